@@ -0,0 +1,37 @@
+"""
+Gunicorn configuration serving the ASGI application with uvicorn workers :
+
+    gunicorn -c gunicorn_asgi.conf.py pureBeurreOC.asgi:application
+
+Every worker runs an event loop. The search, product details and save views
+are async (ASYNC_VIEWS) and run their database queries in a pool of
+ASYNC_VIEWS_THREADS threads, so a slow query no longer blocks the whole
+worker. The other views run in the thread of the synchronous code of Django.
+
+WEB_CONCURRENCY sets the number of workers and PORT the port, like the
+default configuration of gunicorn on Heroku. DEBUG is off, the hosts of the
+site are set in ALLOWED_HOSTS (comma separated). Every worker saves its
+metrics in METRICS_DIRECTORY, emptied when the server starts. The WSGI
+application is still available with the synchronous views :
+
+    gunicorn pureBeurreOC.wsgi --threads 4
+"""
+import os
+import shutil
+import tempfile
+
+bind = "0.0.0.0:{}".format(os.environ.get("PORT", "8000"))
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "uvicorn.workers.UvicornWorker"
+raw_env = ["ASYNC_VIEWS=1", "DJANGO_DEBUG=0"]
+
+
+def on_starting(server):
+    """Remove the metrics saved by the workers of the previous server"""
+    shutil.rmtree(
+        os.environ.get(
+            "METRICS_DIRECTORY",
+            os.path.join(tempfile.gettempdir(), "purebeurre", "metrics"),
+        ),
+        ignore_errors=True,
+    )
@@ -2,6 +2,7 @@ from django.contrib import admin
 
 # Register your models here.
 from django.contrib.auth.models import User
+from .cache import bump_catalog_version
 from .models import (
     Nutriment,
     Category,
@@ -58,8 +59,25 @@ class CategoryAdmin(admin.ModelAdmin):
         return False
 
 
+class CatalogAdminMixin:
+    """Invalidate the cached catalog once a product is changed or deleted,
+    the products and their relations send no signal"""
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        bump_catalog_version()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        bump_catalog_version()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        bump_catalog_version()
+
+
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(CatalogAdminMixin, admin.ModelAdmin):
     inlines = [ProductCategoriesInline, ProductNutrimentsInline, ProductUsersInline]
     search_fields = [
         "name",
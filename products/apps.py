@@ -1,5 +1,21 @@
 from django.apps import AppConfig
+from django.db import connection
+from django.db.models import CharField
 
 
 class ProductsConfig(AppConfig):
     name = "products"
+
+    def ready(self):
+        # connect the signals invalidating the cache of the catalog
+        import products.cache  # noqa: F401
+
+        # connect the health check of the persistent connections
+        import products.routers  # noqa: F401
+
+        # the lookup of the trigram search, once per process. psycopg2 is
+        # only required with PostgreSQL
+        if connection.vendor == "postgresql":
+            from django.contrib.postgres.lookups import TrigramSimilar
+
+            CharField.register_lookup(TrigramSimilar)
@@ -0,0 +1,304 @@
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from urllib.parse import parse_qs, urlparse
+import json
+import os
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from products.importer import (
+    ProductImporter,
+    create_missing_categories,
+    create_missing_nutriments,
+)
+from products.models import Product, ProductUsers
+from products.cache import bump_catalog_version
+from products.substitutes import compute_substitutes
+
+
+DUMP_PATH = os.path.join(os.path.dirname(__file__), "dumps", "products.json")
+
+
+def percentile(values, percent: float):
+    """Return the percentile of the values, by the nearest rank"""
+    values = sorted(values)
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def load_dump_products(path: str = DUMP_PATH):
+    """
+        Return the products of the fixture of the project, in the format of the
+        Open Food Facts API, with their categories and nutriments.
+    """
+    with open(path) as dump_file:
+        rows = json.load(dump_file)
+
+    names = {}
+    for row in rows:
+        if row["model"] in ("products.category", "products.nutriment"):
+            names[(row["model"], row["pk"])] = row["fields"]["name"]
+
+    products = {}
+    for row in rows:
+        if row["model"] == "products.product":
+            fields = row["fields"]
+            products[row["pk"]] = {
+                "url": fields["url"],
+                "image_url": fields["image_url"],
+                "product_name": fields["name"],
+                "nutrition_grades_tags": [fields["nutri_score"]],
+                "categories_tags": [],
+                "nutriments": {},
+            }
+
+    for row in rows:
+        fields = row["fields"]
+        if row["model"] == "products.productcategories":
+            category = names[("products.category", fields["category"])]
+            products[fields["product"]]["categories_tags"].append("en:" + category)
+        elif row["model"] == "products.productnutriments":
+            nutriment = names[("products.nutriment", fields["nutriment"])]
+            products[fields["product"]]["nutriments"][nutriment + "_100g"] = fields[
+                "quantity"
+            ]
+
+    return list(products.values())
+
+
+def iter_scaled_products(products, number: int):
+    """Yield number products, the products of the dump followed by copies
+    of them with a new name and new urls"""
+    for index in range(number):
+        product = products[index % len(products)]
+        copy = index // len(products)
+        if copy == 0:
+            yield product
+            continue
+        yield dict(
+            product,
+            url="{}-{}".format(product["url"], copy),
+            image_url=(
+                "{}?copy={}".format(product["image_url"], copy)
+                if product["image_url"]
+                else None
+            ),
+            product_name="{} {}".format(product["product_name"], copy),
+        )
+
+
+def seed_products(number: int, batch_size: int = None):
+    """Fill the database with number products scaled from the dump, with
+    their substitutes. Return the number of seconds it took"""
+    start = time.perf_counter()
+    create_missing_nutriments()
+    create_missing_categories()
+
+    importer = ProductImporter(batch_size or settings.IMPORT_BATCH_SIZE)
+    importer.load_existing_keys()
+    for product in iter_scaled_products(load_dump_products(), number):
+        importer.add(product)
+    importer.flush()
+
+    compute_substitutes()
+    bump_catalog_version()
+    return time.perf_counter() - start
+
+
+def measure_requests(name: str, send_requests):
+    """
+        Send the requests of a view and measure them.
+
+        Parameters:
+            - name (str): the name of the view in the results
+            - send_requests (iterable): callables sending one request each,
+              returning the response
+
+        Returns the latencies in milliseconds (p50, p95, mean, max) and the
+        queries per request (mean, max).
+    """
+    latencies = []
+    queries = []
+    for send_request in send_requests:
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            response = send_request()
+            latencies.append((time.perf_counter() - start) * 1000)
+        queries.append(len(context))
+        if response.status_code >= 400:
+            raise RuntimeError(
+                "{} returned a status code {}".format(name, response.status_code)
+            )
+
+    return {
+        "requests": len(latencies),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "max_ms": round(max(latencies), 3),
+        "queries_mean": round(sum(queries) / len(queries), 2),
+        "queries_max": max(queries),
+    }
+
+
+def benchmark_views(requests: int, seed: int = 0):
+    """Measure the search, product details, saved products and save views,
+    with products taken at random. The cache is cleared before every view"""
+    generator = random.Random(seed)
+    products = list(Product.objects.values_list("id", "name"))
+    sample = [generator.choice(products) for _ in range(requests)]
+
+    user, created = User.objects.get_or_create(username="benchmark")
+    user.set_password("benchmark")
+    user.save()
+    ProductUsers.objects.filter(user=user).delete()
+    ProductUsers.objects.bulk_create(
+        [
+            ProductUsers(product_id=product_id, user=user)
+            for product_id in {product_id for product_id, name in sample[:50]}
+        ]
+    )
+
+    anonymous = Client()
+    authenticated = Client()
+    authenticated.force_login(user)
+    results = {}
+
+    cache.clear()
+    results["SearchResult"] = measure_requests(
+        "SearchResult",
+        [
+            lambda name=name: anonymous.get(
+                reverse("product-search-results"), {"q": " ".join(name.split())}
+            )
+            for product_id, name in sample
+        ],
+    )
+
+    cache.clear()
+    results["ProductDetails"] = measure_requests(
+        "ProductDetails",
+        [
+            lambda product_id=product_id: anonymous.get(
+                reverse("product-details", args=(product_id,))
+            )
+            for product_id, name in sample
+        ],
+    )
+
+    cache.clear()
+    results["UserResults"] = measure_requests(
+        "UserResults",
+        [
+            lambda: authenticated.get(reverse("product-user-results"))
+            for _ in range(requests)
+        ],
+    )
+
+    cache.clear()
+    results["UserSaveProduct"] = measure_requests(
+        "UserSaveProduct",
+        [
+            lambda product_id=product_id: authenticated.get(
+                reverse("save-product", args=(product_id,))
+            )
+            for product_id, name in sample
+        ],
+    )
+
+    return results
+
+
+class OpenFoodFactsBenchmarkStub(BaseHTTPRequestHandler):
+    """Search API generating new products, page_size per page, up to
+    server.products_per_category products per category"""
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        category = query["search_terms"][0]
+        page = int(query["page"][0])
+        page_size = int(query["page_size"][0])
+
+        start = (page - 1) * page_size
+        stop = min(start + page_size, self.server.products_per_category)
+        products = [
+            {
+                "url": "https://benchmark.test/{}/{}".format(category, number),
+                "product_name": "Benchmark {} {}".format(category, number),
+                "nutrition_grades_tags": ["abcde"[number % 5]],
+                "categories_tags": ["en:" + category],
+                "nutriments": {"fat_100g": number % 30, "salt_100g": number % 3},
+                "last_modified_t": 1600000000 + number,
+            }
+            for number in range(start, stop)
+        ]
+
+        body = json.dumps({"count": len(products), "products": products}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def benchmark_database_update(products_per_category: int):
+    """Run database_update against a local stub of the search API, return
+    the number of products written per second"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OpenFoodFactsBenchmarkStub)
+    server.products_per_category = products_per_category
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    products_before = Product.objects.count()
+    try:
+        with override_settings(
+            OFF_SEARCH_URL="http://127.0.0.1:{}/cgi/search.pl".format(
+                server.server_address[1]
+            )
+        ), redirect_stdout(StringIO()):
+            start = time.perf_counter()
+            call_command(
+                "database_update", "--full", "--products", str(products_per_category)
+            )
+            elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    inserted = Product.objects.count() - products_before
+    return {
+        "products_per_category": products_per_category,
+        "inserted_products": inserted,
+        "seconds": round(elapsed, 3),
+        "products_per_second": round(inserted / elapsed, 1) if elapsed else None,
+    }
+
+
+def run_benchmark(products: int, requests: int, update_products: int):
+    """Seed the database, then measure the views and database_update,
+    return the results as a dict"""
+    results = {
+        "database": connection.vendor,
+        "products": products,
+        "seed_seconds": round(seed_products(products), 3),
+        "views": benchmark_views(requests),
+    }
+    if update_products:
+        results["database_update"] = benchmark_database_update(update_products)
+    return results
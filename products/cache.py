@@ -0,0 +1,179 @@
+from datetime import datetime, timezone
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from products.metrics import record_cache_lookup
+from products.models import Category, Nutriment
+
+
+CATALOG_VERSION_KEY = "products:catalog-version"
+
+
+def shared_cache():
+    """Return True when the cache is shared by the processes of the server
+    and the cron job, False for the memory of every process"""
+    return not isinstance(caches["default"], LocMemCache)
+
+
+def catalog_version_timeout():
+    """Return the timeout of the version of the catalog. The cron job can't
+    bump the version kept in the memory of the web processes, it expires
+    after CATALOG_VERSION_LOCAL_TIMEOUT instead"""
+    return None if shared_cache() else settings.CATALOG_VERSION_LOCAL_TIMEOUT
+
+
+def get_catalog_version():
+    """
+        Return the version of the catalog, part of the key of every cached
+        entry built from the products. Bumping the version invalidates all
+        these entries at once, the old ones expire by themselves.
+    """
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, time.time_ns(), catalog_version_timeout())
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    """Invalidate every cached entry built from the products, called once
+    the import commands have written the new products"""
+    cache.set(CATALOG_VERSION_KEY, time.time_ns(), catalog_version_timeout())
+
+
+def catalog_cache_key(name: str, key: str):
+    """Return the cache key of an entry of the catalog, the key is hashed
+    so any text (urls, searched texts) can be used"""
+    return "products:{}:{}:{}".format(
+        name, get_catalog_version(), hashlib.md5(key.encode()).hexdigest()
+    )
+
+
+def get_or_set_catalog(name: str, key: str, compute):
+    """
+        Return the cached result of compute(), computed once per version of
+        the catalog.
+
+        Parameters:
+            - name (str): the kind of entry, like "search"
+            - key (str): the key of the entry in this kind
+            - compute (callable): returns the value to cache, not None
+    """
+    cache_key = catalog_cache_key(name, key)
+    value = cache.get(cache_key)
+    record_cache_lookup(name, value is not None)
+    if value is None:
+        value = compute()
+        cache.set(cache_key, value, settings.CATALOG_CACHE_TIMEOUT)
+    return value
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Nutriment)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Nutriment)
+def catalog_changed(sender, **kwargs):
+    """Invalidate the cache when a category or a nutriment is changed from
+    the admin site. The products and their relations are written in bulk by
+    the imports, which bump the version once per operation : a receiver on
+    these tables would send a signal per row and prevent the fast deletes"""
+    bump_catalog_version()
+
+
+def sets_cookie(request, response):
+    """Return True when a cookie is sent with the response, by the view or
+    by the middlewares : the csrf token, the session or the messages"""
+    session = getattr(request, "session", None)
+    messages = getattr(request, "_messages", None)
+    return bool(
+        response.cookies
+        or request.META.get("CSRF_COOKIE_USED")
+        or (session is not None and session.modified)
+        or (messages is not None and (messages.used or messages.added_new))
+    )
+
+
+class AnonymousPageCacheMixin:
+    """
+        Cache the pages of a view for the anonymous visitors, until the next
+        version of the catalog.
+
+        The pages are cached per url. A page sending a cookie, like the one
+        of a csrf token rendered in a form, is specific to the visitor and
+        is not cached.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD") or request.user.is_authenticated:
+            return super().dispatch(request, *args, **kwargs)
+
+        key = catalog_cache_key("page", request.get_full_path())
+        cached_page = cache.get(key)
+        record_cache_lookup("page", cached_page is not None)
+        if cached_page is not None:
+            content, content_type = cached_page
+            return HttpResponse(content, content_type=content_type)
+
+        response = super().dispatch(request, *args, **kwargs)
+
+        if (
+            response.status_code == 200
+            and not response.streaming
+            and not sets_cookie(request, response)
+        ):
+            cache.set(
+                key,
+                (response.content, response["Content-Type"]),
+                settings.CATALOG_CACHE_TIMEOUT,
+            )
+
+        return response
+
+
+def catalog_etag(request, *args, **kwargs):
+    return str(get_catalog_version())
+
+
+def catalog_last_modified(request, *args, **kwargs):
+    return datetime.fromtimestamp(get_catalog_version() / 10 ** 9, timezone.utc)
+
+
+class CatalogConditionalMixin:
+    """
+        Send the ETag and Last-Modified of the version of the catalog with the
+        pages of the anonymous visitors, and answer 304 Not Modified to the
+        browsers and proxies revalidating a page of the same version.
+
+        The pages of the users show their saved products, they are neither
+        validated nor cached by the proxies. Neither are the pages sending a
+        cookie, nor the pages of a server whose processes each keep their own
+        version of the catalog in memory.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if (
+            request.method not in ("GET", "HEAD")
+            or request.user.is_authenticated
+            or not shared_cache()
+        ):
+            return super().dispatch(request, *args, **kwargs)
+
+        conditional_dispatch = condition(
+            etag_func=catalog_etag, last_modified_func=catalog_last_modified
+        )(super().dispatch)
+        response = conditional_dispatch(request, *args, **kwargs)
+
+        if response.status_code in (200, 304) and not sets_cookie(request, response):
+            patch_cache_control(
+                response, public=True, max_age=settings.CATALOG_HTTP_MAX_AGE
+            )
+        return response
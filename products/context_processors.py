@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+
+from products.cache import get_catalog_version
+
+
+def catalog(request):
+    """Add the version of the catalog to the context of the templates, for
+    the keys of the cached fragments, and the minimum length of the
+    autocompleted texts. The version is read from the cache only by the
+    templates using it"""
+    return {
+        "catalog_version": SimpleLazyObject(get_catalog_version),
+        "catalog_cache_timeout": settings.CATALOG_CACHE_TIMEOUT,
+        "autocomplete_min_length": settings.AUTOCOMPLETE_MIN_LENGTH,
+    }
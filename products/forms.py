@@ -13,9 +13,15 @@ from django.contrib.auth.forms import (
 
 
 class SearchForm(forms.Form):
-    product_name = forms.CharField(
+    q = forms.CharField(
         max_length=50,
-        widget=forms.TextInput(attrs={"placeholder": "Rechercher"}),
+        widget=forms.TextInput(
+            attrs={
+                "placeholder": "Rechercher",
+                "list": "product-suggestions",
+                "autocomplete": "off",
+            }
+        ),
         required=True,
     )
 
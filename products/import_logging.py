@@ -0,0 +1,105 @@
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+import json
+import logging
+import queue
+
+
+logger = logging.getLogger("products.database_update")
+
+# verbosity option of the commands : 0 only the warnings, 1 the summaries,
+# 2 and more every page and every product
+VERBOSITY_LEVELS = {0: logging.WARNING, 1: logging.INFO}
+
+LOG_FORMATS = ("text", "json")
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the event and the stats passed in
+    the extra of the record"""
+
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "event": getattr(record, "event", None),
+            "message": record.getMessage(),
+        }
+        data.update(getattr(record, "stats", {}))
+        return json.dumps(data, default=str)
+
+
+@contextmanager
+def queued_logging(stream, verbosity: int = 1, log_format: str = "text"):
+    """
+        Send the records of the import logger to a stream from a background
+        thread, the command only puts them in a queue.
+
+        Parameters:
+            - stream (file-like): where the records are written, like the
+              stdout of the command
+            - verbosity (int): the verbosity option of the command
+            - log_format (str): "text" for the messages only, "json" for one
+              JSON object per line
+    """
+    handler = logging.StreamHandler(stream)
+    if log_format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(message)s"))
+
+    records = queue.Queue()
+    queue_handler = QueueHandler(records)
+    listener = QueueListener(records, handler)
+
+    previous_level, previous_propagate = logger.level, logger.propagate
+    logger.setLevel(VERBOSITY_LEVELS.get(verbosity, logging.DEBUG))
+    logger.propagate = False
+    logger.addHandler(queue_handler)
+    listener.start()
+    try:
+        yield logger
+    finally:
+        # writes the records left in the queue
+        listener.stop()
+        logger.removeHandler(queue_handler)
+        logger.setLevel(previous_level)
+        logger.propagate = previous_propagate
+        handler.flush()
+
+
+@contextmanager
+def worker_logging(records, verbosity: int = 1):
+    """
+        Send the records of the import logger of a worker process to the
+        process which started it, instead of the handlers inherited from it.
+
+        Parameters:
+            - records (queue): a queue shared with the main process, like a
+              queue of a multiprocessing manager
+            - verbosity (int): the verbosity option of the command
+    """
+    previous_handlers = logger.handlers
+    previous_level, previous_propagate = logger.level, logger.propagate
+    logger.handlers = [QueueHandler(records)]
+    logger.setLevel(VERBOSITY_LEVELS.get(verbosity, logging.DEBUG))
+    logger.propagate = False
+    try:
+        yield logger
+    finally:
+        logger.handlers = previous_handlers
+        logger.setLevel(previous_level)
+        logger.propagate = previous_propagate
+
+
+@contextmanager
+def collect_worker_logs(records):
+    """Write the records sent by the worker processes with the records of
+    the main process, see worker_logging"""
+    listener = QueueListener(records, logger)
+    listener.start()
+    try:
+        yield
+    finally:
+        listener.stop()
@@ -0,0 +1,471 @@
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from products.search import normalize_search_text
+from products.models import (
+    Nutriment,
+    Category,
+    Product,
+    ProductCategories,
+    ProductNutriments,
+)
+
+
+NUTRI_SCORES = ["a", "b", "c", "d", "e"]
+
+
+def clean_category_tag(tag: str):
+    """Remove the language prefix of an Open Food Facts category tag"""
+    return tag.replace("en:", "").replace("fr:", "")
+
+
+def clean_quantity(value):
+    """Return the quantity as a float, None if it is empty or not a number"""
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def normalize_product(product: dict, nutriment_names):
+    """
+        Apply the Pur Beurre rules to a product coming from Open Food Facts.
+
+        Parameters:
+            - product (dict): the product as returned by the Open Food Facts API
+            - nutriment_names (iterable): names of the nutriments to keep
+
+        Returns a dict with the url, image_url, name, nutri_score, categories,
+        nutriments, content_hash and last_modified_t of the product, None if
+        the product can't be used.
+    """
+    url = product.get("url")
+    if not url:
+        return None
+
+    # the name of the product fallback on the french name
+    name = product.get("product_name")
+    if name is None or name == "":
+        name = product.get("product_name_fr")
+        if name is None or name == "":
+            return None
+
+    # set the nutrition score of the product
+    nutri_score = ""
+    if "nutrition_grades_tags" in product:
+        grades = product["nutrition_grades_tags"] or [""]
+        nutri_score = grades[0].lower()
+        if nutri_score not in NUTRI_SCORES:
+            nutri_score = "e"
+
+    product_nutriments = product.get("nutriments") or {}
+
+    new_product = {
+        "url": url,
+        "image_url": product.get("image_url") or None,
+        "name": name,
+        "nutri_score": nutri_score,
+        "categories": list(
+            dict.fromkeys(
+                clean_category_tag(tag) for tag in product.get("categories_tags") or []
+            )
+        ),
+        "nutriments": {
+            nutriment: clean_quantity(product_nutriments.get(nutriment + "_100g"))
+            for nutriment in nutriment_names
+        },
+    }
+
+    # hash of the datas stored for the product, to detect upstream changes
+    new_product["content_hash"] = hashlib.sha1(
+        json.dumps(new_product, sort_keys=True).encode()
+    ).hexdigest()
+
+    try:
+        new_product["last_modified_t"] = int(product["last_modified_t"])
+    except (KeyError, TypeError, ValueError):
+        new_product["last_modified_t"] = None
+
+    return new_product
+
+
+def create_missing_nutriments():
+    """Create the nutriments of settings.NUTRIMENTS missing in the database,
+    return the names of the created nutriments"""
+    existing_nutriments = {
+        name.lower() for name in Nutriment.objects.values_list("name", flat=True)
+    }
+    new_nutriments = [
+        Nutriment(name=nutriment, unit=settings.NUTRIMENTS[nutriment]["unit"])
+        for nutriment in settings.NUTRIMENTS
+        if nutriment.lower() not in existing_nutriments
+    ]
+    Nutriment.objects.bulk_create(new_nutriments)
+    return [nutriment.name for nutriment in new_nutriments]
+
+
+def create_missing_categories():
+    """Create the categories of settings.PRODUCTS_CATEGORIES missing in the
+    database, return the names of the created categories"""
+    existing_categories = {
+        name.lower() for name in Category.objects.values_list("name", flat=True)
+    }
+    new_categories = [
+        Category(name=category)
+        for category in settings.PRODUCTS_CATEGORIES
+        if category.lower() not in existing_categories
+    ]
+    Category.objects.bulk_create(new_categories)
+    return [category.name for category in new_categories]
+
+
+def iter_file_lines(path: str):
+    """
+        Iterate over the lines of a file without loading it in memory.
+
+        Plain files are memory-mapped, gzip compressed files (.gz) are
+        decompressed chunk by chunk.
+
+        Parameters:
+            - path (str): the path of the file
+
+        Yields every line, as bytes.
+    """
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as dump_file:
+            yield from dump_file
+        return
+
+    with open(path, "rb") as dump_file:
+        # an empty file can't be mapped
+        if os.fstat(dump_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(dump_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield from iter(mapped.readline, b"")
+
+
+def jsonl_to_product(line: bytes):
+    """Decode a line of an Open Food Facts JSONL dump, None if it is not valid"""
+    try:
+        product = json.loads(line)
+    except ValueError:
+        return None
+
+    if not isinstance(product, dict):
+        return None
+
+    # the dumps don't have the urls computed by the API
+    if not product.get("url") and product.get("code"):
+        product["url"] = settings.OFF_PRODUCT_URL.format(product["code"])
+    if not product.get("image_url"):
+        product["image_url"] = product.get("image_front_url")
+
+    return product
+
+
+def csv_to_product(row: dict):
+    """Convert a row of the Open Food Facts CSV export to the format of the API"""
+    grade = row.get("nutriscore_grade") or row.get("nutrition_grade_fr")
+    categories = row.get("categories_tags") or ""
+
+    return {
+        "code": row.get("code"),
+        "url": row.get("url"),
+        "image_url": row.get("image_url"),
+        "product_name": row.get("product_name"),
+        "product_name_fr": row.get("product_name_fr"),
+        "last_modified_t": row.get("last_modified_t"),
+        "nutrition_grades_tags": [grade or "unknown"],
+        "categories_tags": [tag for tag in categories.split(",") if tag],
+        "nutriments": {
+            key: value for key, value in row.items() if key.endswith("_100g")
+        },
+    }
+
+
+def iter_dump_products(path: str, dump_format: str = None):
+    """
+        Iterate over the products of an Open Food Facts dump file.
+
+        Parameters:
+            - path (str): the path of the dump, optionally gzip compressed
+            - dump_format (str): "jsonl" or "csv" (tab-separated), guessed
+              from the name of the file by default
+
+        Yields the products in the format of the API.
+    """
+    if dump_format is None:
+        name = path[:-3] if path.endswith(".gz") else path
+        dump_format = "csv" if name.endswith((".csv", ".tsv")) else "jsonl"
+
+    lines = iter_file_lines(path)
+
+    if dump_format == "jsonl":
+        for line in lines:
+            product = jsonl_to_product(line)
+            if product is not None:
+                yield product
+        return
+
+    header = next(lines, None)
+    if header is None:
+        return
+    columns = header.decode("utf-8", "replace").rstrip("\r\n").split("\t")
+
+    for line in lines:
+        values = line.decode("utf-8", "replace").rstrip("\r\n").split("\t")
+        yield csv_to_product(dict(zip(columns, values)))
+
+
+def product_keys(product: dict):
+    """Return the keys of a normalized product checked by the unique
+    constraints, only the url for an update"""
+    keys = [("url", product["url"].lower())]
+    if product.get("id") is None:
+        keys.append(("name", product["name"].lower()))
+        if product["image_url"]:
+            keys.append(("image_url", product["image_url"].lower()))
+    return keys
+
+
+class ProductImporter:
+    """
+        Insert or update Open Food Facts products in the database with batched
+        bulk queries.
+
+        The url, image_url, name and content hash of the products already in the
+        database are loaded once in memory, so duplicates and unchanged products
+        are skipped without any query. A product whose url is known but whose
+        content hash changed is updated, with its categories and nutriments.
+        Products are buffered and written every batch_size products, or when
+        flush() is called, in one transaction per batch.
+
+        Parameters:
+            - batch_size (int): the number of products per batch,
+              IMPORT_BATCH_SIZE by default
+            - on_flush (callable): called without arguments in the transaction
+              of every batch, like to save where the import is
+            - claim (callable): for the parallel imports, claim(products_keys)
+              returns the indexes of the products this process can write, the
+              others are written by another process
+    """
+
+    def __init__(self, batch_size: int = None, on_flush=None, claim=None):
+        self.batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+        self.on_flush = on_flush
+        self.claim = claim
+        self.urls = {}
+        self.image_urls = set()
+        self.names = set()
+        self.categories = {}
+        self.nutriments = {}
+        self.pending = []
+        self.pending_updates = []
+        self.inserted_products = 0
+        self.updated_products = 0
+        self.skipped_products = 0
+        self.inserted_rows = 0
+        self.write_time = 0.0
+
+    def load_existing_keys(self):
+        """Load the keys of the products, categories and nutriments in memory"""
+        for product_id, url, image_url, name, content_hash in Product.objects.values_list(
+            "id", "url", "image_url", "name", "content_hash"
+        ).iterator():
+            self.urls[url.lower()] = (product_id, content_hash)
+            if image_url:
+                self.image_urls.add(image_url.lower())
+            self.names.add(name.lower())
+
+        self.categories = dict(Category.objects.values_list("name", "id"))
+        self.nutriments = dict(Nutriment.objects.values_list("name", "id"))
+
+    def add(self, product: dict):
+        """
+            Normalize a product and queue it for insertion, or for update if it
+            is already in the database and changed.
+
+            Parameters:
+                - product (dict): the product as returned by the Open Food Facts API
+
+            Returns the normalized product, with the id of the product to update
+            in "id" for an update. None if it is invalid, already known or unchanged.
+        """
+        new_product = normalize_product(product, self.nutriments)
+
+        if new_product is None:
+            self.skipped_products += 1
+            return None
+
+        key = new_product["url"].lower()
+        if key in self.urls:
+            product_id, content_hash = self.urls[key]
+            # a product seen twice in the run is kept as first seen
+            if product_id is None or content_hash == new_product["content_hash"]:
+                self.skipped_products += 1
+                return None
+
+            self.urls[key] = (product_id, new_product["content_hash"])
+            new_product["id"] = product_id
+            self.pending_updates.append(new_product)
+
+        elif self.is_known(new_product):
+            self.skipped_products += 1
+            return None
+
+        else:
+            self.urls[key] = (None, new_product["content_hash"])
+            if new_product["image_url"]:
+                self.image_urls.add(new_product["image_url"].lower())
+            self.names.add(new_product["name"].lower())
+            self.pending.append(new_product)
+
+        if len(self.pending) + len(self.pending_updates) >= self.batch_size:
+            self.flush()
+
+        return new_product
+
+    def is_known(self, product: dict):
+        """Return True if the url, image_url or name of the product is already used"""
+        return (
+            product["url"].lower() in self.urls
+            or (product["image_url"] or "").lower() in self.image_urls
+            or product["name"].lower() in self.names
+        )
+
+    def flush(self):
+        """Write the pending products and their relations in the database,
+        in one transaction"""
+        if not self.pending and not self.pending_updates:
+            return
+
+        if self.claim is not None:
+            self.claim_pending()
+
+        start = time.perf_counter()
+        with transaction.atomic():
+            self.write_pending()
+            if self.on_flush is not None:
+                self.on_flush()
+
+        self.write_time += time.perf_counter() - start
+        self.pending = []
+        self.pending_updates = []
+
+    def claim_pending(self):
+        """Keep the pending products claimed by this process, in one call
+        to the claim registry per batch"""
+        products = self.pending + self.pending_updates
+        accepted = set(self.claim([product_keys(product) for product in products]))
+
+        self.skipped_products += len(products) - len(accepted)
+        # the updates follow the new products in the claimed list
+        first_update = len(self.pending)
+        self.pending = [
+            product for index, product in enumerate(self.pending) if index in accepted
+        ]
+        self.pending_updates = [
+            product
+            for index, product in enumerate(self.pending_updates, first_update)
+            if index in accepted
+        ]
+
+    def write_pending(self):
+        """Insert the pending products and update the changed ones, with their
+        categories and their nutriments"""
+        products = Product.objects.bulk_create(
+            [
+                Product(
+                    name=product["name"],
+                    search_name=normalize_search_text(product["name"]),
+                    url=product["url"],
+                    image_url=product["image_url"],
+                    nutri_score=product["nutri_score"],
+                    content_hash=product["content_hash"],
+                    last_modified_t=product["last_modified_t"],
+                )
+                for product in self.pending
+            ],
+            batch_size=self.batch_size,
+        )
+
+        # only some backends set the primary keys on bulk_create
+        if any(product.pk is None for product in products):
+            ids = dict(
+                Product.objects.filter(
+                    url__in=[product.url for product in products]
+                ).values_list("url", "id")
+            )
+            for product in products:
+                product.pk = ids[product.url]
+
+        for product, new_product in zip(products, self.pending):
+            new_product["id"] = product.pk
+            self.urls[product.url.lower()] = (product.pk, new_product["content_hash"])
+
+        # the name and urls are the keys of the product, they are not updated
+        updated_ids = [product["id"] for product in self.pending_updates]
+        Product.objects.bulk_update(
+            [
+                Product(
+                    id=product["id"],
+                    nutri_score=product["nutri_score"],
+                    content_hash=product["content_hash"],
+                    last_modified_t=product["last_modified_t"],
+                )
+                for product in self.pending_updates
+            ],
+            ["nutri_score", "content_hash", "last_modified_t"],
+            batch_size=self.batch_size,
+        )
+        ProductCategories.objects.filter(product_id__in=updated_ids).delete()
+        ProductNutriments.objects.filter(product_id__in=updated_ids).delete()
+
+        product_categories = []
+        product_nutriments = []
+        for new_product in self.pending + self.pending_updates:
+            for category in new_product["categories"]:
+                if category in self.categories:
+                    product_categories.append(
+                        ProductCategories(
+                            product_id=new_product["id"],
+                            category_id=self.categories[category],
+                        )
+                    )
+
+            for nutriment, quantity in new_product["nutriments"].items():
+                product_nutriments.append(
+                    ProductNutriments(
+                        product_id=new_product["id"],
+                        nutriment_id=self.nutriments[nutriment],
+                        quantity=quantity,
+                    )
+                )
+
+        ProductCategories.objects.bulk_create(
+            product_categories, batch_size=self.batch_size
+        )
+        ProductNutriments.objects.bulk_create(
+            product_nutriments, batch_size=self.batch_size
+        )
+
+        self.inserted_products += len(self.pending)
+        self.updated_products += len(self.pending_updates)
+        self.inserted_rows += (
+            len(self.pending) + len(product_categories) + len(product_nutriments)
+        )
+
+    def rows_per_second(self):
+        """Return the number of rows written per second of database writes"""
+        if self.write_time == 0:
+            return 0.0
+        return self.inserted_rows / self.write_time
@@ -0,0 +1,84 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.test.utils import (
+    setup_databases,
+    setup_test_environment,
+    teardown_databases,
+    teardown_test_environment,
+)
+
+import json
+import subprocess
+
+from products.benchmark import run_benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the latency and the queries of the main views and the speed of "
+        "database_update, on a test database seeded from products/dumps/products.json"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--products",
+            type=int,
+            default=10000,
+            help="Number of products of the test database, like 10000, 100000 or 1000000",
+        )
+        parser.add_argument(
+            "--requests",
+            type=int,
+            default=200,
+            help="Number of requests sent to every view",
+        )
+        parser.add_argument(
+            "--update-products",
+            type=int,
+            default=100,
+            help="Number of products per category imported by database_update, 0 to skip it",
+        )
+        parser.add_argument(
+            "--output", help="Write the results in this JSON file instead of the output"
+        )
+        parser.add_argument(
+            "--keepdb",
+            action="store_true",
+            help="Keep the test database between two runs",
+        )
+
+    def handle(self, *args, **options):
+        # the test database of the configured one, SQLite or PostgreSQL
+        setup_test_environment(debug=False)
+        old_config = setup_databases(
+            verbosity=0, interactive=False, keepdb=options["keepdb"]
+        )
+        try:
+            results = run_benchmark(
+                options["products"], options["requests"], options["update_products"]
+            )
+        finally:
+            teardown_databases(old_config, verbosity=0, keepdb=options["keepdb"])
+            teardown_test_environment()
+
+        results["commit"] = self.get_commit()
+        output = json.dumps(results, indent=2)
+
+        if options["output"]:
+            with open(options["output"], "w") as output_file:
+                output_file.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    def get_commit(self):
+        """Return the current git commit, so the results of two commits can be compared"""
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "HEAD"],
+                cwd=settings.BASE_DIR,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,167 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from datetime import datetime
+import os
+import time
+
+from products.importer import (
+    ProductImporter,
+    clean_category_tag,
+    create_missing_categories,
+    create_missing_nutriments,
+    iter_dump_products,
+)
+from products.cache import bump_catalog_version
+from products.import_logging import LOG_FORMATS, queued_logging
+from products.staging import StagingImporter
+from products.substitutes import compute_substitutes
+
+
+class Command(BaseCommand):
+    help = "Fill the database from an Open Food Facts dump file (JSONL or CSV)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "path", help="Path of the dump file, optionally gzip compressed (.gz)"
+        )
+        parser.add_argument(
+            "--format",
+            choices=["jsonl", "csv"],
+            help="Format of the dump, guessed from the name of the file by default",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.IMPORT_BATCH_SIZE,
+            help="Number of products written in the database per transaction",
+        )
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Rebuild the catalog in staging tables swapped with the live ones at the end, "
+            "the products missing from the dump are deleted",
+        )
+        parser.add_argument(
+            "--log-format",
+            choices=LOG_FORMATS,
+            default=settings.IMPORT_LOG_FORMAT,
+            help="Format of the logs, the messages only or one JSON object per line",
+        )
+
+    def handle(self, *args, **options):
+        """
+            The logs are written to stdout by a background thread, like the
+            ones of database_update.
+        """
+        path = options["path"]
+        if not os.path.isfile(path):
+            raise CommandError("Dump file not found : {}".format(path))
+
+        with queued_logging(
+            self.stdout, options["verbosity"], options["log_format"]
+        ) as self.logger:
+            self.import_dump(path, options)
+
+
+    def import_dump(self, path: str, options):
+        logger = self.logger
+        logger.info(
+            "STARTING DATABASE_IMPORT - %s", datetime.now(), extra={"event": "start"}
+        )
+        for nutriment in create_missing_nutriments():
+            logger.info("Adding new nutriment to database : %s", nutriment)
+        for category in create_missing_categories():
+            logger.info("Adding new category to database : %s", category)
+
+        start = time.perf_counter()
+        if options["rebuild"]:
+            importer = StagingImporter(options["batch_size"])
+        else:
+            importer = ProductImporter(options["batch_size"])
+        importer.load_existing_keys()
+        read_products = 0
+
+        try:
+            # every batch of products is written in its own transaction
+            for product in iter_dump_products(path, options["format"]):
+                read_products += 1
+
+                # only the products of the categories of the site are imported
+                if any(
+                    clean_category_tag(tag) in importer.categories
+                    for tag in product.get("categories_tags") or []
+                ):
+                    importer.add(product)
+
+                if read_products % 100000 == 0:
+                    logger.info(
+                        "%d products read, %d products inserted",
+                        read_products,
+                        importer.inserted_products,
+                        extra={
+                            "event": "progress",
+                            "stats": {
+                                "read": read_products,
+                                "inserted": importer.inserted_products,
+                            },
+                        },
+                    )
+
+            importer.flush()
+            if options["rebuild"]:
+                # the site reads the previous catalog until the swap
+                importer.swap()
+        except BaseException:
+            if options["rebuild"]:
+                importer.discard()
+            else:
+                # the cached pages show the committed batches
+                bump_catalog_version()
+            raise
+
+        substitutes_start = time.perf_counter()
+        nb_substitutes = compute_substitutes(batch_size=options["batch_size"])
+        logger.info(
+            "%d substitutes computed in %.2fs",
+            nb_substitutes,
+            time.perf_counter() - substitutes_start,
+            extra={
+                "event": "substitutes",
+                "stats": {
+                    "substitutes": nb_substitutes,
+                    "seconds": round(time.perf_counter() - substitutes_start, 3),
+                },
+            },
+        )
+
+        # the cached pages and the in-memory search indexes of the web
+        # processes show the new products
+        bump_catalog_version()
+
+        elapsed = time.perf_counter() - start
+        rows_per_second = importer.inserted_rows / elapsed if elapsed else 0
+        logger.info(
+            "%d products read, %d inserted, %d updated - "
+            "%d rows written in %.2fs (%.0f rows/sec)",
+            read_products,
+            importer.inserted_products,
+            importer.updated_products,
+            importer.inserted_rows,
+            elapsed,
+            rows_per_second,
+            extra={
+                "event": "summary",
+                "stats": {
+                    "read": read_products,
+                    "inserted": importer.inserted_products,
+                    "updated": importer.updated_products,
+                    "rows": importer.inserted_rows,
+                    "seconds": round(elapsed, 3),
+                    "rows_per_second": round(rows_per_second, 1),
+                },
+            },
+        )
+        logger.info(
+            "END OF DATABASE_IMPORT - %s", datetime.now(), extra={"event": "end"}
+        )
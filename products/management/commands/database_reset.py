@@ -1,25 +1,54 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.core.management.color import no_style
+from django.db import connection, transaction
 
+from products.cache import bump_catalog_version
 from products.models import (
     Nutriment,
     Category,
+    CategorySync,
+    ImportCheckpoint,
+    ImportRun,
     Product,
     ProductCategories,
     ProductNutriments,
+    ProductSubstitute,
+    ProductUsers,
 )
 
-
 class Command(BaseCommand):
     help = "Delete all datas in all tables from the database"
 
     def handle(self, *args, **options):
+        """Empty the tables of the catalog and the saved products with one
+        TRUNCATE on Postgres, instead of deleting the rows one by one"""
+        tables = [
+            model._meta.db_table
+            for model in [
+                ProductUsers,
+                ProductSubstitute,
+                ProductNutriments,
+                ProductCategories,
+                CategorySync,
+                ImportCheckpoint,
+                ImportRun,
+                Product,
+                Nutriment,
+                Category,
+            ]
+        ]
+        sql_list = connection.ops.sql_flush(
+            no_style(), tables, reset_sequences=True, allow_cascade=False
+        )
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                for sql in sql_list:
+                    cursor.execute(sql)
 
-        Product.objects.all().delete()
-        Nutriment.objects.all().delete()
-        Category.objects.all().delete()
-        ProductNutriments.all().delete()
-        ProductCategories.all().delete()
+        # the ids of the products are used again by the next import, the
+        # entries of the cache and the search indexes follow the version
+        # of the catalog
+        bump_catalog_version()
 
         self.stdout.write("DATABASE RESET FINISHED")
-
@@ -2,169 +2,708 @@ import os
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import transaction
+
+from django.utils import timezone
 
 from datetime import datetime
+from functools import partial
+from itertools import islice, takewhile
+import logging
+import time
 
-from products.models import (
-    Nutriment,
-    Category,
-    Product,
-    ProductCategories,
-    ProductNutriments,
-)
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
 
-import json
-import requests
+from products.models import Category, CategorySync, ImportCheckpoint, ImportRun
+from products.importer import (
+    ProductImporter,
+    create_missing_categories,
+    create_missing_nutriments,
+)
+from products.openfoodfacts import OpenFoodFactsClient, OpenFoodFactsError
+from products.cache import bump_catalog_version
+from products import metrics
+from products.import_logging import (
+    LOG_FORMATS,
+    collect_worker_logs,
+    queued_logging,
+    worker_logging,
+)
+from products.parallel import ImportManager, partition, worker_pool
+from products.staging import StagingImporter
+from products.substitutes import compute_substitutes
 
 
 class Command(BaseCommand):
     help = "Call Open Food Facts API to get products and fill the database"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.IMPORT_BATCH_SIZE,
+            help="Number of products written in the database per bulk insert",
+        )
+        parser.add_argument(
+            "--products",
+            type=int,
+            default=settings.NB_PRODUCTS_TO_GET,
+            help="Maximum number of products to get per category, the delta syncs "
+            "get every product modified since the last sync",
+        )
+        parser.add_argument(
+            "--page-size",
+            type=int,
+            default=settings.OFF_PAGE_SIZE,
+            help="Number of products per page requested to Open Food Facts",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=settings.OFF_CONCURRENCY,
+            help="Maximum number of categories fetched at once from Open Food Facts, "
+            "each one requesting its next page while a page is read",
+        )
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Check every product instead of the products modified since the last sync",
+        )
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Rebuild the catalog in staging tables swapped with the live ones at the end, "
+            "the products no longer returned by Open Food Facts are deleted (implies --full)",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.IMPORT_WORKERS,
+            help="Number of processes importing the categories in parallel, "
+            "sharing the --concurrency requests to Open Food Facts",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Continue the last interrupted import from its checkpoints, "
+            "a new import is started if every import finished",
+        )
+        parser.add_argument(
+            "--log-format",
+            choices=LOG_FORMATS,
+            default=settings.IMPORT_LOG_FORMAT,
+            help="Format of the logs, the messages only or one JSON object per line",
+        )
+
     def handle(self, *args, **options):
+        """
+            The logs are written to stdout by a background thread. With the
+            default verbosity only the summaries of the categories and of the
+            import are logged, --verbosity 2 logs every page and every product.
+        """
+        with queued_logging(
+            self.stdout, options["verbosity"], options["log_format"]
+        ) as self.logger:
+            self.update_database(options)
+
+
+    def update_database(self, options):
+        if options["resume"] and options["rebuild"]:
+            raise CommandError(
+                "--resume can't be used with --rebuild, "
+                "a rebuild always starts from empty staging tables"
+            )
+        if options["workers"] > 1 and options["rebuild"]:
+            raise CommandError(
+                "--workers can't be used with --rebuild, "
+                "the staging tables are loaded by one process"
+            )
+
+        logger = self.logger
+        logger.info(
+            "STARTING DATABASE_UPDATE - %s", datetime.now(), extra={"event": "start"}
+        )
+        new_nutriments = create_missing_nutriments()
+        new_categories = create_missing_categories()
+        for nutriment in new_nutriments:
+            logger.info("Adding new nutriment to database : %s", nutriment)
+        for category in new_categories:
+            logger.info("Adding new category to database : %s", category)
+        logger.debug(
+            "%d nutriments, %d categories",
+            len(settings.NUTRIMENTS),
+            len(settings.PRODUCTS_CATEGORIES),
+        )
 
-        print("**************************************************")
-        print("STARTING DATABASE_UPDATE - {}".format(datetime.now()))
-        print("**************************************************")
-        for nutriment in settings.NUTRIMENTS:
-            if not Nutriment.objects.filter(name__iexact=nutriment):
-                new_nutriment = Nutriment(
-                    name=nutriment, unit=settings.NUTRIMENTS[nutriment]["unit"]
-                )
-                new_nutriment.save()
-                print("Adding new nutriment to database :", nutriment)
+        start = time.perf_counter()
+        # the rebuilds are not resumable, they have no run
+        self.run = None
+        if not options["rebuild"]:
+            self.start_run(options)
+        self.load_run_state()
+
+        categories = [
+            category
+            for category in Category.objects.order_by("id").values_list("name", flat=True)
+            if category not in self.checkpoints or not self.checkpoints[category].finished
+        ]
+
+        try:
+            if options["workers"] > 1:
+                stats = self.import_in_workers(categories, options)
             else:
-                print("Existing nutriment :", nutriment)
-
-        print("--------------------------------------------------")
-        for category in settings.PRODUCTS_CATEGORIES:
-            if not Category.objects.filter(name__iexact=category):
-                new_category = Category(name=category)
-                new_category.save()
-                print("Adding new category to database :", category)
+                self.import_categories(categories, options)
+                stats = self.import_stats()
+
+            if options["rebuild"]:
+                # the site reads the previous catalog until the swap
+                self.importer.swap()
+        except BaseException:
+            if options["rebuild"]:
+                self.importer.discard()
             else:
-                print("Existing category :", category)
+                # the committed batches are kept, --resume continues the run
+                ImportRun.objects.filter(pk=self.run.pk).update(status=ImportRun.FAILED)
+                # the cached pages show the committed products
+                bump_catalog_version()
+            raise
+
+        substitutes_start = time.perf_counter()
+        nb_substitutes = compute_substitutes(batch_size=options["batch_size"])
+        logger.info(
+            "%d substitutes computed in %.2fs",
+            nb_substitutes,
+            time.perf_counter() - substitutes_start,
+            extra={
+                "event": "substitutes",
+                "stats": {
+                    "substitutes": nb_substitutes,
+                    "seconds": round(time.perf_counter() - substitutes_start, 3),
+                },
+            },
+        )
+
+        # the cached pages and the in-memory search indexes of the web
+        # processes show the new products
+        bump_catalog_version()
 
-        print("--------------------------------------------------")
-        for category in Category.objects.all():
-            self.get_products_for_category(category.name)
+        if self.run is not None:
+            self.run.status = ImportRun.FINISHED
+            self.run.finished_at = timezone.now()
+            self.run.save(update_fields=["status", "finished_at"])
 
-        print("**************************************************")
-        print("END OF DATABASE_UPDATE - {}".format(datetime.now()))
-        print("**************************************************")
+        elapsed = time.perf_counter() - start
+        self.write_metrics(stats, elapsed)
+
+        rows_per_second = stats["rows"] / elapsed if elapsed else 0
+        logger.info(
+            "%d products inserted, %d updated, %d skipped - "
+            "%d rows written in %.2fs (%.0f rows/sec)",
+            stats["inserted"],
+            stats["updated"],
+            stats["skipped"],
+            stats["rows"],
+            elapsed,
+            rows_per_second,
+            extra={
+                "event": "summary",
+                "stats": dict(
+                    stats,
+                    seconds=round(elapsed, 3),
+                    write_seconds=round(stats["write_seconds"], 3),
+                    rows_per_second=round(rows_per_second, 1),
+                ),
+            },
+        )
+        logger.info(
+            "END OF DATABASE_UPDATE - %s", datetime.now(), extra={"event": "end"}
+        )
 
         # with open(os.path.join(os.path.dirname(settings.BASE_DIR), 'django_cron.log'), 'a') as log_file:
         #     print("PRODUCTS DATAS UPDATE DONE - {}".format(datetime.now()), file=log_file)
 
 
-    def get_products_for_category(self, product_category: str):
+    def start_run(self, options):
+        """
+            Start the import run to continue with --resume, the last one which
+            didn't finish, or a new import run, in self.run. Every category
+            has a checkpoint in the run.
         """
-            GET request to open food fact api to get products in a category.
-            For each response, datas are inserted in the database
+        run = None
+        if options["resume"]:
+            run = (
+                ImportRun.objects.exclude(status=ImportRun.FINISHED)
+                .order_by("-started_at", "-id")
+                .first()
+            )
+            if run is None:
+                self.logger.info("No interrupted import to resume, starting a new one")
+
+        resumed = run is not None
+        if resumed:
+            run.status = ImportRun.RUNNING
+            run.save(update_fields=["status"])
+        else:
+            run = ImportRun.objects.create(full=options["full"])
+        self.run = run
+
+        # the categories added to the settings since the start of the run
+        ImportCheckpoint.objects.bulk_create(
+            [
+                ImportCheckpoint(run=run, category_id=category_id)
+                for category_id in Category.objects.exclude(
+                    importcheckpoint__run=run
+                ).values_list("id", flat=True)
+            ]
+        )
+
+        if resumed:
+            finished = run.checkpoints.filter(finished=True).count()
+            self.logger.info(
+                "Resuming the import started %s : %d of %d categories finished",
+                run.started_at,
+                finished,
+                run.checkpoints.count(),
+                extra={
+                    "event": "resume",
+                    "stats": {"run": run.pk, "finished_categories": finished},
+                },
+            )
+
+
+    def load_run_state(self):
+        """Load the checkpoints of the categories of self.run, and the last
+        modifications imported per category for the delta sync"""
+        self.checkpoints = {}
+        self.checkpoint = None
+        self.last_modified = {}
+        if self.run is not None:
+            self.checkpoints = {
+                checkpoint.category.name: checkpoint
+                for checkpoint in self.run.checkpoints.select_related("category")
+            }
+            if not self.run.full:
+                self.last_modified = {
+                    sync.category.name: sync.last_modified_t
+                    for sync in CategorySync.objects.select_related("category")
+                    if sync.last_modified_t is not None
+                }
+
+        # where the fetch threads start the categories, read before the
+        # checkpoints are updated
+        self.resume_points = {
+            category: (checkpoint.page, checkpoint.last_code)
+            for category, checkpoint in self.checkpoints.items()
+            if checkpoint.products > 0
+        }
+
+
+    def import_categories(self, categories, options, claim=None):
+        """
+            Import the products of the categories with the importer and the
+            fetch threads of this process.
 
             Parameters:
-                - product_category (str): the name of the category of products to get
+                - categories (list): the names of the categories to import
+                - options (dict): the options of the command
+                - claim (callable): the claims of the products of a worker of
+                  a parallel import, see ProductImporter
         """
+        if options["rebuild"]:
+            self.importer = StagingImporter(options["batch_size"])
+        else:
+            self.importer = ProductImporter(
+                options["batch_size"], on_flush=self.save_checkpoint, claim=claim
+            )
+        self.importer.load_existing_keys()
+        self.fetched_products = 0
+        self.failed_categories = []
+
+        self.max_products = options["products"]
+        self.page_size = options["page_size"]
+
+        # the next products are downloaded while the current ones are written
+        with OpenFoodFactsClient(concurrency=options["concurrency"]) as self.client:
+            for category, products in self.client.fetch_categories(
+                self.iter_category_products, categories, self.page_size
+            ):
+                fetched = self.get_products_for_category(category, products)
+                if options["rebuild"] and fetched == 0:
+                    # Open Food Facts failed, the products of the category
+                    # would be deleted by the swap
+                    raise CommandError(
+                        "No product fetched for the category {}, "
+                        "the catalog is kept".format(category)
+                    )
 
-        response = self.openfoodfacts_api_get_product(product_category, settings.NB_PRODUCTS_TO_GET, settings.USER_AGENT_OFF)
+        if self.failed_categories:
+            # the run is marked failed, the cron job resumes it
+            raise CommandError(
+                "Open Food Facts failed for the categories {}, "
+                "--resume continues the import".format(", ".join(self.failed_categories))
+            )
 
-        if (response is not None):
-            for product in response["products"]:
 
-                new_product = Product()
-                
-                if Product.objects.filter(url__iexact=product["url"]):
-                    continue
-                new_product.url = product["url"]
+    def import_stats(self):
+        """Return the numbers of products and rows of the import of this process"""
+        return {
+            "fetched": self.fetched_products,
+            "inserted": self.importer.inserted_products,
+            "updated": self.importer.updated_products,
+            "skipped": self.importer.skipped_products,
+            "rows": self.importer.inserted_rows,
+            "write_seconds": self.importer.write_time,
+        }
+
+
+    def import_in_workers(self, categories, options):
+        """
+            Import the categories in a pool of worker processes, each one with
+            its own connection to the database, its own importer and its own
+            fetch threads. The categories are split between the workers.
+
+            The keys of the products are claimed in a registry shared by the
+            workers, so a product returned in the categories of two workers
+            is written once.
+
+            Returns the stats of the import, summed over the workers. The
+            latency of the requests of the workers is added to the metrics of
+            this process.
+        """
+        partitions = partition(categories, options["workers"])
+        stats = dict.fromkeys(
+            ["fetched", "inserted", "updated", "skipped", "rows", "write_seconds"], 0
+        )
+        if not partitions:
+            # every category of the resumed run is imported
+            return stats
+
+        worker_options = dict(
+            options,
+            # the requests to Open Food Facts are shared between the workers
+            concurrency=max(1, options["concurrency"] // len(partitions)),
+        )
 
-                # set the image_url of the product
-                if ("image_url" in product):
-                    if Product.objects.filter(image_url__iexact=product["image_url"]):
-                        continue                
-                    new_product.image_url = product["image_url"]
+        with ImportManager() as manager:
+            claims = manager.ClaimRegistry()
+            records = manager.Queue()
+            with collect_worker_logs(records), worker_pool(len(partitions)) as pool:
+                futures = [
+                    pool.submit(
+                        import_worker,
+                        worker,
+                        self.run.pk,
+                        worker_categories,
+                        worker_options,
+                        claims,
+                        records,
+                    )
+                    for worker, worker_categories in enumerate(partitions)
+                ]
+                for future in futures:
+                    worker_stats = future.result()
+                    metrics.off_request_duration.merge(
+                        worker_stats.pop("off_request_duration")
+                    )
+                    for key, value in worker_stats.items():
+                        stats[key] += value
 
-                # set the name of the product
-                if "product_name" in product:
-                    if (
-                        product["product_name"] is not None
-                        and product["product_name"] is not ""
+        return stats
+
+
+    def save_checkpoint(self):
+        """Save where the import of the current category is, called in the
+        transaction of every batch of products"""
+        if self.checkpoint is None:
+            return
+        self.checkpoint.save(
+            update_fields=[
+                "page",
+                "last_code",
+                "products",
+                "last_modified_t",
+                "finished",
+                "updated_at",
+            ]
+        )
+
+
+    def write_metrics(self, stats: dict, elapsed: float):
+        """Write the stats of the import in METRICS_IMPORT_FILE, with the
+        latency of the requests to Open Food Facts, for the metrics view"""
+        for result in ["fetched", "inserted", "updated", "skipped"]:
+            metrics.import_products.set(stats[result], result=result)
+        metrics.import_duration.set(elapsed)
+        metrics.import_write_duration.set(stats["write_seconds"])
+        metrics.import_last_success.set(time.time())
+        metrics.import_registry.write(settings.METRICS_IMPORT_FILE)
+
+
+    def get_products_for_category(self, product_category: str, products):
+        """
+            Insert the new products of a category and update the changed ones
+            in the database in bulk, in one transaction per batch of products
+            with the checkpoint of the category. The last modification
+            imported is saved for the next delta sync, with the finished
+            checkpoint.
+
+            If Open Food Facts fails in the middle of the category, the
+            products read are committed but the checkpoint is not finished,
+            --resume continues the category after the last one. A rebuild is
+            aborted, its staging tables are dropped.
+
+            Parameters:
+                - product_category (str): the name of the category of the products
+                - products (iterable): the products of the category, as returned
+                  by open food fact api, with their page
+
+            Returns the number of products of the category.
+        """
+
+        last_modified = self.last_modified.get(product_category)
+        # None for the rebuilds
+        checkpoint = self.checkpoint = self.checkpoints.get(product_category)
+        if checkpoint is not None and checkpoint.last_modified_t is not None:
+            last_modified = max(last_modified or 0, checkpoint.last_modified_t)
+
+        start = time.perf_counter()
+        fetched = 0
+        inserted = self.importer.inserted_products
+        updated = self.importer.updated_products
+        skipped = self.importer.skipped_products
+        log_products = self.logger.isEnabledFor(logging.DEBUG)
+        error = None
+
+        try:
+            for page, product in products:
+                fetched += 1
+                if checkpoint is not None:
+                    if page != checkpoint.page and not (
+                        self.importer.pending or self.importer.pending_updates
                     ):
-                        new_product.name = product["product_name"]
-                    else:
-                        if (
-                            product["product_name_fr"] is not None
-                            and product["product_name_fr"] is not ""
-                        ):
-                            new_product.name = product["product_name_fr"]
-                        else:
-                            continue
-                else:
-                    continue
-
-                # check if product exist in database
-                if Product.objects.filter(name__iexact=new_product.name):
-                    continue
-
-                # set the nutrition score of the product
-                if "nutrition_grades_tags" in product:
-                    if product["nutrition_grades_tags"][0].lower() not in [
-                        "a",
-                        "b",
-                        "c",
-                        "d",
-                        "e",
-                    ]:
-                        new_product.nutri_score = "e"
-                    else:
-                        new_product.nutri_score = product["nutrition_grades_tags"][
-                            0
-                        ].lower()
-
-                new_product.save()
-
-                print("Adding new product to database :", new_product.name)
-
-                # create the relations product-category
-                if len(product["categories_tags"]) > 0:
-                    for category in product["categories_tags"]:
-                        # parsing of the category tag
-                        new_category = category.replace("en:", "")
-                        new_category = new_category.replace("fr:", "")
-
-                        if Category.objects.filter(name=new_category):
-                            new_product.categories.add(Category.objects.get(name=new_category))
-                        else:
-                            continue
-                else:
-                    continue
-
-                # create the relations product-nutriment for every nutriments specified in settings
-                for nutriment in Nutriment.objects.all():
-
-                    if nutriment.name + "_100g" in product["nutriments"]:
-                        if product["nutriments"][nutriment.name + "_100g"] is not "":
-                            new_product.nutriments.add(
-                                nutriment,
-                                through_defaults={
-                                    "quantity": product["nutriments"][nutriment.name + "_100g"]
-                                },
+                        # the products of the previous page are all committed
+                        self.save_checkpoint()
+                    checkpoint.page = page
+                    checkpoint.last_code = str(product.get("code") or "")
+                    checkpoint.products += 1
+
+                new_product = self.importer.add(product)
+
+                if new_product is not None:
+                    if log_products:
+                        if new_product.get("id") is None:
+                            self.logger.debug(
+                                "Adding new product to database : %s",
+                                new_product["name"],
                             )
                         else:
-                            new_product.nutriments.add(nutriment)
-                    else:
-                        new_product.nutriments.add(nutriment)
+                            self.logger.debug(
+                                "Updating product : %s", new_product["name"]
+                            )
 
+                # the unchanged products skipped by the importer count too,
+                # they are not read again by the next delta sync
+                try:
+                    product_modified = int(product["last_modified_t"])
+                except (KeyError, TypeError, ValueError):
+                    product_modified = None
+                if product_modified is not None:
+                    last_modified = max(last_modified or 0, product_modified)
+                    if checkpoint is not None:
+                        checkpoint.last_modified_t = last_modified
+        except OpenFoodFactsError as exception:
+            if checkpoint is None:
+                # the swap of the rebuild would delete the products not
+                # fetched, with the products saved by the users
+                raise CommandError(
+                    "Open Food Facts failed for the category {}, "
+                    "the catalog is kept - {}".format(product_category, exception)
+                ) from exception
+            error = exception
 
-    def openfoodfacts_api_get_product(self, category: str, number_of_products: int, user_agent):
-        request = requests.get(
-            "https://fr-en.openfoodfacts.org/cgi/search.pl?search_terms="
-            + category
-            + "&page_size="
-            + str(number_of_products)
-            + "&action=process&json=1",
-            headers={"items": user_agent},
+        with transaction.atomic():
+            self.importer.flush()
+
+            # only once the category is read to the end : the products are
+            # read the last modified first, the ones not read yet would be
+            # older than the last modification imported
+            if error is None:
+                # written without reading it first, the categories of the
+                # other workers are written at the same time
+                sync = {"last_sync": timezone.now(), "last_modified_t": last_modified}
+                category_id = self.importer.categories[product_category]
+                if not CategorySync.objects.filter(category_id=category_id).update(
+                    **sync
+                ):
+                    CategorySync.objects.create(category_id=category_id, **sync)
+
+            if checkpoint is not None:
+                checkpoint.finished = error is None
+                self.save_checkpoint()
+        self.checkpoint = None
+
+        if error is not None:
+            self.failed_categories.append(product_category)
+            self.logger.warning(
+                "Category %s : Open Food Facts failed after %d products, "
+                "the category is not finished - %s",
+                product_category,
+                fetched,
+                error,
+                extra={
+                    "event": "category_failed",
+                    "stats": {"category": product_category, "fetched": fetched},
+                },
+            )
+
+        self.fetched_products += fetched
+        stats = {
+            "category": product_category,
+            "fetched": fetched,
+            "inserted": self.importer.inserted_products - inserted,
+            "updated": self.importer.updated_products - updated,
+            "skipped": self.importer.skipped_products - skipped,
+            "seconds": round(time.perf_counter() - start, 3),
+        }
+        self.logger.info(
+            "Category %(category)s : %(fetched)d products, %(inserted)d inserted, "
+            "%(updated)d updated, %(skipped)d skipped in %(seconds).2fs",
+            stats,
+            extra={"event": "category", "stats": stats},
         )
+        return fetched
+
 
-        if (request.status_code == 200):
-            return json.loads(request.text)
+    def iter_category_products(self, product_category: str):
+        """
+            Iterate over the products of a category with the number of their
+            page, called from the fetch threads.
+
+            Once a category has been synced, only the products modified since
+            the last sync are requested, the last modified first, all of them :
+            the next sync starts from the last modification imported, the
+            products skipped by a maximum number of products would be lost. A resumed
+            import starts at the page of the checkpoint of the category, after
+            its last committed product.
+        """
+        last_modified = self.last_modified.get(product_category)
+        first_page, last_code = self.resume_points.get(product_category, (1, ""))
+
+        products = self.client.iter_products(
+            product_category,
+            self.max_products if last_modified is None else None,
+            self.page_size,
+            open_page=self.get_products_page,
+            on_page=self.log_page,
+            sort_by=None if last_modified is None else "last_modified_t",
+            first_page=first_page,
+        )
+        if last_modified is not None:
+            products = takewhile(
+                lambda product: int(product.get("last_modified_t") or 0) > last_modified,
+                products,
+            )
+
+        # only the last page is not full
+        products = (
+            (first_page + index // self.page_size, product)
+            for index, product in enumerate(products)
+        )
+        if last_code:
+            products = self.skip_committed_products(products, last_code)
+        return products
+
+
+    def skip_committed_products(self, products, last_code: str):
+        """
+            Skip the products of the first page up to the last committed one,
+            found by its code.
+
+            If the page changed on Open Food Facts since and the product is not
+            in it anymore, the whole page is read again, the unchanged products
+            are skipped by the importer.
+        """
+        first_page = list(islice(products, self.page_size))
+        codes = [str(product.get("code") or "") for page, product in first_page]
+        if last_code in codes:
+            del first_page[: codes.index(last_code) + 1]
+        yield from first_page
+        yield from products
+
+
+    def get_products_page(self, category: str, page_size: int, page: int, sort_by=None):
+        """Get the products of a page of a category"""
+        return self.openfoodfacts_api_get_product(category, page_size, settings.USER_AGENT_OFF, page, sort_by)
+
+
+    def log_page(self, category: str, page: int, count: int, total: int):
+        """Log the progress and the memory peak of the process after every page"""
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+
+        if resource is not None:
+            # kilobytes on Linux
+            memory_peak = "{:.1f} MB".format(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            )
         else:
-            return None
+            memory_peak = "unknown"
+
+        self.logger.debug(
+            "Category %s - page %d : %d products (%d in total) - memory peak %s",
+            category,
+            page,
+            count,
+            total,
+            memory_peak,
+            extra={
+                "event": "page",
+                "stats": {
+                    "category": category,
+                    "page": page,
+                    "products": count,
+                    "total": total,
+                    "memory_peak": memory_peak,
+                },
+            },
+        )
+
+
+    def openfoodfacts_api_get_product(self, category: str, number_of_products: int, user_agent, page: int = 1, sort_by=None):
+        """Streamed request of a page of products, see OpenFoodFactsClient.open_page"""
+        return self.client.open_page(category, number_of_products, page, sort_by)
+
+
+def import_worker(worker: int, run_id: int, categories, options, claims, records):
+    """
+        Import the products of some categories in a worker process of
+        database_update --workers.
+
+        Parameters:
+            - worker (int): the number of the worker
+            - run_id (int): the id of the ImportRun, with the checkpoints
+            - categories (list): the names of the categories of the worker
+            - options (dict): the options of the command
+            - claims (ClaimRegistry): the registry shared by the workers
+            - records (queue): the queue of the logs, shared with the command
+
+        Returns the stats of the import of the worker, with the series of the
+        latency of its requests to Open Food Facts.
+    """
+    # a process of the pool can run the categories of two workers
+    metrics.off_request_duration.clear()
+    command = Command()
+    with worker_logging(records, options["verbosity"]) as command.logger:
+        command.run = ImportRun.objects.get(pk=run_id)
+        command.load_run_state()
+        command.import_categories(
+            categories, options, claim=partial(claims.claim, worker)
+        )
+        return dict(
+            command.import_stats(),
+            off_request_duration=metrics.off_request_duration.dump(),
+        )
@@ -0,0 +1,388 @@
+import copy
+import glob
+import json
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.http import HttpResponse
+
+
+def format_value(value: float):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                name,
+                str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+            )
+            for name, value in zip(names, values)
+        )
+    )
+
+
+def replace_file(path: str, content: str):
+    """Write a file replaced at once, so the readers never read half a file"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary_path, "w") as metrics_file:
+        metrics_file.write(content)
+    os.replace(temporary_path, path)
+
+
+class Metric:
+    """
+        Base of the metrics, every combination of label values has its own
+        series. The metrics are kept in the memory of the process, the
+        registry saves them for the other processes.
+
+        Parameters:
+            - name (str): the name of the metric
+            - documentation (str): the help text of the metric
+            - labels (list): the names of the labels
+    """
+
+    type_name = None
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.series = {}
+        self.registry = None
+
+    def label_values(self, labels: dict):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.type_name),
+        ]
+        with self.lock:
+            for values, value in sorted(self.series.items()):
+                lines.extend(self.render_series(values, value))
+        return lines
+
+    def render_series(self, values, value):
+        return [
+            "{}{} {}".format(
+                self.name, format_labels(self.label_names, values), format_value(value)
+            )
+        ]
+
+    def clear(self):
+        with self.lock:
+            self.series.clear()
+
+    def changed(self):
+        if self.registry is not None:
+            self.registry.changed()
+
+    def empty(self):
+        """Return a copy of the metric without series"""
+        metric = copy.copy(self)
+        metric.lock = threading.Lock()
+        metric.series = {}
+        metric.registry = None
+        return metric
+
+    def dump(self):
+        """Return the series as a list of [label values, value], in JSON"""
+        with self.lock:
+            return [[list(values), value] for values, value in self.series.items()]
+
+    def merge(self, series):
+        """Add the series dumped by another process"""
+        with self.lock:
+            for values, value in series:
+                values = tuple(values)
+                self.series[values] = self.merge_value(self.series.get(values), value)
+
+    def merge_value(self, current, value):
+        return value
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        values = self.label_values(labels)
+        with self.lock:
+            self.series[values] = self.series.get(values, 0) + amount
+        self.changed()
+
+    def merge_value(self, current, value):
+        return (current or 0) + value
+
+    def value(self, **labels):
+        return self.series.get(self.label_values(labels), 0)
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.series[self.label_values(labels)] = value
+        self.changed()
+
+    def value(self, **labels):
+        return self.series.get(self.label_values(labels))
+
+
+class Histogram(Metric):
+    """Cumulative histogram of observed values, with their sum and count"""
+
+    type_name = "histogram"
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=None):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets or self.default_buckets) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        values = self.label_values(labels)
+        with self.lock:
+            series = self.series.setdefault(
+                values, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            )
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+        self.changed()
+
+    def merge_value(self, current, value):
+        if current is None:
+            return copy.deepcopy(value)
+        current["buckets"] = [
+            count + other for count, other in zip(current["buckets"], value["buckets"])
+        ]
+        current["sum"] += value["sum"]
+        current["count"] += value["count"]
+        return current
+
+    def count(self, **labels):
+        series = self.series.get(self.label_values(labels))
+        return series["count"] if series else 0
+
+    def render_series(self, values, series):
+        lines = []
+        for bound, count in zip(self.buckets, series["buckets"]):
+            lines.append(
+                "{}_bucket{} {}".format(
+                    self.name,
+                    format_labels(
+                        self.label_names + ("le",), values + (format_value(bound),)
+                    ),
+                    count,
+                )
+            )
+        labels = format_labels(self.label_names, values)
+        lines.append("{}_sum{} {}".format(self.name, labels, format_value(series["sum"])))
+        lines.append("{}_count{} {}".format(self.name, labels, series["count"]))
+        return lines
+
+
+class Registry:
+    """
+        Set of metrics rendered together in the Prometheus text format.
+
+        The registry of the web processes is shared : every process saves its
+        metrics in its own file of METRICS_DIRECTORY, at most every
+        METRICS_SAVE_INTERVAL seconds, and the metrics view renders the sum
+        of the files of every process.
+
+        Parameters:
+            - shared (bool): save the metrics for the other processes
+    """
+
+    def __init__(self, shared: bool = False):
+        self.metrics = []
+        self.shared = shared
+        self.saved_at = None
+        self.process = None
+        self.lock = threading.Lock()
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+        metric.registry = self
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+    def write(self, path: str):
+        """Write the metrics in a file read by the metrics view"""
+        replace_file(path, self.render())
+
+    def dump(self):
+        return {metric.name: metric.dump() for metric in self.metrics}
+
+    def merge(self, dump: dict):
+        for metric in self.metrics:
+            metric.merge(dump.get(metric.name, []))
+
+    def process_file(self):
+        """Return the file of the process, named after its pid and its first
+        save, so a new process never takes the file of a stopped one"""
+        pid = os.getpid()
+        if self.process is None or self.process[0] != pid:
+            self.process = (pid, "{}-{}.json".format(pid, time.time_ns()))
+        return os.path.join(settings.METRICS_DIRECTORY, self.process[1])
+
+    def changed(self):
+        if not self.shared:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if (
+                self.saved_at is not None
+                and now - self.saved_at < settings.METRICS_SAVE_INTERVAL
+            ):
+                return
+            self.saved_at = now
+        self.save()
+
+    def save(self):
+        """Save the metrics of the process in its file of METRICS_DIRECTORY"""
+        replace_file(self.process_file(), json.dumps(self.dump()))
+
+    def render_processes(self):
+        """Render the sum of the metrics saved by every process, the files of
+        the stopped processes included so the counters never decrease"""
+        self.save()
+        total = Registry()
+        for metric in self.metrics:
+            total.register(metric.empty())
+        for path in glob.glob(os.path.join(settings.METRICS_DIRECTORY, "*.json")):
+            try:
+                with open(path) as metrics_file:
+                    total.merge(json.load(metrics_file))
+            except (OSError, ValueError):
+                continue
+        return total.render()
+
+
+# Metrics of the web processes
+registry = Registry(shared=True)
+
+search_duration = registry.register(
+    Histogram(
+        "purebeurre_search_duration_seconds",
+        "Duration of the product searches, cache included",
+    )
+)
+cache_requests = registry.register(
+    Counter(
+        "purebeurre_cache_requests_total",
+        "Lookups in the cache, per cache and result (hit or miss)",
+        ["cache", "result"],
+    )
+)
+favorite_toggles = registry.register(
+    Counter(
+        "purebeurre_favorite_toggles_total",
+        "Products saved or unsaved by the users",
+        ["action"],
+    )
+)
+
+# Metrics of database_update, written in METRICS_IMPORT_FILE at the end of
+# the command since it runs in its own process
+import_registry = Registry()
+
+import_products = import_registry.register(
+    Gauge(
+        "purebeurre_import_products",
+        "Products of the last database_update, per result "
+        "(fetched, inserted, updated, skipped)",
+        ["result"],
+    )
+)
+import_duration = import_registry.register(
+    Gauge(
+        "purebeurre_import_duration_seconds",
+        "Duration of the last database_update",
+    )
+)
+import_write_duration = import_registry.register(
+    Gauge(
+        "purebeurre_import_db_write_seconds",
+        "Time spent writing the products in the database by the last database_update",
+    )
+)
+import_last_success = import_registry.register(
+    Gauge(
+        "purebeurre_import_last_success_timestamp_seconds",
+        "End of the last successful database_update, as a unix timestamp",
+    )
+)
+off_request_duration = import_registry.register(
+    Histogram(
+        "purebeurre_off_request_duration_seconds",
+        "Time to the response headers of the requests to Open Food Facts",
+        ["status"],
+        buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    )
+)
+
+
+def record_cache_lookup(cache_name: str, hit: bool):
+    cache_requests.inc(cache=cache_name, result="hit" if hit else "miss")
+
+
+def metrics_allowed(request):
+    """Return True when the request sends METRICS_TOKEN as a bearer token,
+    comes from a staff user or from an address of METRICS_ALLOWED_IPS"""
+    if settings.METRICS_TOKEN and request.META.get(
+        "HTTP_AUTHORIZATION"
+    ) == "Bearer {}".format(settings.METRICS_TOKEN):
+        return True
+    user = getattr(request, "user", None)
+    if user is not None and user.is_staff:
+        return True
+    return request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS
+
+
+def metrics_view(request):
+    """
+        Return the metrics of the web processes and the metrics of the last
+        database_update, in the Prometheus text format.
+
+        Only the staff users and the addresses of METRICS_ALLOWED_IPS can read
+        them, or the requests sending METRICS_TOKEN in an
+        "Authorization: Bearer <token>" header when it is set.
+    """
+    if not metrics_allowed(request):
+        return HttpResponse(status=401 if settings.METRICS_TOKEN else 403)
+
+    content = registry.render_processes()
+    try:
+        with open(settings.METRICS_IMPORT_FILE) as metrics_file:
+            content += metrics_file.read()
+    except FileNotFoundError:
+        pass
+
+    return HttpResponse(content, content_type="text/plain; version=0.0.4")
@@ -0,0 +1,70 @@
+# Generated by Django 3.1 on 2026-10-18 09:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0003_auto_20200525_1250"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="product",
+            name="content_hash",
+            field=models.CharField(
+                blank=True,
+                default="",
+                max_length=40,
+                verbose_name="Empreinte des données importées",
+            ),
+        ),
+        migrations.AddField(
+            model_name="product",
+            name="last_modified_t",
+            field=models.IntegerField(
+                blank=True,
+                null=True,
+                verbose_name="Dernière modification sur OpenFoodFact",
+            ),
+        ),
+        migrations.CreateModel(
+            name="CategorySync",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "last_sync",
+                    models.DateTimeField(verbose_name="Dernière synchronisation"),
+                ),
+                (
+                    "last_modified_t",
+                    models.IntegerField(
+                        blank=True,
+                        null=True,
+                        verbose_name="Dernière modification importée",
+                    ),
+                ),
+                (
+                    "category",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="products.category",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Synchronisation catégorie",
+                "verbose_name_plural": "Synchronisations catégories",
+            },
+        ),
+    ]
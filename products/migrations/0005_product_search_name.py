@@ -0,0 +1,52 @@
+# Generated by Django 3.1 on 2026-10-18 09:58
+
+from django.db import migrations, models
+
+
+def fill_search_name(apps, schema_editor):
+    from products.search import normalize_search_text
+
+    Product = apps.get_model("products", "Product")
+    products = list(Product.objects.only("id", "name"))
+    for product in products:
+        product.search_name = normalize_search_text(product.name)
+    Product.objects.bulk_update(products, ["search_name"], batch_size=500)
+
+
+def create_trigram_index(apps, schema_editor):
+    # the in-memory index of products.search is used by the other databases
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    schema_editor.execute(
+        "CREATE INDEX products_product_search_name_trgm "
+        "ON products_product USING gin (search_name gin_trgm_ops)"
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS products_product_search_name_trgm")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0004_category_sync"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="product",
+            name="search_name",
+            field=models.CharField(
+                blank=True,
+                default="",
+                max_length=255,
+                verbose_name="Nom pour la recherche",
+            ),
+        ),
+        migrations.RunPython(fill_search_name, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
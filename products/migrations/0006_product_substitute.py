@@ -0,0 +1,55 @@
+# Generated by Django 3.1 on 2026-10-18 10:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0005_product_search_name"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProductSubstitute",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("rank", models.PositiveSmallIntegerField(verbose_name="Rang")),
+                (
+                    "product",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="substitutes",
+                        to="products.product",
+                    ),
+                ),
+                (
+                    "substitute",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="substitute_of",
+                        to="products.product",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Substitut produit",
+                "verbose_name_plural": "Substituts produits",
+            },
+        ),
+        migrations.AddIndex(
+            model_name="productsubstitute",
+            index=models.Index(
+                fields=["product", "rank"], name="products_pr_product_4d064a_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 3.1 on 2026-10-18 10:13
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def remove_duplicates(apps, schema_editor):
+    """Keep the first row of every duplicated relation, before the unique
+    constraints are added"""
+    for model_name, fields in [
+        ("ProductCategories", ["product", "category"]),
+        ("ProductNutriments", ["product", "nutriment"]),
+        ("ProductUsers", ["user", "product"]),
+    ]:
+        model = apps.get_model("products", model_name)
+        first_ids = model.objects.values(*fields).annotate(Min("id")).values("id__min")
+        model.objects.exclude(id__in=first_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0006_product_substitute"),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                fields=["nutri_score"], name="products_pr_nutri_s_c94bf3_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="productcategories",
+            constraint=models.UniqueConstraint(
+                fields=("product", "category"), name="unique_product_category"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="productnutriments",
+            constraint=models.UniqueConstraint(
+                fields=("product", "nutriment"), name="unique_product_nutriment"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="productusers",
+            constraint=models.UniqueConstraint(
+                fields=("user", "product"), name="unique_user_product"
+            ),
+        ),
+    ]
@@ -0,0 +1,130 @@
+# Generated by Django 3.1 on 2026-10-18 10:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0007_through_tables_constraints"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImportRun",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "started_at",
+                    models.DateTimeField(auto_now_add=True, verbose_name="Début"),
+                ),
+                (
+                    "finished_at",
+                    models.DateTimeField(blank=True, null=True, verbose_name="Fin"),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("running", "En cours"),
+                            ("failed", "Échoué"),
+                            ("finished", "Terminé"),
+                        ],
+                        default="running",
+                        max_length=8,
+                        verbose_name="Statut",
+                    ),
+                ),
+                (
+                    "full",
+                    models.BooleanField(
+                        default=False, verbose_name="Synchronisation complète"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Import",
+                "verbose_name_plural": "Imports",
+            },
+        ),
+        migrations.CreateModel(
+            name="ImportCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("page", models.PositiveIntegerField(default=1, verbose_name="Page")),
+                (
+                    "last_code",
+                    models.CharField(
+                        blank=True,
+                        default="",
+                        max_length=64,
+                        verbose_name="Code du dernier produit traité",
+                    ),
+                ),
+                (
+                    "products",
+                    models.PositiveIntegerField(
+                        default=0, verbose_name="Produits traités"
+                    ),
+                ),
+                (
+                    "last_modified_t",
+                    models.IntegerField(
+                        blank=True,
+                        null=True,
+                        verbose_name="Dernière modification importée",
+                    ),
+                ),
+                (
+                    "finished",
+                    models.BooleanField(default=False, verbose_name="Terminée"),
+                ),
+                (
+                    "updated_at",
+                    models.DateTimeField(auto_now=True, verbose_name="Mise à jour"),
+                ),
+                (
+                    "category",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="products.category",
+                    ),
+                ),
+                (
+                    "run",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="checkpoints",
+                        to="products.importrun",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Point de reprise",
+                "verbose_name_plural": "Points de reprise",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="importcheckpoint",
+            constraint=models.UniqueConstraint(
+                fields=("run", "category"), name="unique_run_category"
+            ),
+        ),
+    ]
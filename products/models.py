@@ -31,7 +31,16 @@ class Product(models.Model):
     image_url = models.URLField(
         "Url de l'image", max_length=255, unique=True, null=True
     )
+    search_name = models.CharField(
+        "Nom pour la recherche", max_length=255, blank=True, default=""
+    )
     nutri_score = models.CharField("Score nutritionnel", max_length=1)
+    content_hash = models.CharField(
+        "Empreinte des données importées", max_length=40, blank=True, default=""
+    )
+    last_modified_t = models.IntegerField(
+        "Dernière modification sur OpenFoodFact", null=True, blank=True
+    )
     nutriments = models.ManyToManyField(
         "products.Nutriment", through="products.ProductNutriments"
     )
@@ -43,22 +52,130 @@ class Product(models.Model):
     class Meta:
         verbose_name = "Produit"
         verbose_name_plural = "Produits"
+        # the substitutes are ordered by nutrition score
+        indexes = [models.Index(fields=["nutri_score"])]
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        """Keep the normalized name used by the search up to date"""
+        from products.search import normalize_search_text
+
+        self.search_name = normalize_search_text(self.name)
+        super().save(*args, **kwargs)
+
+
+class CategorySync(models.Model):
+    category = models.OneToOneField("products.Category", on_delete=models.CASCADE)
+    last_sync = models.DateTimeField("Dernière synchronisation")
+    last_modified_t = models.IntegerField(
+        "Dernière modification importée", null=True, blank=True
+    )
+
+    class Meta:
+        verbose_name = "Synchronisation catégorie"
+        verbose_name_plural = "Synchronisations catégories"
+
+    def __str__(self):
+        return self.category.name
+
 
 class ProductNutriments(models.Model):
     product = models.ForeignKey("products.Product", on_delete=models.CASCADE)
     nutriment = models.ForeignKey("products.Nutriment", on_delete=models.CASCADE)
     quantity = models.FloatField("Quantité", null=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["product", "nutriment"], name="unique_product_nutriment"
+            )
+        ]
+
 
 class ProductCategories(models.Model):
     product = models.ForeignKey("products.Product", on_delete=models.CASCADE)
     category = models.ForeignKey("products.Category", on_delete=models.CASCADE)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["product", "category"], name="unique_product_category"
+            )
+        ]
+
 
 class ProductUsers(models.Model):
     product = models.ForeignKey("products.Product", on_delete=models.CASCADE)
     user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
+
+    class Meta:
+        # the saved products are read per user
+        constraints = [
+            models.UniqueConstraint(fields=["user", "product"], name="unique_user_product")
+        ]
+
+
+class ProductSubstitute(models.Model):
+    product = models.ForeignKey(
+        "products.Product", on_delete=models.CASCADE, related_name="substitutes"
+    )
+    substitute = models.ForeignKey(
+        "products.Product", on_delete=models.CASCADE, related_name="substitute_of"
+    )
+    rank = models.PositiveSmallIntegerField("Rang")
+
+    class Meta:
+        verbose_name = "Substitut produit"
+        verbose_name_plural = "Substituts produits"
+        indexes = [models.Index(fields=["product", "rank"])]
+
+
+class ImportRun(models.Model):
+    RUNNING = "running"
+    FAILED = "failed"
+    FINISHED = "finished"
+    STATUSES = [(RUNNING, "En cours"), (FAILED, "Échoué"), (FINISHED, "Terminé")]
+
+    started_at = models.DateTimeField("Début", auto_now_add=True)
+    finished_at = models.DateTimeField("Fin", null=True, blank=True)
+    status = models.CharField("Statut", max_length=8, choices=STATUSES, default=RUNNING)
+    full = models.BooleanField("Synchronisation complète", default=False)
+
+    class Meta:
+        verbose_name = "Import"
+        verbose_name_plural = "Imports"
+
+    def __str__(self):
+        return "{} - {}".format(self.started_at, self.get_status_display())
+
+
+class ImportCheckpoint(models.Model):
+    run = models.ForeignKey(
+        "products.ImportRun", on_delete=models.CASCADE, related_name="checkpoints"
+    )
+    category = models.ForeignKey("products.Category", on_delete=models.CASCADE)
+    # the page of the last product committed, and its Open Food Facts code
+    page = models.PositiveIntegerField("Page", default=1)
+    last_code = models.CharField(
+        "Code du dernier produit traité", max_length=64, blank=True, default=""
+    )
+    products = models.PositiveIntegerField("Produits traités", default=0)
+    last_modified_t = models.IntegerField(
+        "Dernière modification importée", null=True, blank=True
+    )
+    finished = models.BooleanField("Terminée", default=False)
+    updated_at = models.DateTimeField("Mise à jour", auto_now=True)
+
+    class Meta:
+        verbose_name = "Point de reprise"
+        verbose_name_plural = "Points de reprise"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["run", "category"], name="unique_run_category"
+            )
+        ]
+
+    def __str__(self):
+        return "{} - page {}".format(self.category, self.page)
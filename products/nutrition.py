@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from products.cache import get_catalog_version
+from products.metrics import record_cache_lookup
+from products.models import ProductNutriments
+
+
+def nutrition_cache_key(product_id: int):
+    """Return the cache key of the nutriments of a product, in the version of
+    the catalog bumped by the imports in every process"""
+    return "products:nutrition:{}:{}".format(get_catalog_version(), product_id)
+
+
+def get_nutrition_table(product_id: int):
+    """
+        Return the nutriments of a product as a list of dicts with the name,
+        the unit and the quantity of every nutriment.
+
+        The table is read in one query on ProductNutriments and cached per
+        product, until the next import.
+    """
+    key = nutrition_cache_key(product_id)
+    nutrition_table = cache.get(key)
+    record_cache_lookup("nutrition", nutrition_table is not None)
+
+    if nutrition_table is None:
+        nutrition_table = [
+            {
+                "name": settings.NUTRIMENTS[product_nutriment.nutriment.name]["name"],
+                "unit": product_nutriment.nutriment.unit,
+                "quantity": product_nutriment.quantity,
+            }
+            for product_nutriment in ProductNutriments.objects.filter(
+                product_id=product_id
+            )
+            .select_related("nutriment")
+            .order_by("id")
+        ]
+        cache.set(key, nutrition_table, settings.NUTRITION_CACHE_TIMEOUT)
+
+    return nutrition_table
+
@@ -0,0 +1,416 @@
+from concurrent.futures import ThreadPoolExecutor
+import codecs
+import json
+import queue
+import threading
+import time
+
+from django.conf import settings
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from products.metrics import off_request_duration
+
+
+# Sent by the producer threads once a category is exhausted
+END_OF_CATEGORY = object()
+
+
+class OpenFoodFactsError(Exception):
+    """A page of products failed or was cut off, the category is incomplete"""
+
+
+def iter_json_array(chunks, key: str):
+    """
+        Incremental parser yielding the items of an array of a JSON document.
+
+        Only the item being parsed is kept in memory, so the document can be
+        bigger than the available memory.
+
+        Parameters:
+            - chunks (iterable): the text of the JSON document, chunk by chunk
+            - key (str): the key of the array, in the top-level object
+
+        Yields every item of the array, decoded. Raises ValueError if the
+        document ends before the end of the array.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    marker = '"{}"'.format(key)
+    buffer = ""
+
+    # skip everything before the opening bracket of the array
+    while True:
+        index = buffer.find(marker)
+        if index != -1:
+            bracket = buffer.find("[", index + len(marker))
+            if bracket != -1:
+                buffer = buffer[bracket + 1 :]
+                break
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError("No array {} in the document".format(marker))
+        buffer += chunk
+
+    position = 0
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+
+        if position < len(buffer) and buffer[position] == "]":
+            return
+
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            # the item is not complete yet
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError(
+                    "The document ended before the end of the array {}".format(marker)
+                )
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+
+        yield item
+
+
+def close_page(future):
+    """Close the response of a page requested in advance but never read"""
+    if not future.cancelled() and future.exception() is None:
+        products = future.result()
+        if products is not None and hasattr(products, "close"):
+            products.close()
+
+
+def iter_text(response, chunk_size: int):
+    """Decode the body of a streamed response chunk by chunk"""
+    decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(
+        errors="replace"
+    )
+    for chunk in response.iter_content(chunk_size):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+class StreamedPage:
+    """
+        Iterator decoding the products of a streamed response, closed at the
+        end of the page or by close() if the page is not read to the end.
+
+        Raises OpenFoodFactsError if the connection is lost or the body is
+        cut off before the end of the page.
+    """
+
+    def __init__(self, response, chunk_size: int):
+        self.response = response
+        self.products = self.decode(chunk_size)
+
+    def decode(self, chunk_size: int):
+        with self.response:
+            try:
+                yield from iter_json_array(
+                    iter_text(self.response, chunk_size), "products"
+                )
+            except (requests.RequestException, ValueError) as error:
+                raise OpenFoodFactsError(
+                    "Page {} cut off : {}".format(self.response.url, error)
+                ) from error
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.products)
+
+    def close(self):
+        self.products.close()
+        self.response.close()
+
+
+class OpenFoodFactsClient:
+    """
+        HTTP client for the Open Food Facts search API.
+
+        A single requests session is shared by every request so the connections
+        are kept alive and reused. Failed requests (connection errors and 5xx
+        responses) are retried with an exponential backoff. Every category
+        fetched at once streams a page while the next one is requested, the
+        pool keeps two connections per category.
+
+        Parameters:
+            - base_url (str): url of the search API, OFF_SEARCH_URL by default
+            - user_agent (str): user agent sent to the API, USER_AGENT_OFF by default
+            - concurrency (int): maximum number of categories fetched at once
+            - timeout (float): timeout in seconds of every request
+            - retries (int): number of retries of a failed request
+            - backoff_factor (float): backoff factor between two retries
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(
+        self,
+        base_url: str = None,
+        user_agent: str = None,
+        concurrency: int = None,
+        timeout: float = None,
+        retries: int = None,
+        backoff_factor: float = None,
+    ):
+        self.base_url = base_url or settings.OFF_SEARCH_URL
+        self.user_agent = user_agent or settings.USER_AGENT_OFF
+        self.concurrency = concurrency or settings.OFF_CONCURRENCY
+        self.timeout = timeout if timeout is not None else settings.OFF_TIMEOUT
+        retries = retries if retries is not None else settings.OFF_RETRIES
+        backoff_factor = (
+            backoff_factor
+            if backoff_factor is not None
+            else settings.OFF_BACKOFF_FACTOR
+        )
+
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.concurrency * 2,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff_factor,
+                status_forcelist=[500, 502, 503, 504],
+                raise_on_status=False,
+            ),
+        )
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = self.user_agent
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def request_page(
+        self, category: str, page_size: int, page: int, stream: bool, sort_by=None
+    ):
+        """Send the GET request of a page, return the response or None if it failed"""
+        params = {
+            "search_terms": category,
+            "page_size": page_size,
+            "page": page,
+            "action": "process",
+            "json": 1,
+        }
+        if sort_by is not None:
+            params["sort_by"] = sort_by
+
+        start = time.perf_counter()
+        try:
+            response = self.session.get(
+                self.base_url,
+                params=params,
+                timeout=self.timeout,
+                stream=stream,
+            )
+        except requests.RequestException:
+            off_request_duration.observe(time.perf_counter() - start, status="error")
+            return None
+
+        # with the retries, until the headers of the last response
+        off_request_duration.observe(
+            time.perf_counter() - start, status=response.status_code
+        )
+
+        if response.status_code != 200:
+            response.close()
+            return None
+
+        return response
+
+    def search(self, category: str, page_size: int, page: int = 1):
+        """
+            GET request to the search API for one page of products in a category.
+
+            Parameters:
+                - category (str): the name of the category of products to get
+                - page_size (int): the number of products per page
+                - page (int): the number of the page to get, starting at 1
+
+            Returns the decoded JSON response, None if the request failed.
+        """
+        response = self.request_page(category, page_size, page, stream=False)
+
+        if response is None:
+            return None
+
+        return response.json()
+
+    def open_page(self, category: str, page_size: int, page: int = 1, sort_by=None):
+        """
+            Streamed GET request to the search API for one page of products.
+
+            Parameters:
+                - category (str): the name of the category of products to get
+                - page_size (int): the number of products per page
+                - page (int): the number of the page to get, starting at 1
+                - sort_by (str): the field sorting the products, like
+                  "last_modified_t" for the last modified products first
+
+            Returns an iterator decoding the products while the body of the
+            response is downloaded, None if the request failed.
+        """
+        response = self.request_page(
+            category, page_size, page, stream=True, sort_by=sort_by
+        )
+
+        if response is None:
+            return None
+
+        return StreamedPage(response, self.chunk_size)
+
+    def iter_products(
+        self,
+        category: str,
+        max_products: int,
+        page_size: int,
+        open_page=None,
+        on_page=None,
+        sort_by=None,
+        first_page: int = 1,
+    ):
+        """
+            Iterate over the products of a category, page after page.
+
+            The request of the next page is sent while the products of a page
+            are read, so its response is ready when the page ends. It is sent
+            as long as max_products is not reached, once too many when the
+            last page is not full.
+
+            Only a page read to its end with less than page_size products
+            ends the category. A failed request or a page cut off raises
+            OpenFoodFactsError, the category is incomplete.
+
+            Parameters:
+                - category (str): the name of the category of products to get
+                - max_products (int): stop after this number of products, None
+                  to read every page
+                - page_size (int): the number of products per page
+                - open_page (callable): open_page(category, page_size, page, sort_by)
+                  returning the products of a page, self.open_page by default
+                - on_page (callable): on_page(category, page, count, total)
+                  called at the end of every page
+                - sort_by (str): the field sorting the products
+                - first_page (int): the page to start from, the products of the
+                  previous pages count in max_products
+
+            Yields the products, decoded.
+        """
+        open_page = open_page or self.open_page
+        total = (first_page - 1) * page_size
+        page = first_page
+        prefetcher = ThreadPoolExecutor(max_workers=1)
+        next_page = None
+
+        try:
+            products = open_page(category, page_size, page, sort_by=sort_by)
+            while True:
+                if products is None:
+                    raise OpenFoodFactsError(
+                        "Request of the page {} of the category {} failed".format(
+                            page, category
+                        )
+                    )
+
+                if max_products is None or total + page_size < max_products:
+                    next_page = prefetcher.submit(
+                        open_page, category, page_size, page + 1, sort_by=sort_by
+                    )
+
+                count = 0
+                for product in products:
+                    count += 1
+                    total += 1
+                    yield product
+                    if max_products is not None and total >= max_products:
+                        break
+
+                if on_page is not None:
+                    on_page(category, page, count, total)
+
+                # the last page is not full
+                if count < page_size or next_page is None:
+                    return
+                products, next_page = next_page.result(), None
+                page += 1
+        finally:
+            if next_page is not None:
+                next_page.add_done_callback(close_page)
+            prefetcher.shutdown(wait=False)
+
+    def fetch_categories(self, produce, categories, queue_size: int):
+        """
+            Run produce(category) for every category in a bounded thread pool.
+
+            Every category has a bounded queue between its producer thread and
+            the caller, so the products are parsed and downloaded while the
+            caller writes the previous ones, with a constant memory use.
+            The categories are yielded in order, the products of a category
+            must be consumed before moving to the next one.
+
+            Parameters:
+                - produce (callable): function iterating over the products of a category
+                - categories (iterable): the names of the categories to get
+                - queue_size (int): the maximum number of products waiting per category
+
+            Yields (category, products) tuples.
+        """
+        stop = threading.Event()
+
+        def put(products_queue, item):
+            while not stop.is_set():
+                try:
+                    products_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def run(category, products_queue):
+            try:
+                for product in produce(category):
+                    if not put(products_queue, product):
+                        return
+            finally:
+                put(products_queue, END_OF_CATEGORY)
+
+        def drain(products_queue, future):
+            yield from iter(products_queue.get, END_OF_CATEGORY)
+            # raise the exception of the producer, if any
+            future.result()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            producers = []
+            for category in categories:
+                products_queue = queue.Queue(maxsize=queue_size)
+                producers.append(
+                    (
+                        category,
+                        products_queue,
+                        executor.submit(run, category, products_queue),
+                    )
+                )
+
+            try:
+                for category, products_queue, future in producers:
+                    yield category, drain(products_queue, future)
+            finally:
+                # stop the producers nobody will read
+                stop.set()
+                for category, products_queue, future in producers:
+                    future.cancel()
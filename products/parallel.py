@@ -0,0 +1,75 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.managers import SyncManager
+import threading
+
+import django
+from django.db import connections
+
+
+class ClaimRegistry:
+    """
+        Keys of the products written by the workers of a parallel import,
+        hosted by the manager process and shared by every worker.
+
+        A product is written by the first worker claiming its keys, the
+        others skip it, so two workers never insert the same url or name and
+        never rewrite the categories and nutriments of the same product.
+    """
+
+    def __init__(self):
+        self.owners = {}
+        # the manager serves every worker from its own thread
+        self.lock = threading.Lock()
+
+    def claim(self, worker: int, products_keys):
+        """
+            Claim the keys of products for a worker.
+
+            Parameters:
+                - worker (int): the number of the worker
+                - products_keys (list): the keys of every product, a list of
+                  (kind, value) tuples per product
+
+            Returns the indexes of the products the worker can write, whose
+            keys are not claimed by another worker.
+        """
+        accepted = []
+        with self.lock:
+            for index, keys in enumerate(products_keys):
+                if all(self.owners.get(key, worker) == worker for key in keys):
+                    for key in keys:
+                        self.owners[key] = worker
+                    accepted.append(index)
+        return accepted
+
+
+class ImportManager(SyncManager):
+    """Manager process of a parallel import, with the claim registry and the
+    queue of the logs of the workers"""
+
+
+ImportManager.register("ClaimRegistry", ClaimRegistry)
+
+
+def partition(items, parts: int):
+    """Split items in at most parts lists, round-robin so the big and small
+    categories are spread over the workers"""
+    items = list(items)
+    return [items[part::parts] for part in range(parts) if items[part::parts]]
+
+
+def init_worker():
+    """Set up Django in the worker processes started without a fork"""
+    django.setup()
+
+
+def worker_pool(workers: int):
+    """
+        Return a pool of worker processes, each one opening its own
+        connection to the database.
+
+        The connections of the current process are closed first, a forked
+        worker must not share them.
+    """
+    connections.close_all()
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
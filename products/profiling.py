@@ -0,0 +1,308 @@
+from collections import deque
+from contextlib import contextmanager
+from io import StringIO
+import asyncio
+import contextvars
+import cProfile
+import logging
+import pstats
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import connections
+from django.http import JsonResponse
+from django.shortcuts import render
+from django.template.backends.django import Template
+from django.utils import timezone
+
+
+logger = logging.getLogger("products.profiling")
+
+# Stats of the request being handled, read by the instrumented template
+# rendering and the queries. The threads of the async views run with the
+# context of the request
+current_stats = contextvars.ContextVar("current_stats", default=None)
+# Profile of a sampled request handled by an async view, enabled in its thread
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+
+class RequestStats:
+    """Timings of a request, in milliseconds"""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_ms = 0.0
+        self.template_ms = 0.0
+
+    def record_query(self, execute, sql, params, many, context):
+        """execute_wrapper of the database connections, counting the queries
+        and their time"""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_ms += (time.perf_counter() - start) * 1000
+
+
+def record_query(execute, sql, params, many, context):
+    """execute_wrapper of the database connections, adds the query to the
+    stats of the current request, if any"""
+    stats = current_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    return stats.record_query(execute, sql, params, many, context)
+
+
+def record_queries():
+    """Count the queries of the connections of the current thread in the
+    stats of the requests, the connections are wrapped once"""
+    for connection in connections.all():
+        if record_query not in connection.execute_wrappers:
+            connection.execute_wrappers.append(record_query)
+
+
+@contextmanager
+def profile_thread():
+    """Measure the code of an async view run in another thread, with the
+    context of the request : its queries, and its profile if it is sampled"""
+    record_queries()
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+
+
+class ProfilingStore:
+    """
+        Statistics of the requests per view, and the last sampled profiles,
+        in the memory of the process.
+
+        Parameters:
+            - max_profiles (int): number of profiles kept, the oldest are dropped
+    """
+
+    def __init__(self, max_profiles: int):
+        self.lock = threading.Lock()
+        self.views = {}
+        self.profiles = deque(maxlen=max_profiles)
+
+    def add(self, view: str, duration_ms: float, stats: RequestStats):
+        with self.lock:
+            view_stats = self.views.setdefault(
+                view,
+                {
+                    "requests": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "queries": 0,
+                    "db_ms": 0.0,
+                    "template_ms": 0.0,
+                },
+            )
+            view_stats["requests"] += 1
+            view_stats["total_ms"] += duration_ms
+            view_stats["max_ms"] = max(view_stats["max_ms"], duration_ms)
+            view_stats["queries"] += stats.queries
+            view_stats["db_ms"] += stats.db_ms
+            view_stats["template_ms"] += stats.template_ms
+
+    def add_profile(self, profile: dict):
+        with self.lock:
+            self.profiles.appendleft(profile)
+
+    def report(self):
+        """Return the mean timings per view, the slowest first, and the profiles"""
+        with self.lock:
+            views = [
+                {
+                    "view": view,
+                    "requests": view_stats["requests"],
+                    "mean_ms": round(
+                        view_stats["total_ms"] / view_stats["requests"], 2
+                    ),
+                    "max_ms": round(view_stats["max_ms"], 2),
+                    "queries_mean": round(
+                        view_stats["queries"] / view_stats["requests"], 2
+                    ),
+                    "db_mean_ms": round(
+                        view_stats["db_ms"] / view_stats["requests"], 2
+                    ),
+                    "template_mean_ms": round(
+                        view_stats["template_ms"] / view_stats["requests"], 2
+                    ),
+                }
+                for view, view_stats in self.views.items()
+            ]
+            profiles = list(self.profiles)
+        views.sort(
+            key=lambda view_stats: -view_stats["mean_ms"] * view_stats["requests"]
+        )
+        return {"views": views, "profiles": profiles}
+
+    def clear(self):
+        with self.lock:
+            self.views.clear()
+            self.profiles.clear()
+
+
+store = ProfilingStore(settings.PROFILING_MAX_PROFILES)
+
+
+def instrument_template_rendering():
+    """Add the rendering time of the templates to the stats of the current
+    request. Only the templates rendered by the views are timed, the
+    included ones are part of their time"""
+    if getattr(Template.render, "instrumented", False):
+        return
+    render_template = Template.render
+
+    def render(self, *args, **kwargs):
+        stats = current_stats.get()
+        if stats is None:
+            return render_template(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return render_template(self, *args, **kwargs)
+        finally:
+            stats.template_ms += (time.perf_counter() - start) * 1000
+
+    render.instrumented = True
+    Template.render = render
+
+
+class ProfilingMiddleware:
+    """
+        Measure the time, the queries and the template rendering of every
+        request, and profile a sample of the requests with cProfile.
+
+        The statistics are shown to the staff on vigile/profiling/. Every
+        sampled or slow request is logged on one line of key=value pairs by the
+        "products.profiling" logger.
+
+        On an ASGI server the middleware is async, so it doesn't make the async
+        views wait for each other. Their queries and their profile are taken
+        in the threads running them, see profile_thread.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # the handler awaits the middleware, like the Django ones
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+        instrument_template_rendering()
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        stats = RequestStats()
+        profile = self.sample()
+        record_queries()
+
+        token = current_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            if profile is not None:
+                profile.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                if profile is not None:
+                    profile.disable()
+        finally:
+            current_stats.reset(token)
+
+        self.record(request, response, stats, profile, start)
+        return response
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        profile = self.sample()
+
+        stats_token = current_stats.set(stats)
+        profile_token = current_profile.set(profile)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_profile.reset(profile_token)
+            current_stats.reset(stats_token)
+
+        if profile is not None and not profile.getstats():
+            # a synchronous view, run by Django without profile_thread
+            profile = None
+        self.record(request, response, stats, profile, start)
+        return response
+
+    def sample(self):
+        """Return a new profile for the sampled requests, None otherwise"""
+        if random.random() < settings.PROFILING_SAMPLE_RATE:
+            return cProfile.Profile()
+        return None
+
+    def record(self, request, response, stats, profile, start: float):
+        """Add the request to the statistics of its view and log it if it is
+        sampled or slow"""
+        duration_ms = (time.perf_counter() - start) * 1000
+
+        match = request.resolver_match
+        view = match.view_name if match is not None else "unresolved"
+        store.add(view, duration_ms, stats)
+
+        if profile is not None:
+            output = StringIO()
+            pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(
+                settings.PROFILING_PROFILE_LINES
+            )
+            store.add_profile(
+                {
+                    "date": timezone.now().isoformat(),
+                    "method": request.method,
+                    "path": request.path,
+                    "view": view,
+                    "duration_ms": round(duration_ms, 2),
+                    "profile": output.getvalue(),
+                }
+            )
+
+        if profile is not None or duration_ms >= settings.PROFILING_SLOW_REQUEST_MS:
+            logger.info(
+                "method=%s path=%s view=%s status=%s duration_ms=%.2f queries=%d "
+                "db_ms=%.2f template_ms=%.2f profiled=%d",
+                request.method,
+                request.path,
+                view,
+                response.status_code,
+                duration_ms,
+                stats.queries,
+                stats.db_ms,
+                stats.template_ms,
+                profile is not None,
+            )
+
+
+@staff_member_required
+def profiling_report(request):
+    """Show the statistics per view and the profiles of the process to the
+    staff, as JSON with ?format=json"""
+    report = store.report()
+    if request.GET.get("format") == "json":
+        return JsonResponse(report)
+    context = dict(
+        report,
+        title="Profilage des requêtes",
+        sample_rate=settings.PROFILING_SAMPLE_RATE,
+    )
+    return render(request, "products/profiling.html", context)
@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+import contextvars
+import time
+
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db import connections
+from django.dispatch import receiver
+
+
+REPLICA_ALIAS = "replica"
+
+# Set while a read-only view is handled, its queries are sent to the replica
+use_replica = contextvars.ContextVar("use_replica", default=False)
+
+
+@contextmanager
+def read_from_replica():
+    """Send the reads of the block to the replica, when there is one"""
+    token = use_replica.set(True)
+    try:
+        yield
+    finally:
+        use_replica.reset(token)
+
+
+def replica_configured():
+    """Return True if the replica alias is a database of its own, not the
+    primary database under another name like the test mirrors"""
+    replica = settings.DATABASES.get(REPLICA_ALIAS)
+    if replica is None:
+        return False
+    primary = settings.DATABASES["default"]
+    return any(
+        replica.get(key) != primary.get(key) for key in ("ENGINE", "NAME", "HOST", "PORT")
+    )
+
+
+class ReplicaRouter:
+    """
+        Send the reads of the read-only views to the replica and every other
+        query, writes included, to the primary database.
+
+        The reads of the other views stay on the primary database, so the
+        users always see their own favorites and account right after saving
+        them, whatever the lag of the replica.
+    """
+
+    def db_for_read(self, model, **hints):
+        if use_replica.get() and replica_configured():
+            return REPLICA_ALIAS
+        return "default"
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as the primary database
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the replica is migrated by the replication of the primary database
+        return db != REPLICA_ALIAS
+
+
+class ReadReplicaMixin:
+    """Handle the requests of a read-only view with the reads sent to the
+    replica, the user of the session is read from the primary database"""
+
+    def dispatch(self, request, *args, **kwargs):
+        # loads the user of the session before the reads are sent to the replica
+        request.user.is_authenticated
+        with read_from_replica():
+            return super().dispatch(request, *args, **kwargs)
+
+
+@receiver(request_finished)
+def mark_idle_connections(**kwargs):
+    """Save when the persistent connections became idle, at the end of the
+    request"""
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is not None:
+            connection.idle_since = now
+
+
+@receiver(request_started)
+def check_persistent_connections(**kwargs):
+    """
+        Close the persistent connections that the database closed since the
+        last request, so the next query opens a new one instead of failing.
+
+        Only the connections idle for DATABASE_HEALTH_CHECK_IDLE seconds or
+        more, or whose queries failed, are checked with a query.
+    """
+    if not settings.DATABASE_HEALTH_CHECKS:
+        return
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is None or connection.in_atomic_block:
+            continue
+        idle_since = getattr(connection, "idle_since", None)
+        if (
+            not connection.errors_occurred
+            and idle_since is not None
+            and now - idle_since < settings.DATABASE_HEALTH_CHECK_IDLE
+        ):
+            continue
+        if not connection.is_usable():
+            connection.close()
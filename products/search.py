@@ -0,0 +1,300 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import heapq
+import re
+import threading
+import unicodedata
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import (
+    Case,
+    IntegerField,
+    Q,
+    Value,
+    When,
+)
+
+from products.cache import get_catalog_version
+from products.models import Product
+
+
+# Minimum similarity of a product not containing the searched text
+SIMILARITY_THRESHOLD = 0.3
+
+
+def normalize_search_text(text: str):
+    """Lowercase the text and remove its accents and punctuation, so
+    "Pâté de campagne" and "pate DE Campagne" are matched"""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def trigrams(text: str):
+    """Return the set of trigrams of a normalized text, computed like pg_trgm:
+    every word is padded with two spaces before and one space after"""
+    result = set()
+    for word in text.split():
+        padded = "  " + word + " "
+        for index in range(len(padded) - 2):
+            result.add(padded[index : index + 3])
+    return result
+
+
+class PackedStrings:
+    """
+        Read-only list of strings stored in a single string, with an array of
+        the offsets of every string. It takes a fraction of the memory of a
+        list of strings, and the whole list is scanned with str.find.
+
+        Parameters:
+            - strings (iterable): the strings, without new lines
+    """
+
+    def __init__(self, strings):
+        self.offsets = array("l", [0])
+        parts = []
+        for string in strings:
+            parts.append(string)
+            self.offsets.append(self.offsets[-1] + len(string) + 1)
+        self.text = "\n".join(parts) + "\n"
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position: int):
+        return self.text[self.offsets[position] : self.offsets[position + 1] - 1]
+
+    def find(self, text: str):
+        """Yield the positions of the strings containing the text"""
+        start = self.text.find(text)
+        while start != -1:
+            position = bisect_right(self.offsets, start) - 1
+            yield position
+            start = self.text.find(text, self.offsets[position + 1])
+
+
+class ProductSearchIndex:
+    """
+        In-memory index of the names of the products, used for the search when
+        the database is not PostgreSQL, and for the autocompletion.
+
+        Every trigram and every word points to the positions of the products
+        containing it, so only the products sharing a trigram with the searched
+        text are scored. The names are packed in PackedStrings, with the ids in
+        an array of the same positions.
+
+        Parameters:
+            - rows (iterable): (id, name, search_name) tuples of the products
+    """
+
+    def __init__(self, rows):
+        self.ids = array("l")
+        self.trigram_counts = array("l")
+        self.postings = {}
+        self.word_postings = {}
+        names = []
+        search_names = []
+
+        for product_id, name, search_name in rows:
+            position = len(self.ids)
+            name_trigrams = trigrams(search_name)
+            self.ids.append(product_id)
+            self.trigram_counts.append(len(name_trigrams))
+            names.append(" ".join(name.split()))
+            search_names.append(search_name)
+            for trigram in name_trigrams:
+                self.postings.setdefault(trigram, array("l")).append(position)
+            for word in set(search_name.split()):
+                self.word_postings.setdefault(word, array("l")).append(position)
+
+        self.names = PackedStrings(names)
+        self.search_names = PackedStrings(search_names)
+        self.words = sorted(self.word_postings)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, text: str, limit: int = 10):
+        """
+            Return the ids of the products matching the text, the best first.
+
+            A product matches if its name contains the text or if the names
+            are similar enough. The products containing the text come first,
+            then the products are ordered by similarity.
+        """
+        return [self.ids[position] for position in self.search_positions(text, limit)]
+
+    def search_positions(self, text: str, limit: int):
+        """Return the positions of the products matching the text, the best first"""
+        query = normalize_search_text(text)
+        query_trigrams = trigrams(query)
+        if not query_trigrams:
+            return []
+
+        shared = {}
+        for trigram in query_trigrams:
+            for position in self.postings.get(trigram, ()):
+                shared[position] = shared.get(position, 0) + 1
+
+        results = []
+        found_containing = False
+        for position, count in shared.items():
+            score = count / (
+                len(query_trigrams) + self.trigram_counts[position] - count
+            )
+            contains = query in self.search_names[position]
+            found_containing = found_containing or contains
+            if contains or score >= SIMILARITY_THRESHOLD:
+                results.append((not contains, -score, position))
+
+        # short texts inside a word share no trigram with the name
+        if not found_containing:
+            for position in self.search_names.find(query):
+                results.append((False, 0.0, position))
+
+        results.sort()
+        return [position for not_contains, score, position in results[:limit]]
+
+    def complete(self, text: str, limit: int = 10):
+        """
+            Return the products whose name contains every word of the text,
+            the last word being a prefix, as (id, name) tuples.
+
+            The names starting with the text come first, then the shortest.
+            Only the word index is read, the similarity of the names is left to
+            the search so the suggestions stay under the millisecond.
+        """
+        query = normalize_search_text(text)
+        if not query:
+            return []
+
+        *words, prefix = query.split()
+
+        # the products containing every complete word, the rarest first
+        candidates = None
+        words.sort(key=lambda word: len(self.word_postings.get(word, ())))
+        for word in words:
+            positions = set(self.word_postings.get(word, ()))
+            candidates = positions if candidates is None else candidates & positions
+            if not candidates:
+                break
+
+        matches = set()
+        if candidates is None or candidates:
+            index = bisect_left(self.words, prefix)
+            while index < len(self.words) and self.words[index].startswith(prefix):
+                for position in self.word_postings[self.words[index]]:
+                    if candidates is None or position in candidates:
+                        matches.add(position)
+                index += 1
+
+        positions = heapq.nsmallest(
+            limit,
+            matches,
+            key=lambda position: (
+                not self.search_names[position].startswith(query),
+                self.name_length(position),
+                position,
+            ),
+        )
+
+        return [(self.ids[position], self.names[position]) for position in positions]
+
+    def name_length(self, position: int):
+        """Return the length of the name of a product, without slicing it"""
+        offsets = self.search_names.offsets
+        return offsets[position + 1] - offsets[position]
+
+
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+
+
+def get_search_index():
+    """
+        Return the in-memory index of the products of this process, rebuilt
+        when the version of the catalog changes.
+
+        The version is read from the cache like the cached pages, so the
+        imports of the cron job and the changes of the admin site reach
+        every web process without querying the products. While a request
+        rebuilds the index, the other requests keep reading the previous one.
+    """
+    global _index, _index_version
+
+    version = get_catalog_version()
+    if _index is not None and version == _index_version:
+        return _index
+
+    if _index is None:
+        _index_lock.acquire()
+    elif not _index_lock.acquire(blocking=False):
+        # rebuilt by another request
+        return _index
+
+    try:
+        if _index is None or version != _index_version:
+            _index = ProductSearchIndex(
+                Product.objects.values_list("id", "name", "search_name").iterator()
+            )
+            _index_version = version
+    finally:
+        _index_lock.release()
+    return _index
+
+
+def invalidate_search_index():
+    """Drop the in-memory index of this process, it is rebuilt by the next
+    search. The other processes follow the version of the catalog"""
+    global _index
+    _index = None
+
+
+def search_product(text: str):
+    """
+        Return the product best matching the searched text, None if no product
+        matches.
+
+        On PostgreSQL the search runs in the database, on the trigram GIN index
+        of Product.search_name. Otherwise the in-memory index is used.
+    """
+    query = normalize_search_text(text)
+    if not query:
+        return None
+
+    if connection.vendor == "postgresql":
+        # psycopg2 is only required with PostgreSQL, the trigram_similar
+        # lookup is registered by ProductsConfig
+        from django.contrib.postgres.search import TrigramSimilarity
+
+        return (
+            Product.objects.filter(
+                Q(search_name__contains=query) | Q(search_name__trigram_similar=query)
+            )
+            .annotate(
+                similarity=TrigramSimilarity("search_name", query),
+                not_contains=Case(
+                    When(search_name__contains=query, then=Value(0)),
+                    default=Value(1),
+                    output_field=IntegerField(),
+                ),
+            )
+            .order_by("not_contains", "-similarity", "id")
+            .first()
+        )
+
+    ids = get_search_index().search(query, limit=1)
+    if not ids:
+        return None
+    return Product.objects.filter(id=ids[0]).first()
+
+
+def autocomplete(text: str, limit: int = 10):
+    """Return the products whose name starts like the text, as (id, name)
+    tuples, from the in-memory index"""
+    if len(normalize_search_text(text)) < settings.AUTOCOMPLETE_MIN_LENGTH:
+        return []
+    return get_search_index().complete(text, limit)
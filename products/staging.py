@@ -0,0 +1,433 @@
+import hashlib
+import re
+
+from django.db import connection, transaction
+from django.db.models import Max
+
+from products.cache import bump_catalog_version
+from products.importer import ProductImporter
+from products.models import Category, Nutriment, Product, ProductCategories, ProductNutriments
+from products.search import normalize_search_text
+
+
+# Tables rebuilt by an import in staging tables, the products first
+SWAPPED_MODELS = [Product, ProductCategories, ProductNutriments]
+
+INDEX_DEFINITION_RE = re.compile(r"^(CREATE (?:UNIQUE )?INDEX )\S+( ON (?:ONLY )?)\S+( .*)$")
+
+
+def quote(name: str):
+    return connection.ops.quote_name(name)
+
+
+def staging_table(model):
+    return model._meta.db_table + "_staging"
+
+
+def old_table(model):
+    return model._meta.db_table + "_old"
+
+
+def staging_name(name: str):
+    """Name of the copy of an index or a constraint on a staging table,
+    short enough for Postgres and renamed to the original name by the swap"""
+    return "stg_{}".format(hashlib.md5(name.encode()).hexdigest()[:24])
+
+
+class StagingCatalog:
+    """
+        Staging copies of the tables of the products, their categories and
+        their nutriments, loaded while the site keeps reading the live tables.
+
+        On Postgres the staging tables are loaded without indexes, the indexes
+        and constraints of the live tables are built once the rows are loaded,
+        then the staging tables take the place of the live ones by renaming
+        them, in a transaction holding the locks for a few milliseconds. The
+        other databases copy the staging tables in the live ones in one
+        transaction.
+    """
+
+    def __init__(self):
+        self.postgresql = connection.vendor == "postgresql"
+        self.next_id = None
+        # copies of the indexes and constraints : (kind, model, staging name, name)
+        self.copies = []
+
+    def create(self):
+        """Create the empty staging tables, replacing the ones of a previous
+        import which failed"""
+        self.drop()
+        with connection.cursor() as cursor:
+            for model in SWAPPED_MODELS:
+                if self.postgresql:
+                    # the columns, their NOT NULL and their defaults, the id
+                    # sequence of the live table included
+                    cursor.execute(
+                        "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)".format(
+                            quote(staging_table(model)), quote(model._meta.db_table)
+                        )
+                    )
+                else:
+                    cursor.execute(
+                        "CREATE TABLE {} AS SELECT * FROM {} WHERE 1 = 0".format(
+                            quote(staging_table(model)), quote(model._meta.db_table)
+                        )
+                    )
+
+    def drop(self):
+        with connection.cursor() as cursor:
+            for model in reversed(SWAPPED_MODELS):
+                cursor.execute(
+                    "DROP TABLE IF EXISTS {}".format(quote(staging_table(model)))
+                )
+
+    def allocate_ids(self, number: int):
+        """Return number new ids of products, which are in neither the live
+        table nor the staging table"""
+        if number == 0:
+            return []
+
+        if self.postgresql:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+                    "FROM generate_series(1, %s)",
+                    [Product._meta.db_table, number],
+                )
+                return [row[0] for row in cursor.fetchall()]
+
+        if self.next_id is None:
+            self.next_id = (Product.objects.aggregate(Max("id"))["id__max"] or 0) + 1
+        ids = list(range(self.next_id, self.next_id + number))
+        self.next_id += number
+        return ids
+
+    def insert(self, model, fields, rows):
+        """
+            Insert rows in the staging table of a model, with multi-row inserts.
+
+            Parameters:
+                - model (Model): the model of the live table
+                - fields (list): the names of the fields of the values
+                - rows (list): the values of the rows, in the order of the fields
+        """
+        if not rows:
+            return
+
+        columns = ", ".join(quote(model._meta.get_field(field).column) for field in fields)
+        row_placeholder = "({})".format(", ".join(["%s"] * len(fields)))
+        max_params = connection.features.max_query_params
+        batch_size = max_params // len(fields) if max_params else 1000
+
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start : start + batch_size]
+                cursor.execute(
+                    "INSERT INTO {} ({}) VALUES {}".format(
+                        quote(staging_table(model)),
+                        columns,
+                        ", ".join([row_placeholder] * len(batch)),
+                    ),
+                    [value for row in batch for value in row],
+                )
+
+    def build_indexes(self):
+        """Create the constraints and indexes of the live tables on the loaded
+        staging tables, under temporary names (Postgres only)"""
+        if not self.postgresql:
+            return
+
+        with connection.cursor() as cursor:
+            for model in SWAPPED_MODELS:
+                table = model._meta.db_table
+
+                # the primary and unique keys before the foreign keys
+                cursor.execute(
+                    "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                    "WHERE conrelid = %s::regclass ORDER BY contype = 'f', conname",
+                    [table],
+                )
+                for name, definition in cursor.fetchall():
+                    for referenced in SWAPPED_MODELS:
+                        definition = definition.replace(
+                            "REFERENCES {}(".format(referenced._meta.db_table),
+                            "REFERENCES {}(".format(staging_table(referenced)),
+                        )
+                    cursor.execute(
+                        "ALTER TABLE {} ADD CONSTRAINT {} {}".format(
+                            quote(staging_table(model)), quote(staging_name(name)), definition
+                        )
+                    )
+                    self.copies.append(("constraint", model, staging_name(name), name))
+
+                # the other indexes, like the indexes on expressions
+                cursor.execute(
+                    "SELECT index_class.relname, pg_get_indexdef(index_class.oid) "
+                    "FROM pg_index JOIN pg_class index_class "
+                    "ON index_class.oid = pg_index.indexrelid "
+                    "WHERE pg_index.indrelid = %s::regclass AND NOT EXISTS ("
+                    "SELECT 1 FROM pg_constraint "
+                    "WHERE pg_constraint.conindid = pg_index.indexrelid)",
+                    [table],
+                )
+                for name, definition in cursor.fetchall():
+                    cursor.execute(
+                        INDEX_DEFINITION_RE.sub(
+                            r"\g<1>{}\g<2>{}\g<3>".format(
+                                quote(staging_name(name)), quote(staging_table(model))
+                            ),
+                            definition,
+                        )
+                    )
+                    self.copies.append(("index", model, staging_name(name), name))
+
+                cursor.execute("ANALYZE {}".format(quote(staging_table(model))))
+
+    def referencing_fields(self):
+        """Return the foreign keys of the tables kept by the swap which point
+        to the products, like the saved products of the users"""
+        return [
+            relation.field
+            for relation in Product._meta.related_objects
+            if relation.related_model not in SWAPPED_MODELS and relation.field.concrete
+        ]
+
+    def delete_missing_references(self, cursor):
+        """Delete the saved products and substitutes of the products which
+        are not in the new catalog, the others keep the same product id"""
+        for field in self.referencing_fields():
+            cursor.execute(
+                "DELETE FROM {} WHERE {} NOT IN (SELECT {} FROM {})".format(
+                    quote(field.model._meta.db_table),
+                    quote(field.column),
+                    quote(Product._meta.pk.column),
+                    quote(staging_table(Product)),
+                )
+            )
+
+    def swap(self):
+        """Replace the live tables by the staging tables"""
+        if self.postgresql:
+            self.swap_tables()
+        else:
+            self.copy_tables()
+
+    def swap_tables(self):
+        """Rename the staging tables to the live tables, in one transaction"""
+        tables = [model._meta.db_table for model in SWAPPED_MODELS]
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            referencing_tables = list(
+                dict.fromkeys(
+                    field.model._meta.db_table for field in self.referencing_fields()
+                )
+            )
+            cursor.execute(
+                "LOCK TABLE {} IN ACCESS EXCLUSIVE MODE".format(
+                    ", ".join(quote(table) for table in tables + referencing_tables)
+                )
+            )
+            self.delete_missing_references(cursor)
+
+            # the foreign keys of the other tables would follow the renamed
+            # live table, they are created again on the new one
+            cursor.execute(
+                "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) "
+                "FROM pg_constraint WHERE contype = 'f' AND confrelid = %s::regclass",
+                [Product._meta.db_table],
+            )
+            foreign_keys = [
+                foreign_key
+                for foreign_key in cursor.fetchall()
+                if foreign_key[0].split(".")[-1].strip('"') not in tables
+            ]
+            for table, name, definition in foreign_keys:
+                cursor.execute(
+                    "ALTER TABLE {} DROP CONSTRAINT {}".format(table, quote(name))
+                )
+
+            for model in SWAPPED_MODELS:
+                table = model._meta.db_table
+                cursor.execute(
+                    "SELECT pg_get_serial_sequence(%s, %s)", [table, model._meta.pk.column]
+                )
+                sequence = cursor.fetchone()[0]
+                cursor.execute(
+                    "ALTER TABLE {} RENAME TO {}".format(quote(table), quote(old_table(model)))
+                )
+                cursor.execute(
+                    "ALTER TABLE {} RENAME TO {}".format(
+                        quote(staging_table(model)), quote(table)
+                    )
+                )
+                if sequence:
+                    # the sequence would be dropped with the old table
+                    cursor.execute(
+                        "ALTER SEQUENCE {} OWNED BY {}.{}".format(
+                            sequence, quote(table), quote(model._meta.pk.column)
+                        )
+                    )
+
+            for model in reversed(SWAPPED_MODELS):
+                cursor.execute("DROP TABLE {}".format(quote(old_table(model))))
+
+            for kind, model, name, original_name in self.copies:
+                if kind == "constraint":
+                    cursor.execute(
+                        "ALTER TABLE {} RENAME CONSTRAINT {} TO {}".format(
+                            quote(model._meta.db_table), quote(name), quote(original_name)
+                        )
+                    )
+                else:
+                    cursor.execute(
+                        "ALTER INDEX {} RENAME TO {}".format(
+                            quote(name), quote(original_name)
+                        )
+                    )
+
+            # checked after the commit, without locking the tables
+            for table, name, definition in foreign_keys:
+                cursor.execute(
+                    "ALTER TABLE {} ADD CONSTRAINT {} {} NOT VALID".format(
+                        table, quote(name), definition
+                    )
+                )
+
+        with connection.cursor() as cursor:
+            for table, name, definition in foreign_keys:
+                cursor.execute(
+                    "ALTER TABLE {} VALIDATE CONSTRAINT {}".format(table, quote(name))
+                )
+
+    def copy_tables(self):
+        """Replace the rows of the live tables by the rows of the staging
+        tables in one transaction, then drop the staging tables"""
+        with transaction.atomic(), connection.cursor() as cursor:
+            self.delete_missing_references(cursor)
+
+            # the foreign keys are checked at the commit
+            for model in reversed(SWAPPED_MODELS):
+                cursor.execute("DELETE FROM {}".format(quote(model._meta.db_table)))
+
+            for model in SWAPPED_MODELS:
+                # the products keep their ids, the relations get new ones
+                columns = ", ".join(
+                    quote(field.column)
+                    for field in model._meta.concrete_fields
+                    if model is Product or not field.primary_key
+                )
+                cursor.execute(
+                    "INSERT INTO {} ({}) SELECT {} FROM {}".format(
+                        quote(model._meta.db_table),
+                        columns,
+                        columns,
+                        quote(staging_table(model)),
+                    )
+                )
+
+        self.drop()
+
+
+class StagingImporter(ProductImporter):
+    """
+        Rebuild the catalog from scratch in staging tables, then swap them
+        with the live tables once every product is loaded. The site keeps
+        reading the previous catalog during the import.
+
+        A product keeps its id when its url is already in the live catalog, so
+        the saved products of the users and the substitutes stay attached to
+        it. The products missing from the new catalog are deleted with their
+        saved products and substitutes by swap().
+    """
+
+    def __init__(self, batch_size: int = None):
+        super().__init__(batch_size)
+        self.staging = StagingCatalog()
+        self.live_products = {}
+
+    def load_existing_keys(self):
+        """Load the ids of the live products per url, the categories and the
+        nutriments, and create the empty staging tables"""
+        for product_id, url in Product.objects.values_list("id", "url").iterator():
+            self.live_products[url.lower()] = product_id
+
+        self.categories = dict(Category.objects.values_list("name", "id"))
+        self.nutriments = dict(Nutriment.objects.values_list("name", "id"))
+        self.staging.create()
+
+    def write_pending(self):
+        """Insert the pending products and their relations in the staging tables"""
+        new_ids = iter(
+            self.staging.allocate_ids(
+                sum(
+                    1
+                    for product in self.pending
+                    if product["url"].lower() not in self.live_products
+                )
+            )
+        )
+
+        products = []
+        product_categories = []
+        product_nutriments = []
+        for new_product in self.pending:
+            new_product["id"] = self.live_products.get(new_product["url"].lower())
+            if new_product["id"] is None:
+                new_product["id"] = next(new_ids)
+
+            products.append(
+                (
+                    new_product["id"],
+                    new_product["name"],
+                    normalize_search_text(new_product["name"]),
+                    new_product["url"],
+                    new_product["image_url"],
+                    new_product["nutri_score"],
+                    new_product["content_hash"],
+                    new_product["last_modified_t"],
+                )
+            )
+            for category in new_product["categories"]:
+                if category in self.categories:
+                    product_categories.append(
+                        (new_product["id"], self.categories[category])
+                    )
+            for nutriment, quantity in new_product["nutriments"].items():
+                product_nutriments.append(
+                    (new_product["id"], self.nutriments[nutriment], quantity)
+                )
+
+        self.staging.insert(
+            Product,
+            [
+                "id",
+                "name",
+                "search_name",
+                "url",
+                "image_url",
+                "nutri_score",
+                "content_hash",
+                "last_modified_t",
+            ],
+            products,
+        )
+        self.staging.insert(ProductCategories, ["product", "category"], product_categories)
+        self.staging.insert(
+            ProductNutriments, ["product", "nutriment", "quantity"], product_nutriments
+        )
+
+        self.inserted_products += len(self.pending)
+        self.inserted_rows += len(products) + len(product_categories) + len(product_nutriments)
+
+    def swap(self):
+        """Build the indexes of the staging tables and swap them with the live
+        tables, once every product has been added"""
+        self.flush()
+        self.staging.build_indexes()
+        self.staging.swap()
+        bump_catalog_version()
+
+    def discard(self):
+        """Drop the staging tables of an import which failed, the live
+        tables are untouched"""
+        self.staging.drop()
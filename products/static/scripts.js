@@ -54,4 +54,56 @@ $(".save-div p").click((e) => {
             }
         }
     });
-});
\ No newline at end of file
+});
+
+// AJAX call to unsave all the products of the grid in one request
+$("#unsave-all-products").click((e) => {
+    let productIds = $(".product-card .save-div p").map((index, element) => $(element).attr("data")).get();
+
+    $.ajax({
+        type: "POST",
+        url: $(e.target).attr("data-url"),
+        contentType: "application/json",
+        headers: { "X-CSRFToken": $(e.target).attr("data-csrf") },
+        data: JSON.stringify({ product_ids: productIds, saved: false }),
+        success: (data) => {
+            data["product_ids"].forEach((productId) => {
+                $("#product-card-" + productId).css("display", "none");
+            });
+            $("#save-product-message").text(data["product_ids"].length + " produits ont été retirés de vos favoris");
+            $("#save-product-message").show();
+            setTimeout(function() {
+                $("#save-product-message").hide();
+            }, 1500);
+            $(e.target).hide();
+        }
+    });
+});
+
+// Suggest products while the user types in a search form
+let autocompleteRequest = null;
+
+$("input[list='product-suggestions']").on("input", (e) => {
+    let text = $(e.target).val();
+    let suggestions = $("#product-suggestions");
+
+    if (text.trim().length < Number(suggestions.attr("data-min-length"))) {
+        suggestions.empty();
+        return;
+    }
+    if (autocompleteRequest) {
+        autocompleteRequest.abort();
+    }
+
+    autocompleteRequest = $.ajax({
+        type: "GET",
+        url: suggestions.attr("data-url"),
+        data: { q: text },
+        success: (data) => {
+            suggestions.empty();
+            data["results"].forEach((product) => {
+                suggestions.append($("<option>").attr("value", product["name"]));
+            });
+        }
+    });
+});
@@ -0,0 +1,134 @@
+from collections import defaultdict
+import heapq
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, CharField, F, Value, When
+
+from products.models import (
+    Product,
+    ProductCategories,
+    ProductNutriments,
+    ProductSubstitute,
+)
+
+
+# Products without nutrition score are ranked after the "e" ones
+UNKNOWN_NUTRI_SCORE = "z"
+
+
+def nutri_score_rank():
+    """Return the expression ranking the products by nutrition score, the
+    empty scores last"""
+    return Case(
+        When(nutri_score="", then=Value(UNKNOWN_NUTRI_SCORE)),
+        default=F("nutri_score"),
+        output_field=CharField(),
+    )
+
+
+def compute_substitutes(nb_substitutes: int = None, batch_size: int = None):
+    """
+        Compute the best substitutes of every product and replace the content
+        of the ProductSubstitute table, in one transaction.
+
+        The substitutes of a product are the products of its first category,
+        ranked by nutrition score, then by number of categories shared with
+        the product, then by total quantity of nutriments (fat, sugars, salt...).
+
+        Parameters:
+            - nb_substitutes (int): number of substitutes kept per product
+            - batch_size (int): number of rows per bulk insert
+
+        Returns the number of substitutes rows written. The caller bumps
+        the version of the catalog once its import is done.
+    """
+    nb_substitutes = nb_substitutes or settings.NB_SUBSTITUTES
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+
+    nutri_scores = dict(
+        Product.objects.annotate(rank=nutri_score_rank())
+        .values_list("id", "rank")
+        .iterator()
+    )
+
+    product_categories = defaultdict(set)
+    for product_id, category_id in ProductCategories.objects.values_list(
+        "product_id", "category_id"
+    ).iterator():
+        product_categories[product_id].add(category_id)
+
+    nutriment_totals = defaultdict(float)
+    for product_id, quantity in ProductNutriments.objects.values_list(
+        "product_id", "quantity"
+    ).iterator():
+        nutriment_totals[product_id] += quantity or 0
+
+    def health(product_id):
+        return (nutri_scores[product_id], nutriment_totals[product_id], product_id)
+
+    # members of every category, the healthiest first
+    category_members = defaultdict(list)
+    for product_id, categories in product_categories.items():
+        for category_id in categories:
+            category_members[category_id].append(product_id)
+    for members in category_members.values():
+        members.sort(key=health)
+
+    substitutes = []
+    for product_id, categories in product_categories.items():
+        # the category of Product.categories.first()
+        members = category_members[min(categories)]
+
+        # the healthiest products are reranked with the shared categories
+        candidates = [
+            member for member in members[: nb_substitutes * 4 + 1] if member != product_id
+        ]
+        best = heapq.nsmallest(
+            nb_substitutes,
+            candidates,
+            key=lambda member: (
+                nutri_scores[member],
+                -len(categories & product_categories[member]),
+                nutriment_totals[member],
+                member,
+            ),
+        )
+
+        substitutes.extend(
+            ProductSubstitute(product_id=product_id, substitute_id=member, rank=rank)
+            for rank, member in enumerate(best)
+        )
+
+    with transaction.atomic():
+        ProductSubstitute.objects.all().delete()
+        ProductSubstitute.objects.bulk_create(substitutes, batch_size=batch_size)
+
+    return len(substitutes)
+
+
+def get_substitutes(product: Product, nb_substitutes: int = None):
+    """
+        Return the substitutes of a product, the best first.
+
+        The precomputed substitutes are read in one query. The products
+        without precomputed substitutes (added since the last import) fallback
+        on the products of their first category ordered by nutrition score,
+        the products without score last like in compute_substitutes.
+    """
+    nb_substitutes = nb_substitutes or settings.NB_SUBSTITUTES
+
+    substitutes = list(
+        Product.objects.filter(substitute_of__product=product).order_by(
+            "substitute_of__rank"
+        )[:nb_substitutes]
+    )
+
+    if not substitutes:
+        substitutes = list(
+            Product.objects.filter(categories=product.categories.first())
+            .exclude(id=product.id)
+            .order_by(nutri_score_rank(), "id")[:nb_substitutes]
+        )
+
+    return substitutes
@@ -1,23 +1,169 @@
-from django.test import TestCase
+from django.test import (
+    AsyncClient,
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
 from unittest.mock import Mock, patch
-from django.urls import reverse
+from django.urls import clear_url_caches, reverse
+from django.utils.module_loading import import_string
+from django.http import Http404, HttpResponse
+from django.middleware.csrf import get_token
+from django.views import View
 
 from django.contrib.auth import authenticate, login, logout
-from django.contrib.auth.models import User
-from django.core.management import call_command
+from django.contrib.auth.models import AnonymousUser, User
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.core.management import call_command, CommandError
+from django.db import (
+    IntegrityError,
+    connection,
+    connections,
+    reset_queries,
+    transaction,
+)
+from django.db.models import CharField
+from django.test.utils import CaptureQueriesContext
 
 from products.models import (
     Category,
+    CategorySync,
+    ImportCheckpoint,
+    ImportRun,
     Nutriment,
     Product,
     ProductCategories,
     ProductNutriments,
+    ProductSubstitute,
     ProductUsers,
 )
+from products.benchmark import (
+    iter_scaled_products,
+    load_dump_products,
+    percentile,
+    run_benchmark,
+)
+from products.cache import (
+    AnonymousPageCacheMixin,
+    CatalogConditionalMixin,
+    bump_catalog_version,
+    catalog_version_timeout,
+    get_catalog_version,
+)
 from products.forms import UserCreateForm, LoginForm
-from products.management.commands.database_update import Command
+from products.views import (
+    product_details_async,
+    search_result_async,
+    user_save_product_async,
+)
+from products.management.commands.database_update import Command, import_worker
+from products.importer import ProductImporter, create_missing_categories
+from products.parallel import ClaimRegistry, partition
+from products.search import (
+    PackedStrings,
+    ProductSearchIndex,
+    autocomplete,
+    get_search_index,
+    invalidate_search_index,
+    normalize_search_text,
+    search_product,
+)
+from products import metrics
+from products.nutrition import get_nutrition_table
+from products.profiling import store as profiling_store
+from products.routers import (
+    ReplicaRouter,
+    check_persistent_connections,
+    read_from_replica,
+    use_replica,
+)
+from products.openfoodfacts import (
+    OpenFoodFactsClient,
+    OpenFoodFactsError,
+    iter_json_array,
+)
+from products.substitutes import compute_substitutes, get_substitutes
 
+from asgiref.sync import async_to_sync
+from contextlib import contextmanager, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from io import StringIO
+from urllib.parse import parse_qs, urlparse
+import asyncio
+import importlib
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import requests
+
+
+# The tests cache the pages and save the metrics in a temporary directory,
+# empty at every run, not in the ones of the server
+test_directory = tempfile.mkdtemp()
+test_settings = override_settings(
+    CACHES={
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": os.path.join(test_directory, "cache"),
+        }
+    },
+    METRICS_DIRECTORY=os.path.join(test_directory, "metrics"),
+)
+
+
+def setUpModule():
+    test_settings.enable()
+
+
+def tearDownModule():
+    test_settings.disable()
+    shutil.rmtree(test_directory, ignore_errors=True)
+
+
+class QueryCountMixin:
+    """Assertions on the number of queries of a view, so the N+1 queries
+    cannot come back unnoticed"""
+
+    @contextmanager
+    def assertMaxQueries(self, maximum: int):
+        # the log of the queries is bounded, a full log would count nothing
+        reset_queries()
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        self.assertLessEqual(
+            len(context),
+            maximum,
+            "{} queries executed, {} expected at most :\n{}".format(
+                len(context),
+                maximum,
+                "\n".join(query["sql"] for query in context.captured_queries),
+            ),
+        )
+
+    def assertQueriesDoNotGrow(self, request, add_rows):
+        """Run the request before and after more rows are added by
+        add_rows(), and check it runs the same number of queries. Every
+        request is run once beforehand, so the one-off queries filling
+        the caches are not counted"""
+        request()
+        reset_queries()
+        with CaptureQueriesContext(connection) as before:
+            request()
+        expected = len(before)
+        add_rows()
+        request()
+        with self.assertMaxQueries(expected):
+            request()
+
 
 # Homepage page
 class HomePageTestCase(TestCase):
@@ -27,8 +173,9 @@ class HomePageTestCase(TestCase):
 
 
 # Search-result Page
-class SearchResultPage(TestCase):
+class SearchResultPage(QueryCountMixin, TestCase):
     def setUp(self):
+        cache.clear()
         self.test_product = Product.objects.create(
             name="Produit test", url="test.fr", nutri_score="c"
         )
@@ -87,10 +234,43 @@ class SearchResultPage(TestCase):
         self.assertIsNotNone(response.context["saved_product"])
         self.assertGreater(len(response.context["saved_product"]), 0)
 
+    # test that the saved products are checked with a constant number of queries
+    def test_searchresult_page_saved_products_queries(self):
+        test_user = User.objects.create_user(username="testuser", password="test123+")
+        self.client.login(username="testuser", password="test123+")
+        category = Category.objects.get(name="test-category")
+
+        def search():
+            response = self.client.post(
+                reverse("product-search-results"), {"product_name": "Produit test"}
+            )
+            self.assertEqual(response.status_code, 200)
+
+        def add_saved_substitutes():
+            for number in range(10):
+                substitute = Product.objects.create(
+                    name="Substitut {}".format(number),
+                    url="sub-{}.fr".format(number),
+                    nutri_score="b",
+                )
+                ProductCategories.objects.create(product=substitute, category=category)
+                ProductUsers.objects.create(product=substitute, user=test_user)
+            # like the import of the products
+            bump_catalog_version()
+
+        self.assertQueriesDoNotGrow(search, add_saved_substitutes)
+
+        with self.assertMaxQueries(8):
+            response = self.client.post(
+                reverse("product-search-results"), {"product_name": "Produit test"}
+            )
+        self.assertEqual(len(response.context["saved_product"]), 10)
+
 
 # Product-details page
-class ProductDetailsPage(TestCase):
+class ProductDetailsPage(QueryCountMixin, TestCase):
     def setUp(self):
+        cache.clear()
         self.test_product = Product.objects.create(
             name="Produit test", url="test.fr", nutri_score="c"
         )
@@ -111,6 +291,55 @@ class ProductDetailsPage(TestCase):
         self.assertEqual(response.context["product_nutriments"][0]["unit"], "g")
         self.assertEqual(response.context["product_nutriments"][0]["quantity"], 1.5)
 
+    # test that the nutriments are loaded in one query, then from the cache
+    def test_productdetails_nutriments_queries(self):
+        sugars = Nutriment.objects.create(name="sugars", unit="g")
+        ProductNutriments.objects.create(
+            product=self.test_product, nutriment=sugars, quantity=12
+        )
+        url = reverse("product-details", args=(self.test_product.id,))
+
+        with self.assertMaxQueries(2):
+            response = self.client.get(url)
+        self.assertEqual(
+            [nutriment["name"] for nutriment in response.context["product_nutriments"]],
+            ["sel", "sucres"],
+        )
+
+        with self.assertNumQueries(0):
+            self.assertEqual(len(get_nutrition_table(self.test_product.id)), 2)
+
+        # the version of the catalog is bumped by the imports of the cron job
+        bump_catalog_version()
+        with self.assertNumQueries(1):
+            self.assertEqual(len(get_nutrition_table(self.test_product.id)), 2)
+
+    # test that the cached nutriments are replaced when database_update rewrites the product
+    @patch("products.management.commands.database_update.Command.openfoodfacts_api_get_product")
+    def test_productdetails_nutriments_invalidated_by_update(self, mock_get):
+        product = {
+            "url": "https://url.test.com/product",
+            "product_name": "Produit importé",
+            "nutrition_grades_tags": ["b"],
+            "categories_tags": ["en:meats"],
+            "nutriments": {"salt_100g": 1.5},
+        }
+        mock_get.return_value = [product]
+        with redirect_stdout(StringIO()):
+            call_command("database_update")
+        imported = Product.objects.get(name="Produit importé")
+        url = reverse("product-details", args=(imported.id,))
+        self.assertEqual(
+            self.client.get(url).context["product_nutriments"][0]["quantity"], 1.5
+        )
+
+        product["nutriments"] = {"salt_100g": 0.5}
+        with redirect_stdout(StringIO()):
+            call_command("database_update", "--full")
+        self.assertEqual(
+            self.client.get(url).context["product_nutriments"][0]["quantity"], 0.5
+        )
+
     # test that Product-Details page returns a status code 404, if product doesn't exist
     def test_searchresult_page_returns_404(self):
         product_id = self.test_product.id + 1
@@ -119,7 +348,7 @@ class ProductDetailsPage(TestCase):
 
 
 # Product save
-class ProductSave(TestCase):
+class ProductSave(QueryCountMixin, TestCase):
     def setUp(self):
         self.test_user = User.objects.create_user(
             username="testuser", password="test123+"
@@ -164,6 +393,89 @@ class ProductSave(TestCase):
         self.assertJSONEqual(response.content, expected_json)
         self.assertFalse(product_saved)
 
+    # test that Save-product toggles the relation with two queries, after the session and the user
+    def test_product_save_queries(self):
+        url = reverse("save-product", args=(self.test_product.id,))
+        for saved in [True, False]:
+            with self.assertMaxQueries(4):
+                response = self.client.get(url)
+            self.assertEqual(response.json()["saved"], saved)
+
+    # test that Save-product returns a JSON 404, if the product doesn't exist
+    def test_product_save_unknown_product(self):
+        response = self.client.get(
+            reverse("save-product", args=(self.test_product.id + 1,))
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertIn("error", response.json())
+
+    # test that Save-product returns a JSON 401, if the user is not authenticated
+    def test_product_save_anonymous(self):
+        self.client.logout()
+        response = self.client.get(
+            reverse("save-product", args=(self.test_product.id,))
+        )
+        self.assertEqual(response.status_code, 401)
+
+    # test that a product saved twice at once is saved once
+    def test_product_save_twice(self):
+        for _ in range(2):
+            ProductUsers.objects.bulk_create(
+                [ProductUsers(product=self.test_product, user=self.test_user)],
+                ignore_conflicts=True,
+            )
+        self.assertEqual(
+            ProductUsers.objects.filter(
+                product=self.test_product, user=self.test_user
+            ).count(),
+            1,
+        )
+
+    # test that Save-products saves then unsaves many products, and returns the unknown ids
+    def test_products_save_batch(self):
+        other_product = Product.objects.create(
+            name="Autre produit", url="autre.fr", nutri_score="b"
+        )
+        ProductUsers.objects.create(product=self.test_product, user=self.test_user)
+        product_ids = [self.test_product.id, other_product.id, other_product.id + 10]
+
+        response = self.client.post(
+            reverse("save-products"),
+            json.dumps({"product_ids": product_ids, "saved": True}),
+            content_type="application/json",
+        )
+        self.assertEqual(
+            response.json(),
+            {
+                "saved": True,
+                "product_ids": [self.test_product.id, other_product.id],
+                "unknown_ids": [other_product.id + 10],
+            },
+        )
+        self.assertEqual(ProductUsers.objects.filter(user=self.test_user).count(), 2)
+
+        with self.assertMaxQueries(4):
+            response = self.client.post(
+                reverse("save-products"),
+                json.dumps({"product_ids": product_ids, "saved": False}),
+                content_type="application/json",
+            )
+        self.assertFalse(response.json()["saved"])
+        self.assertFalse(ProductUsers.objects.filter(user=self.test_user).exists())
+
+    # test that Save-products returns a JSON 400, if the body is invalid
+    def test_products_save_batch_invalid(self):
+        for body in [
+            "not json",
+            json.dumps({"product_ids": ["a"], "saved": True}),
+            json.dumps({"product_ids": [1], "saved": "false"}),
+            json.dumps({"product_ids": list(range(101)), "saved": True}),
+        ]:
+            response = self.client.post(
+                reverse("save-products"), body, content_type="application/json"
+            )
+            self.assertEqual(response.status_code, 400)
+
 
 # User-create page
 class UserCreatePage(TestCase):
@@ -281,7 +593,7 @@ class UserLogoutView(TestCase):
 
 
 # User-result Page
-class UserResultPage(TestCase):
+class UserResultPage(QueryCountMixin, TestCase):
     def setUp(self):
         self.test_user = User.objects.create_user(
             username="testuser", password="test123+"
@@ -304,6 +616,25 @@ class UserResultPage(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.context["products"]), 0)
 
+    # test that the saved products are loaded with a constant number of queries
+    def test_userresult_page_queries(self):
+        def user_results():
+            response = self.client.get(reverse("product-user-results"))
+            self.assertEqual(response.status_code, 200)
+
+        def add_saved_products():
+            for number in range(10):
+                product = Product.objects.create(
+                    name="Produit {}".format(number), url="p-{}.fr".format(number)
+                )
+                ProductUsers.objects.create(product=product, user=self.test_user)
+
+        self.assertQueriesDoNotGrow(user_results, add_saved_products)
+
+        with self.assertMaxQueries(4):
+            response = self.client.get(reverse("product-user-results"))
+        self.assertEqual(len(response.context["products"]), 10)
+
 
 # User-details page
 class UserDetailsPage(TestCase):
@@ -356,3 +687,2091 @@ class CommandTest(TestCase):
         
         self.assertIsNotNone(response)
         self.assertTrue(mock_get.called)
+
+
+# Bulk ingestion of database_update
+class CommandBulkImportTest(TestCase):
+    def setUp(self):
+        self.products = [
+            {
+                "url": "https://url.test.com/1",
+                "image_url": "https://img.test.com/1.jpg",
+                "product_name": "produit test 1",
+                "nutrition_grades_tags": ["B"],
+                "categories_tags": ["en:meats", "fr:meats", "en:unknown"],
+                "nutriments": {"salt_100g": 1.5, "fat_100g": ""},
+            },
+            {
+                "url": "https://url.test.com/2",
+                "product_name": "",
+                "product_name_fr": "produit test 2",
+                "nutrition_grades_tags": ["not-applicable"],
+                "categories_tags": ["en:fishes"],
+                "nutriments": {},
+            },
+            # duplicated name, case insensitive
+            {
+                "url": "https://url.test.com/3",
+                "product_name": "PRODUIT TEST 1",
+                "categories_tags": [],
+            },
+            # no name at all
+            {"url": "https://url.test.com/4", "categories_tags": []},
+        ]
+
+    # test that database_update inserts products, categories and nutriments relations in bulk and skips duplicates
+    @patch("products.management.commands.database_update.Command.openfoodfacts_api_get_product")
+    def test_database_update_bulk_inserts_products(self, mock_get):
+        mock_get.return_value = self.products
+        call_command("database_update", stdout=StringIO())
+
+        self.assertEqual(Product.objects.count(), 2)
+        first_product = Product.objects.get(url="https://url.test.com/1")
+        second_product = Product.objects.get(url="https://url.test.com/2")
+        self.assertEqual(first_product.nutri_score, "b")
+        self.assertEqual(second_product.name, "produit test 2")
+        self.assertEqual(second_product.nutri_score, "e")
+        self.assertEqual(
+            list(first_product.categories.values_list("name", flat=True)), ["meats"]
+        )
+        self.assertEqual(first_product.nutriments.count(), Nutriment.objects.count())
+        self.assertEqual(
+            ProductNutriments.objects.get(
+                product=first_product, nutriment__name="salt"
+            ).quantity,
+            1.5,
+        )
+        self.assertIsNone(
+            ProductNutriments.objects.get(
+                product=first_product, nutriment__name="fat"
+            ).quantity
+        )
+
+    # test that database_update doesn't query the database for each product to find duplicates
+    @patch("products.management.commands.database_update.Command.openfoodfacts_api_get_product")
+    def test_database_update_queries_do_not_grow_with_products(self, mock_get):
+        mock_get.return_value = self.products
+        call_command("database_update", stdout=StringIO())
+        Product.objects.all().delete()
+
+        mock_get.return_value = [
+            {
+                "url": "https://url.test.com/many/{}".format(index),
+                "product_name": "produit {}".format(index),
+                "categories_tags": ["en:meats"],
+            }
+            for index in range(50)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            call_command("database_update", stdout=StringIO())
+
+        self.assertEqual(Product.objects.count(), 50)
+        self.assertLess(len(queries), 100)
+
+
+# Local stub of the Open Food Facts search API
+class OpenFoodFactsStub(BaseHTTPRequestHandler):
+    requests_count = 0
+    failures = 0
+    delay = 0
+    # (category, page) answered by a 503, or cut off in the middle of the body
+    failing_pages = set()
+    cut_pages = set()
+    requested = []
+
+    def do_GET(self):
+        OpenFoodFactsStub.requests_count += 1
+        query = parse_qs(urlparse(self.path).query)
+        category = query["search_terms"][0]
+        page = int(query["page"][0])
+        OpenFoodFactsStub.requested.append((category, page))
+        if OpenFoodFactsStub.failures > 0 or (category, page) in self.failing_pages:
+            OpenFoodFactsStub.failures = max(0, OpenFoodFactsStub.failures - 1)
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        time.sleep(OpenFoodFactsStub.delay)
+        products = [
+            {
+                "code": "{}{}{}".format(category, page, index),
+                "url": "https://stub.test/{}/{}/{}".format(category, page, index),
+                "product_name": "{} {} {}".format(category, page, index),
+                "nutrition_grades_tags": ["a"],
+                "categories_tags": ["en:" + category],
+                "nutriments": {"salt_100g": index},
+            }
+            for index in range(int(query["page_size"][0]))
+        ]
+        body = json.dumps({"page": page, "products": products}).encode()
+
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if (category, page) in self.cut_pages:
+                # the connection is lost after the first products
+                self.wfile.write(body[: len(body) // 2])
+                self.close_connection = True
+                return
+            self.wfile.write(body)
+        except ConnectionError:
+            # the client gave up waiting, on timeout tests
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class OpenFoodFactsStubMixin:
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub_server = ThreadingHTTPServer(("127.0.0.1", 0), OpenFoodFactsStub)
+        cls.stub_url = "http://127.0.0.1:{}/cgi/search.pl".format(
+            cls.stub_server.server_port
+        )
+        threading.Thread(target=cls.stub_server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub_server.shutdown()
+        cls.stub_server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        OpenFoodFactsStub.requests_count = 0
+        OpenFoodFactsStub.failures = 0
+        OpenFoodFactsStub.delay = 0
+        OpenFoodFactsStub.failing_pages = set()
+        OpenFoodFactsStub.cut_pages = set()
+        OpenFoodFactsStub.requested = []
+
+
+# Incremental JSON parser
+class IterJsonArrayTest(TestCase):
+    # test that the items of the array are decoded whatever the size of the chunks
+    def test_iter_json_array_with_small_chunks(self):
+        document = json.dumps(
+            {
+                "count": 3,
+                "products": [{"name": "a [1]"}, {"name": "b", "tags": ["x"]}, {}],
+                "page": 1,
+            },
+            indent=2,
+        )
+        chunks = [document[index : index + 3] for index in range(0, len(document), 3)]
+
+        self.assertEqual(
+            list(iter_json_array(chunks, "products")),
+            [{"name": "a [1]"}, {"name": "b", "tags": ["x"]}, {}],
+        )
+
+    # test that a truncated document raises an error after the last complete item
+    def test_iter_json_array_truncated_document(self):
+        document = '{"products": [{"name": "a"}, {"name": "b'
+        items = iter_json_array([document], "products")
+
+        self.assertEqual(next(items), {"name": "a"})
+        with self.assertRaises(ValueError):
+            next(items)
+
+
+# Open Food Facts client
+class OpenFoodFactsClientTest(OpenFoodFactsStubMixin, TestCase):
+    # test that the client returns the decoded page of products
+    def test_search_returns_products(self):
+        with OpenFoodFactsClient(base_url=self.stub_url) as client:
+            response = client.search("meats", page_size=3, page=2)
+
+        self.assertEqual(response["page"], 2)
+        self.assertEqual(len(response["products"]), 3)
+
+    # test that the client retries failed requests
+    def test_search_retries_on_server_error(self):
+        OpenFoodFactsStub.failures = 2
+        with OpenFoodFactsClient(
+            base_url=self.stub_url, retries=3, backoff_factor=0
+        ) as client:
+            response = client.search("meats", page_size=1)
+
+        self.assertIsNotNone(response)
+        self.assertEqual(OpenFoodFactsStub.requests_count, 3)
+
+    # test that the client returns None when the request times out
+    def test_search_returns_none_on_timeout(self):
+        OpenFoodFactsStub.delay = 0.5
+        with OpenFoodFactsClient(
+            base_url=self.stub_url, timeout=0.1, retries=0
+        ) as client:
+            response = client.search("meats", page_size=1)
+
+        self.assertIsNone(response)
+
+    # test that the products of a category are streamed page after page until the maximum is reached
+    def test_iter_products_iterates_over_pages(self):
+        pages = []
+        with OpenFoodFactsClient(base_url=self.stub_url) as client:
+            products = list(
+                client.iter_products(
+                    "meats",
+                    max_products=7,
+                    page_size=3,
+                    on_page=lambda *args: pages.append(args),
+                )
+            )
+
+        self.assertEqual(len(products), 7)
+        self.assertEqual(products[3]["url"], "https://stub.test/meats/2/0")
+        self.assertEqual(
+            pages, [("meats", 1, 3, 3), ("meats", 2, 3, 6), ("meats", 3, 1, 7)]
+        )
+
+    # test that the next page is requested while a page is read, and closed if it is not needed
+    def test_iter_products_prefetches_next_page(self):
+        class Page(list):
+            closed = False
+
+            def close(self):
+                self.closed = True
+
+        second_page_requested = threading.Event()
+        pages = {}
+
+        def open_page(category, page_size, page, sort_by=None):
+            if page == 2:
+                second_page_requested.set()
+            pages[page] = Page([{"page": page}] * (page_size if page < 3 else 1))
+            return pages[page]
+
+        with OpenFoodFactsClient(base_url=self.stub_url) as client:
+            products = client.iter_products("meats", None, 2, open_page=open_page)
+            self.assertEqual(next(products), {"page": 1})
+            # requested while the first page is read
+            self.assertTrue(second_page_requested.wait(1))
+            self.assertEqual(len(list(products)), 4)
+
+        # the page after the last one is requested in advance, then closed
+        for _ in range(10):
+            if 4 in pages and pages[4].closed:
+                break
+            time.sleep(0.05)
+        self.assertEqual(sorted(pages), [1, 2, 3, 4])
+        self.assertTrue(pages[4].closed)
+        self.assertFalse(pages[2].closed)
+
+    # test that a failed page ends the category with an error, not as a last page
+    def test_iter_products_failed_page(self):
+        OpenFoodFactsStub.failing_pages = {("meats", 2)}
+        products = []
+        with OpenFoodFactsClient(base_url=self.stub_url, retries=0) as client:
+            with self.assertRaises(OpenFoodFactsError):
+                for product in client.iter_products("meats", None, 3):
+                    products.append(product)
+
+        self.assertEqual(len(products), 3)
+
+    # test that a page cut off ends the category with an error, not as a short last page
+    def test_iter_products_cut_off_page(self):
+        OpenFoodFactsStub.cut_pages = {("meats", 2)}
+        products = []
+        with OpenFoodFactsClient(base_url=self.stub_url, retries=0) as client:
+            with self.assertRaises(OpenFoodFactsError):
+                for product in client.iter_products("meats", None, 4):
+                    products.append(product)
+
+        self.assertGreaterEqual(len(products), 4)
+        self.assertLess(len(products), 8)
+
+    # test that the categories are fetched concurrently and yielded in categories order
+    def test_fetch_categories_runs_requests_concurrently(self):
+        OpenFoodFactsStub.delay = 0.2
+        with OpenFoodFactsClient(base_url=self.stub_url, concurrency=3) as client:
+            start = time.perf_counter()
+            results = [
+                (category, [product["url"] for product in products])
+                for category, products in client.fetch_categories(
+                    lambda category: client.iter_products(category, 4, 2),
+                    ["meats", "fishes", "desserts"],
+                    queue_size=1,
+                )
+            ]
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual(
+            [category for category, urls in results], ["meats", "fishes", "desserts"]
+        )
+        self.assertEqual(
+            results[1][1],
+            [
+                "https://stub.test/fishes/1/0",
+                "https://stub.test/fishes/1/1",
+                "https://stub.test/fishes/2/0",
+                "https://stub.test/fishes/2/1",
+            ],
+        )
+        self.assertLess(elapsed, 6 * 0.2)
+
+    # test that database_update imports every page of every category from the API
+    def test_database_update_against_stub(self):
+        with self.settings(OFF_SEARCH_URL=self.stub_url):
+            call_command(
+                "database_update",
+                products=10,
+                page_size=5,
+                concurrency=3,
+                stdout=StringIO(),
+            )
+
+        self.assertEqual(OpenFoodFactsStub.requests_count, 12)
+        self.assertEqual(Product.objects.count(), 60)
+        self.assertEqual(
+            ProductCategories.objects.filter(category__name="meats").count(), 10
+        )
+
+
+# Custom manage.py command database_import
+class CommandDatabaseImportTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write_dump(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w", encoding="utf-8") as dump_file:
+            dump_file.write(content)
+        return path
+
+    # test that database_import inserts the products of the categories of the site from a JSONL dump
+    def test_database_import_jsonl(self):
+        lines = [
+            {
+                "code": "123",
+                "product_name": "Pâté de test",
+                "image_front_url": "https://img.test.com/123.jpg",
+                "nutrition_grades_tags": ["d"],
+                "categories_tags": ["en:meats"],
+                "nutriments": {"salt_100g": 2},
+            },
+            {
+                "code": "456",
+                "product_name": "Hors catégorie",
+                "categories_tags": ["en:cleaning-products"],
+            },
+        ]
+        path = self.write_dump(
+            "products.jsonl",
+            "\n".join(json.dumps(line) for line in lines) + "\nnot json\n",
+        )
+
+        out = StringIO()
+        with redirect_stdout(StringIO()) as printed:
+            call_command("database_import", path, stdout=out)
+
+        # reported through the import logger, on the stdout of the command
+        self.assertIn("2 products read, 1 inserted, 0 updated", out.getvalue())
+        self.assertEqual(printed.getvalue(), "")
+        product = Product.objects.get()
+        self.assertEqual(product.name, "Pâté de test")
+        self.assertEqual(product.url, "https://fr-en.openfoodfacts.org/product/123")
+        self.assertEqual(product.image_url, "https://img.test.com/123.jpg")
+        self.assertEqual(product.nutri_score, "d")
+        self.assertEqual(list(product.categories.values_list("name", flat=True)), ["meats"])
+        self.assertEqual(
+            ProductNutriments.objects.get(product=product, nutriment__name="salt").quantity,
+            2,
+        )
+
+    # test that database_import inserts the products of a tab-separated CSV export
+    def test_database_import_csv(self):
+        path = self.write_dump(
+            "products.csv",
+            "code\turl\tproduct_name\timage_url\tnutriscore_grade\tcategories_tags\tfat_100g\tsalt_100g\n"
+            "1\thttps://off.test/1\tPoisson pané\t\tb\ten:fishes,en:frozen-foods\t7.5\t\n"
+            "2\thttps://off.test/2\t\t\tc\ten:fishes\t\t\n"
+            "3\thttps://off.test/3\tSoda\t\t\ten:beverages\t0\t0.1\n",
+        )
+
+        call_command("database_import", path, stdout=StringIO())
+
+        self.assertEqual(Product.objects.count(), 2)
+        fish = Product.objects.get(url="https://off.test/1")
+        soda = Product.objects.get(url="https://off.test/3")
+        self.assertEqual(fish.nutri_score, "b")
+        self.assertIsNone(fish.image_url)
+        self.assertEqual(soda.nutri_score, "e")
+        self.assertEqual(
+            ProductNutriments.objects.get(product=fish, nutriment__name="fat").quantity,
+            7.5,
+        )
+        self.assertIsNone(
+            ProductNutriments.objects.get(product=fish, nutriment__name="salt").quantity
+        )
+
+    # test that database_import raises an error if the dump doesn't exist
+    def test_database_import_missing_file(self):
+        with self.assertRaises(CommandError):
+            call_command("database_import", "/missing/products.jsonl", stdout=StringIO())
+
+
+# Delta sync of database_update
+class CommandDeltaSyncTest(TestCase):
+    def make_product(self, index, last_modified_t, nutri_score="c", salt=1):
+        return {
+            "url": "https://url.test.com/{}".format(index),
+            "product_name": "produit delta {}".format(index),
+            "nutrition_grades_tags": [nutri_score],
+            "categories_tags": ["en:meats"],
+            "nutriments": {"salt_100g": salt},
+            "last_modified_t": last_modified_t,
+        }
+
+    def run_update(self, mock_get, api_products, **options):
+        mock_get.reset_mock()
+        mock_get.side_effect = lambda category, *args: (
+            api_products if category == "meats" else []
+        )
+        out = StringIO()
+        with redirect_stdout(out):
+            call_command("database_update", **options)
+        return out.getvalue()
+
+    # test that the first run imports every product and saves the last modification per category
+    @patch("products.management.commands.database_update.Command.openfoodfacts_api_get_product")
+    def test_first_sync_saves_category_state(self, mock_get):
+        self.run_update(
+            mock_get, [self.make_product(1, 1000), self.make_product(2, 2000)]
+        )
+
+        self.assertEqual(Product.objects.count(), 2)
+        sync = CategorySync.objects.get(category__name="meats")
+        self.assertEqual(sync.last_modified_t, 2000)
+        self.assertIsNotNone(sync.last_sync)
+
+    # test that the next run only reads the products modified since the last sync and updates the changed ones
+    @patch("products.management.commands.database_update.Command.openfoodfacts_api_get_product")
+    def test_delta_sync_updates_changed_products(self, mock_get):
+        self.run_update(
+            mock_get, [self.make_product(1, 1000), self.make_product(2, 2000)]
+        )
+
+        output = self.run_update(
+            mock_get,
+            [
+                self.make_product(2, 3000, nutri_score="a", salt=0.2),
+                self.make_product(3, 2500),
+                # older than the last sync, never read
+                self.make_product(1, 1000, nutri_score="e"),
+            ],
+        )
+
+        meats_calls = [
+            call for call in mock_get.call_args_list if call[0][0] == "meats"
+        ]
+        self.assertEqual(meats_calls[0][0][4], "last_modified_t")
+        self.assertIn("1 products inserted, 1 updated, 0 skipped", output)
+
+        updated_product = Product.objects.get(url="https://url.test.com/2")
+        self.assertEqual(updated_product.nutri_score, "a")
+        self.assertEqual(updated_product.last_modified_t, 3000)
+        self.assertEqual(
+            ProductNutriments.objects.get(
+                product=updated_product, nutriment__name="salt"
+            ).quantity,
+            0.2,
+        )
+        self.assertEqual(updated_product.categories.count(), 1)
+        self.assertEqual(
+            Product.objects.get(url="https://url.test.com/1").nutri_score, "c"
+        )
+        self.assertEqual(
+            CategorySync.objects.get(category__name="meats").last_modified_t, 3000
+        )
+
+    # test that a delta sync imports every changed product, whatever the maximum number of products
+    @patch("products.management.commands.database_update.Command.openfoodfacts_api_get_product")
+    def test_delta_sync_not_truncated(self, mock_get):
+        self.run_update(
+            mock_get, [self.make_product(1, 1000), self.make_product(2, 2000)], products=2
+        )
+
+        self.run_update(
+            mock_get,
+            [
+                self.make_product(3, 5000),
+                self.make_product(4, 4000),
+                self.make_product(5, 3000),
+                self.make_product(1, 1000, nutri_score="e"),
+            ],
+            products=2,
+        )
+
+        self.assertEqual(Product.objects.count(), 5)
+        self.assertEqual(
+            CategorySync.objects.get(category__name="meats").last_modified_t, 5000
+        )
+
+    # test that the last modification is only saved once the category is read to the end, the next sync gets the products of a failed page
+    @patch("products.management.commands.database_update.Command.openfoodfacts_api_get_product")
+    def test_delta_sync_failed_page(self, mock_get):
+        self.run_update(mock_get, [self.make_product(1, 1000)])
+
+        changed = [
+            self.make_product(5, 5000),
+            self.make_product(4, 4000),
+            self.make_product(3, 3000),
+            self.make_product(1, 1000, nutri_score="e"),
+        ]
+        pages = {1: changed[:2], 2: None}
+        mock_get.side_effect = lambda category, page_size, user_agent, page, sort_by: (
+            pages[page] if category == "meats" else []
+        )
+        with self.assertRaises(CommandError), redirect_stdout(StringIO()):
+            call_command("database_update", page_size=2)
+
+        self.assertEqual(Product.objects.count(), 3)
+        self.assertEqual(
+            CategorySync.objects.get(category__name="meats").last_modified_t, 1000
+        )
+
+        pages[2] = changed[2:]
+        with redirect_stdout(StringIO()):
+            call_command("database_update", page_size=2)
+
+        self.assertEqual(Product.objects.count(), 4)
+        self.assertEqual(
+            CategorySync.objects.get(category__name="meats").last_modified_t, 5000
+        )
+
+    # test that a full run skips the products whose content didn't change
+    @patch("products.management.commands.database_update.Command.openfoodfacts_api_get_product")
+    def test_full_sync_skips_unchanged_products(self, mock_get):
+        products = [self.make_product(1, 1000), self.make_product(2, 2000)]
+        self.run_update(mock_get, products)
+
+        output = self.run_update(mock_get, products, full=True)
+
+        self.assertIsNone(mock_get.call_args[0][4])
+        self.assertIn("0 products inserted, 0 updated, 2 skipped", output)
+
+
+# Product search
+class ProductSearchTest(TestCase):
+    def setUp(self):
+        self.pate = Product.objects.create(
+            name="Pâté de campagne", url="pate.fr", nutri_score="d"
+        )
+        self.pate_bio = Product.objects.create(
+            name="Pâté de campagne bio au poivre vert", url="pate-bio.fr", nutri_score="c"
+        )
+        self.creme = Product.objects.create(
+            name="Crème brûlée", url="creme.fr", nutri_score="e"
+        )
+        invalidate_search_index()
+
+    # test that the search text is normalized without accents, case and punctuation
+    def test_normalize_search_text(self):
+        self.assertEqual(normalize_search_text("  Crème-Brûlée  BIO! "), "creme brulee bio")
+        self.assertEqual(self.creme.search_name, "creme brulee")
+
+    # test that the trigram lookup of PostgreSQL is registered once, when the app is loaded
+    def test_trigram_lookup_registered_at_startup(self):
+        if connection.vendor != "postgresql":
+            self.skipTest("The trigram lookup is only registered on PostgreSQL")
+        with patch.object(CharField, "register_lookup") as register_lookup:
+            self.assertEqual(search_product("creme"), self.creme)
+        register_lookup.assert_not_called()
+        self.assertIsNotNone(CharField.get_lookup("trigram_similar"))
+
+    # test that the search ignores accents and case and returns the best match first
+    def test_search_product_accent_insensitive_ranking(self):
+        self.assertEqual(search_product("pate de CAMPAGNE"), self.pate)
+        self.assertEqual(search_product("poivre vert"), self.pate_bio)
+        self.assertEqual(search_product("creme brulee"), self.creme)
+
+    # test that the search tolerates typos and returns None if nothing is close enough
+    def test_search_product_similar_names(self):
+        self.assertEqual(search_product("creme brullee"), self.creme)
+        self.assertIsNone(search_product("azerty"))
+        self.assertIsNone(search_product("!!"))
+
+    # test that short texts inside a word are found, like name__icontains
+    def test_search_product_short_text(self):
+        self.assertEqual(search_product("ul"), self.creme)
+
+    # test that the in-memory index is kept without querying the products, and rebuilt when the version of the catalog changes
+    def test_search_index_follows_catalog_version(self):
+        index = get_search_index()
+        rillettes = Product.objects.create(
+            name="Rillettes du Mans", url="rillettes.fr", nutri_score="e"
+        )
+        with self.assertNumQueries(0):
+            self.assertIs(get_search_index(), index)
+
+        # bumped by the imports of the cron job, in the shared cache
+        bump_catalog_version()
+        self.assertEqual(get_search_index().search("rillettes"), [rillettes.id])
+
+    # test that the index ranks the products containing the text first, then by similarity
+    def test_search_index_ranking(self):
+        index = ProductSearchIndex(
+            [
+                (1, "Pâté de campagne bio", "pate de campagne bio"),
+                (2, "Pâté de campagne", "pate de campagne"),
+                (3, "Pâtes", "pates"),
+            ]
+        )
+        self.assertEqual(index.search("pate de campagne"), [2, 1])
+        self.assertEqual(len(index), 3)
+
+
+# Autocomplete endpoint
+class AutocompleteTest(TestCase):
+    def setUp(self):
+        self.pate = Product.objects.create(
+            name="Pâté de campagne", url="pate.fr", nutri_score="d"
+        )
+        self.pate_bio = Product.objects.create(
+            name="Pâté de campagne bio", url="pate-bio.fr", nutri_score="c"
+        )
+        self.campari = Product.objects.create(
+            name="Campari", url="campari.fr", nutri_score="e"
+        )
+        invalidate_search_index()
+
+    # test that the endpoint returns the products whose words start like the text, the best first
+    def test_autocomplete_returns_json_suggestions(self):
+        response = self.client.get(reverse("product-autocomplete"), {"q": "pâté de camp"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json()["results"],
+            [
+                {
+                    "id": self.pate.id,
+                    "name": "Pâté de campagne",
+                    "url": reverse("product-details", args=(self.pate.id,)),
+                },
+                {
+                    "id": self.pate_bio.id,
+                    "name": "Pâté de campagne bio",
+                    "url": reverse("product-details", args=(self.pate_bio.id,)),
+                },
+            ],
+        )
+
+    # test that a prefix of any word of the name matches
+    def test_autocomplete_word_prefix(self):
+        names = [name for product_id, name in autocomplete("CAMP")]
+
+        self.assertEqual(names[0], "Campari")
+        self.assertEqual(set(names), {"Campari", "Pâté de campagne", "Pâté de campagne bio"})
+
+    # test that a too short text returns no suggestions
+    def test_autocomplete_short_text(self):
+        response = self.client.get(reverse("product-autocomplete"), {"q": "p"})
+        self.assertEqual(response.json()["results"], [])
+
+    # test that the script of the search forms gets the minimum length of the server
+    @override_settings(AUTOCOMPLETE_MIN_LENGTH=3)
+    def test_autocomplete_min_length_in_page(self):
+        cache.clear()
+        self.assertContains(self.client.get(reverse("home")), 'data-min-length="3"')
+
+    # test that the suggestions don't query the database once the index is built
+    def test_autocomplete_without_queries(self):
+        autocomplete("camp")
+        with self.assertNumQueries(0):
+            self.assertEqual(len(autocomplete("campag")), 2)
+
+    # test that the index is refreshed at the end of database_update
+    @patch("products.management.commands.database_update.Command.openfoodfacts_api_get_product")
+    def test_autocomplete_refreshed_by_database_update(self, mock_get):
+        autocomplete("camp")
+        mock_get.return_value = [
+            {
+                "url": "https://url.test.com/rillettes",
+                "product_name": "Rillettes de campagne",
+                "categories_tags": ["en:meats"],
+            }
+        ]
+        with redirect_stdout(StringIO()):
+            call_command("database_update")
+
+        self.assertIn("Rillettes de campagne", [name for product_id, name in autocomplete("rill")])
+
+    # test that the packed strings find every string containing a text
+    def test_packed_strings(self):
+        strings = PackedStrings(["abc", "", "bcd", "xbc"])
+
+        self.assertEqual(len(strings), 4)
+        self.assertEqual(strings[2], "bcd")
+        self.assertEqual(strings[1], "")
+        self.assertEqual(list(strings.find("bc")), [0, 2, 3])
+
+
+# Precomputed substitutes
+class SubstitutesTest(TestCase):
+    def setUp(self):
+        self.fat = Nutriment.objects.create(name="fat", unit="g")
+        self.spreads = Category.objects.create(name="spreads")
+        self.sweet = Category.objects.create(name="sweet-spreads")
+
+        self.product = self.create_product("Pâte à tartiner", "c", 30, both=True)
+        self.best = self.create_product("Purée d'amande", "a", 50)
+        self.light = self.create_product("Pâte légère", "b", 10, both=True)
+        self.fatty = self.create_product("Pâte grasse", "b", 40, both=True)
+        self.other = self.create_product("Confiture", "b", 1)
+        self.unknown = self.create_product("Sans score", "", 1, both=True)
+
+    def create_product(self, name, nutri_score, fat, both=False):
+        product = Product.objects.create(
+            name=name, url=name + ".fr", nutri_score=nutri_score
+        )
+        ProductCategories.objects.create(product=product, category=self.spreads)
+        if both:
+            ProductCategories.objects.create(product=product, category=self.sweet)
+        ProductNutriments.objects.create(
+            product=product, nutriment=self.fat, quantity=fat
+        )
+        return product
+
+    # test that the substitutes are ranked by nutri-score, shared categories then nutriments
+    def test_compute_substitutes_ranking(self):
+        self.assertEqual(compute_substitutes(nb_substitutes=12), 30)
+
+        self.assertEqual(
+            get_substitutes(self.product),
+            [self.best, self.light, self.fatty, self.other, self.unknown],
+        )
+        self.assertEqual(
+            list(
+                ProductSubstitute.objects.filter(product=self.product)
+                .order_by("rank")
+                .values_list("rank", flat=True)
+            ),
+            [0, 1, 2, 3, 4],
+        )
+
+    # test that the number of substitutes per product is limited
+    def test_compute_substitutes_limit(self):
+        compute_substitutes(nb_substitutes=2)
+        self.assertEqual(get_substitutes(self.product), [self.best, self.light])
+
+    # test that the precomputed substitutes are read in a single query
+    def test_get_substitutes_single_query(self):
+        compute_substitutes()
+        with self.assertNumQueries(1):
+            get_substitutes(self.product)
+
+    # test that a product without precomputed substitutes falls back on its category,
+    # the products without nutrition score last
+    def test_get_substitutes_fallback(self):
+        substitutes = get_substitutes(self.product)
+        self.assertEqual(len(substitutes), 5)
+        self.assertEqual(substitutes[0], self.best)
+        self.assertEqual(substitutes[-1], self.unknown)
+        self.assertNotIn(self.product, substitutes)
+
+    # test that the substitutes are computed again by database_import
+    def test_database_import_computes_substitutes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "dump.jsonl")
+            with open(path, "w") as dump:
+                dump.write(json.dumps({"code": "1", "product_name": "x"}) + "\n")
+            with redirect_stdout(StringIO()):
+                call_command("database_import", path)
+
+        self.assertEqual(get_substitutes(self.other)[0], self.best)
+        self.assertEqual(ProductSubstitute.objects.count(), 30)
+
+
+# Cache of the pages and searches
+class CatalogCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(
+            name="Produit test", url="test.fr", nutri_score="c"
+        )
+        self.substitute = Product.objects.create(
+            name="Substitut produit test", url="test-sub.fr", nutri_score="a"
+        )
+        category = Category.objects.create(name="test-category")
+        ProductCategories.objects.create(product=self.product, category=category)
+        ProductCategories.objects.create(product=self.substitute, category=category)
+        self.url = reverse("product-details", args=(self.product.id,))
+
+    # test that an import bumps the version of the catalog once, not once per batch
+    @patch("products.management.commands.database_update.Command.openfoodfacts_api_get_product")
+    def test_import_bumps_version_once(self, mock_get):
+        mock_get.return_value = [
+            {
+                "url": "https://url.test.com/bump/{}".format(index),
+                "product_name": "produit bump {}".format(index),
+                "categories_tags": ["en:meats"],
+            }
+            for index in range(10)
+        ]
+        get_catalog_version()
+        with patch("products.cache.time") as cache_time:
+            cache_time.time_ns.return_value = 1
+            call_command("database_update", batch_size=2, stdout=StringIO())
+
+        self.assertEqual(cache_time.time_ns.call_count, 1)
+        self.assertEqual(get_catalog_version(), 1)
+
+    # test that the anonymous pages are served from the cache, without a csrf token
+    # (the search form is sent with a GET request)
+    def test_anonymous_page_cached(self):
+        first = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            second = self.client_class(enforce_csrf_checks=True).get(self.url)
+
+        self.assertEqual(second.status_code, 200)
+        self.assertContains(second, "Produit test")
+        self.assertNotIn(b"csrfmiddlewaretoken", second.content)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(second.cookies, {})
+
+    # test that a page sending a cookie is neither cached nor public
+    def test_page_with_cookie_not_cached(self):
+        calls = []
+
+        class TokenView(CatalogConditionalMixin, AnonymousPageCacheMixin, View):
+            def get(self, request):
+                calls.append(request)
+                return HttpResponse(get_token(request))
+
+        for _ in range(2):
+            request = RequestFactory().get("/token")
+            request.user = AnonymousUser()
+            response = TokenView.as_view()(request)
+            self.assertNotIn("public", response.get("Cache-Control", ""))
+
+        self.assertEqual(len(calls), 2)
+
+    # test that the pages of the authenticated users are not cached
+    def test_authenticated_page_not_cached(self):
+        User.objects.create_user(username="testuser", password="test123+")
+        self.client.login(username="testuser", password="test123+")
+
+        self.client.get(self.url)
+        response = self.client.get(self.url)
+        self.assertIsNotNone(response.context)
+
+    # test that changing a product from the admin site invalidates the cached pages
+    def test_product_change_invalidates_pages(self):
+        User.objects.create_superuser(username="admin", password="test123+")
+        self.client.login(username="admin", password="test123+")
+        version = get_catalog_version()
+
+        response = self.client.post(
+            reverse("admin:products_product_delete", args=(self.substitute.id,)),
+            {"post": "yes"},
+        )
+
+        self.assertEqual(response.status_code, 302)
+        self.assertNotEqual(get_catalog_version(), version)
+
+    # test that the bulk deletes of the relations of the products are not slowed by signals
+    def test_catalog_relations_fast_deleted(self):
+        version = get_catalog_version()
+        with self.assertNumQueries(1):
+            ProductCategories.objects.filter(product=self.product).delete()
+        self.assertEqual(get_catalog_version(), version)
+
+    # test that the version of the catalog expires from a process memory cache only
+    def test_catalog_version_timeout(self):
+        self.assertIsNone(catalog_version_timeout())
+        locmem = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+        with override_settings(CACHES=locmem, CATALOG_VERSION_LOCAL_TIMEOUT=60):
+            self.assertEqual(catalog_version_timeout(), 60)
+
+    def test_search_cached_per_normalized_text(self):
+        search_url = reverse("product-search-results")
+        self.client.post(search_url, {"product_name": "Produit test"})
+
+        with self.assertNumQueries(0):
+            response = self.client.post(search_url, {"product_name": "produit  TEST !"})
+        self.assertEqual(response.context["searched_product"], self.product)
+        self.assertEqual(response.context["products"], [self.substitute])
+
+        bump_catalog_version()
+        with CaptureQueriesContext(connection) as context:
+            self.client.post(search_url, {"product_name": "produit test"})
+        self.assertGreater(len(context), 0)
+
+    # test that database_import bumps the version of the catalog
+    def test_import_bumps_catalog_version(self):
+        version = get_catalog_version()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "dump.jsonl")
+            with open(path, "w") as dump:
+                dump.write(json.dumps({"code": "1", "product_name": "x"}) + "\n")
+            with redirect_stdout(StringIO()):
+                call_command("database_import", path)
+
+        self.assertNotEqual(get_catalog_version(), version)
+
+
+# Views under concurrent requests
+class ConcurrentRequestsTest(TransactionTestCase):
+    letters = "abcdefgh"
+
+    def setUp(self):
+        cache.clear()
+        self.clients = {}
+        for letter in self.letters:
+            product = Product.objects.create(
+                name="Produit concurrent " + letter,
+                url="concurrent-{}.fr".format(letter),
+                nutri_score="c",
+            )
+            category = Category.objects.create(name="concurrent-" + letter)
+            ProductCategories.objects.create(product=product, category=category)
+            user = User.objects.create_user(
+                username="user-" + letter, password="test123+", first_name="Nom" + letter
+            )
+            ProductUsers.objects.create(product=product, user=user)
+            client = self.client_class()
+            client.login(username="user-" + letter, password="test123+")
+            self.clients[letter] = client
+        invalidate_search_index()
+
+    def request_pages(self, letter: str, errors: list):
+        """Search the product of the letter and show the saved products of
+        its user, and record any page showing the data of another letter"""
+        client = self.clients[letter]
+        others = ["Produit concurrent " + other for other in self.letters if other != letter]
+        try:
+            for _ in range(10):
+                pages = [
+                    client.post(
+                        reverse("product-search-results"),
+                        {"product_name": "Produit concurrent " + letter},
+                    ),
+                    client.get(reverse("product-user-results")),
+                ]
+                for page in pages:
+                    content = page.content.decode()
+                    if "Produit concurrent " + letter not in content or any(
+                        other in content for other in others
+                    ):
+                        errors.append((letter, page.request["PATH_INFO"]))
+                if "Salut Nom{} !".format(letter) not in pages[1].content.decode():
+                    errors.append((letter, "title"))
+        except Exception as error:
+            errors.append((letter, repr(error)))
+        finally:
+            connections.close_all()
+
+    # test that parallel requests don't see the products and titles of each other
+    def test_parallel_requests_without_cross_talk(self):
+        errors = []
+        threads = [
+            threading.Thread(target=self.request_pages, args=(letter, errors))
+            for letter in self.letters
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+
+# Async views
+def reload_urls():
+    import products.urls
+    import pureBeurreOC.urls
+
+    importlib.reload(products.urls)
+    importlib.reload(pureBeurreOC.urls)
+    clear_url_caches()
+
+
+@contextmanager
+def async_views_urls():
+    """Serve the async views like the ASGI server, with the middlewares of
+    the settings without DEBUG"""
+    middleware = [
+        name for name in settings.MIDDLEWARE if not name.startswith("debug_toolbar.")
+    ]
+    try:
+        with override_settings(ASYNC_VIEWS=True, MIDDLEWARE=middleware):
+            reload_urls()
+            yield
+    finally:
+        reload_urls()
+
+
+class AsyncViewsTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.product = Product.objects.create(
+            name="Produit test", url="test.fr", nutri_score="c"
+        )
+        self.substitute = Product.objects.create(
+            name="Substitut produit test", url="test-sub.fr", nutri_score="a"
+        )
+        category = Category.objects.create(name="test-category")
+        ProductCategories.objects.create(product=self.product, category=category)
+        ProductCategories.objects.create(product=self.substitute, category=category)
+        self.user = User.objects.create_user(username="testuser", password="test123+")
+        invalidate_search_index()
+
+    def search_request(self, text: str):
+        request = self.factory.post(
+            reverse("product-search-results"), {"product_name": text}
+        )
+        request.user = AnonymousUser()
+        return request
+
+    # test that the async search view renders the same page as the sync one
+    def test_search_result_async(self):
+        response = async_to_sync(search_result_async)(self.search_request("Produit test"))
+
+        self.assertTrue(asyncio.iscoroutinefunction(search_result_async))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Substitut produit test")
+
+    # test that slow searches served through the middlewares run in parallel
+    @patch("products.views.search_product")
+    def test_search_result_async_concurrent(self, mock_search):
+        def slow_search(text):
+            time.sleep(0.3)
+            return None
+
+        mock_search.side_effect = slow_search
+
+        async def search_all():
+            client = AsyncClient()
+            return await asyncio.gather(
+                *[
+                    client.get(
+                        "{}?q=recherche+{}".format(
+                            reverse("product-search-results"), number
+                        )
+                    )
+                    for number in range(4)
+                ]
+            )
+
+        with async_views_urls():
+            start = time.perf_counter()
+            responses = async_to_sync(search_all)()
+            elapsed = time.perf_counter() - start
+
+        self.assertLess(elapsed, 0.9)
+        self.assertEqual([response.status_code for response in responses], [200] * 4)
+        self.assertEqual(mock_search.call_count, 4)
+
+    # test that the middlewares served without DEBUG are async capable
+    def test_middlewares_async_capable(self):
+        with async_views_urls():
+            for name in settings.MIDDLEWARE:
+                with self.subTest(middleware=name):
+                    self.assertTrue(getattr(import_string(name), "async_capable", False))
+
+    # test that the profiling middleware measures the queries and the profile of the async views
+    @override_settings(PROFILING_SAMPLE_RATE=1.0)
+    def test_async_views_profiled(self):
+        profiling_store.clear()
+        with async_views_urls():
+            response = async_to_sync(AsyncClient().get)(
+                reverse("product-details", args=(self.product.id,))
+            )
+
+        self.assertEqual(response.status_code, 200)
+        report = profiling_store.report()
+        view = report["views"][0]
+        self.assertEqual(view["view"], "product-details")
+        self.assertGreater(view["queries_mean"], 0)
+        self.assertGreater(view["template_mean_ms"], 0)
+        self.assertIn("products/views.py", report["profiles"][0]["profile"])
+
+    # test that the async save view saves the product of the user
+    def test_user_save_product_async(self):
+        request = self.factory.get(reverse("save-product", args=(self.product.id,)))
+        request.user = self.user
+        response = async_to_sync(user_save_product_async)(request, product_id=self.product.id)
+
+        self.assertTrue(json.loads(response.content)["saved"])
+        self.assertTrue(
+            ProductUsers.objects.filter(product=self.product, user=self.user).exists()
+        )
+
+    # test that the async details view returns the product or raises a 404
+    def test_product_details_async(self):
+        request = self.factory.get(reverse("product-details", args=(self.product.id,)))
+        request.user = AnonymousUser()
+        response = async_to_sync(product_details_async)(request, product_id=self.product.id)
+        self.assertContains(response, "Produit test")
+
+        request = self.factory.get(reverse("product-details", args=(self.product.id + 10,)))
+        request.user = AnonymousUser()
+        with self.assertRaises(Http404):
+            async_to_sync(product_details_async)(request, product_id=self.product.id + 10)
+
+
+# Indexes and constraints of the tables
+class DatabaseIndexesTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="test123+")
+        self.product = Product.objects.create(
+            name="Produit test", url="test.fr", nutri_score="c"
+        )
+        self.nutriment = Nutriment.objects.create(name="salt", unit="g")
+        self.category = Category.objects.create(name="test-category")
+
+    def assertUsesIndex(self, queryset, sqlite_plan: str, index_name: str):
+        """Check the plan of the query, from EXPLAIN, uses the index"""
+        if connection.vendor == "postgresql":
+            # the tables of the tests are too small for the planner
+            with connection.cursor() as cursor:
+                cursor.execute("SET enable_seqscan = off")
+            plan = queryset.explain()
+            with connection.cursor() as cursor:
+                cursor.execute("RESET enable_seqscan")
+            self.assertIn(index_name, plan)
+        elif connection.vendor == "sqlite":
+            self.assertIn(sqlite_plan, queryset.explain())
+        else:
+            self.skipTest("No expected plan for {}".format(connection.vendor))
+
+    # test that the lookup of a saved product uses the unique (user, product) index
+    def test_product_users_lookup_plan(self):
+        self.assertUsesIndex(
+            ProductUsers.objects.filter(product=self.product, user=self.user),
+            "(user_id=? AND product_id=?)",
+            "unique_user_product",
+        )
+
+    # test that the nutriments of a product are read with the unique (product, nutriment) index
+    def test_product_nutriments_lookup_plan(self):
+        self.assertUsesIndex(
+            ProductNutriments.objects.filter(
+                product=self.product, nutriment=self.nutriment
+            ),
+            "(product_id=? AND nutriment_id=?)",
+            "unique_product_nutriment",
+        )
+
+    # test that the ordering on the nutrition score uses its index
+    def test_nutri_score_ordering_plan(self):
+        self.assertUsesIndex(
+            Product.objects.order_by("nutri_score")[:12],
+            "products_pr_nutri_s_c94bf3_idx",
+            "products_pr_nutri_s_c94bf3_idx",
+        )
+
+    # test that the relations can't be duplicated
+    def test_unique_relations(self):
+        ProductUsers.objects.create(product=self.product, user=self.user)
+        ProductNutriments.objects.create(
+            product=self.product, nutriment=self.nutriment, quantity=1
+        )
+        ProductCategories.objects.create(product=self.product, category=self.category)
+
+        for model, fields in [
+            (ProductUsers, {"user": self.user}),
+            (ProductNutriments, {"nutriment": self.nutriment, "quantity": 2}),
+            (ProductCategories, {"category": self.category}),
+        ]:
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                model.objects.create(product=self.product, **fields)
+
+
+# Benchmark harness
+class BenchmarkTest(TestCase):
+    # test that the products of the dump are scaled with unique names and urls
+    def test_scaled_products(self):
+        dump_products = load_dump_products()
+        products = list(
+            iter_scaled_products(dump_products, len(dump_products) * 2 + 1)
+        )
+
+        self.assertEqual(
+            len({product["product_name"] for product in products}), len(products)
+        )
+        self.assertEqual(len({product["url"] for product in products}), len(products))
+        self.assertTrue(any(product["nutriments"] for product in dump_products))
+
+    # test the nearest rank percentiles
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile([3], 95), 3)
+
+    # test that the benchmark measures every view and database_update
+    def test_run_benchmark(self):
+        cache.clear()
+        results = run_benchmark(products=100, requests=3, update_products=5)
+
+        self.assertEqual(
+            Product.objects.count(), 100 + 5 * len(settings.PRODUCTS_CATEGORIES)
+        )
+        self.assertEqual(
+            set(results["views"]),
+            {"SearchResult", "ProductDetails", "UserResults", "UserSaveProduct"},
+        )
+        for view_results in results["views"].values():
+            self.assertEqual(view_results["requests"], 3)
+            self.assertLessEqual(view_results["p50_ms"], view_results["p95_ms"])
+            self.assertGreater(view_results["queries_max"], 0)
+        self.assertEqual(results["database_update"]["inserted_products"], 30)
+        json.dumps(results)
+
+
+# Profiling middleware
+class ProfilingTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        profiling_store.clear()
+        self.product = Product.objects.create(
+            name="Produit test", url="test.fr", nutri_score="c"
+        )
+        self.url = reverse("product-details", args=(self.product.id,))
+
+    # test that a sampled request is profiled and logged with its queries and template time
+    @override_settings(PROFILING_SAMPLE_RATE=1.0)
+    def test_sampled_request_profiled(self):
+        with self.assertLogs("products.profiling", "INFO") as logs:
+            self.client.get(self.url)
+
+        self.assertIn("view=product-details status=200", logs.output[0])
+        self.assertIn("profiled=1", logs.output[0])
+
+        report = profiling_store.report()
+        view = report["views"][0]
+        self.assertEqual(view["view"], "product-details")
+        self.assertEqual(view["requests"], 1)
+        self.assertGreater(view["queries_mean"], 0)
+        self.assertGreater(view["template_mean_ms"], 0)
+        self.assertEqual(report["profiles"][0]["path"], self.url)
+        self.assertIn("function calls", report["profiles"][0]["profile"])
+
+    # test that the requests not sampled are measured without profile
+    @override_settings(PROFILING_SAMPLE_RATE=0, PROFILING_SLOW_REQUEST_MS=10000)
+    def test_request_not_sampled(self):
+        self.client.get(self.url)
+        self.client.get(reverse("home"))
+
+        report = profiling_store.report()
+        self.assertEqual(
+            {view["view"] for view in report["views"]}, {"product-details", "home"}
+        )
+        self.assertEqual(report["profiles"], [])
+
+    # test that the report is only shown to the staff
+    def test_profiling_report_staff_only(self):
+        self.client.get(self.url)
+        report_url = reverse("profiling-report")
+
+        self.assertEqual(self.client.get(report_url).status_code, 302)
+
+        User.objects.create_user(username="staff", password="test123+", is_staff=True)
+        self.client.login(username="staff", password="test123+")
+        self.assertContains(self.client.get(report_url), "product-details")
+        response = self.client.get(report_url, {"format": "json"})
+        self.assertIn(
+            "product-details", [view["view"] for view in response.json()["views"]]
+        )
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.registry.clear()
+        metrics.import_registry.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.import_file = os.path.join(self.directory.name, "database_update.prom")
+        self.settings = override_settings(
+            METRICS_IMPORT_FILE=self.import_file,
+            METRICS_TOKEN="",
+            METRICS_ALLOWED_IPS=["127.0.0.1"],
+            METRICS_DIRECTORY=os.path.join(self.directory.name, "metrics"),
+        )
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+        self.product = Product.objects.create(
+            name="Produit test", url="test.fr", nutri_score="c"
+        )
+
+    # test that the counters and histograms are rendered in the Prometheus text format
+    def test_exposition_format(self):
+        counter = metrics.Counter("test_total", "Test counter", ["kind"])
+        counter.inc(kind="a")
+        counter.inc(2, kind='b"')
+        histogram = metrics.Histogram("test_seconds", "Test histogram", buckets=(0.1, 1))
+        histogram.observe(0.5)
+        histogram.observe(2)
+        registry = metrics.Registry()
+        registry.register(counter)
+        registry.register(histogram)
+
+        self.assertEqual(
+            registry.render(),
+            "# HELP test_total Test counter\n"
+            "# TYPE test_total counter\n"
+            'test_total{kind="a"} 1.0\n'
+            'test_total{kind="b\\""} 2.0\n'
+            "# HELP test_seconds Test histogram\n"
+            "# TYPE test_seconds histogram\n"
+            'test_seconds_bucket{le="0.1"} 0\n'
+            'test_seconds_bucket{le="1.0"} 1\n'
+            'test_seconds_bucket{le="+Inf"} 2\n'
+            "test_seconds_sum 2.5\n"
+            "test_seconds_count 2\n",
+        )
+
+    # test that the searches, the cache lookups and the favorite toggles are counted
+    def test_web_metrics(self):
+        for _ in range(2):
+            self.client.post(
+                reverse("product-search-results"), {"product_name": "Produit test"}
+            )
+        self.assertEqual(metrics.search_duration.count(), 2)
+        self.assertEqual(
+            metrics.cache_requests.value(cache="search", result="miss"), 1
+        )
+        self.assertEqual(metrics.cache_requests.value(cache="search", result="hit"), 1)
+
+        User.objects.create_user(username="test", password="test123+")
+        self.client.login(username="test", password="test123+")
+        url = reverse("save-product", args=(self.product.id,))
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(metrics.favorite_toggles.value(action="save"), 1)
+        self.assertEqual(metrics.favorite_toggles.value(action="unsave"), 1)
+
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4")
+        content = response.content.decode()
+        self.assertIn("purebeurre_search_duration_seconds_count 2", content)
+        self.assertIn(
+            'purebeurre_favorite_toggles_total{action="save"} 1.0', content
+        )
+
+    # test that the metrics view requires the token when it is set
+    @override_settings(METRICS_TOKEN="secret", METRICS_ALLOWED_IPS=[])
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 401)
+        response = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret"
+        )
+        self.assertEqual(response.status_code, 200)
+
+    # test that the metrics are only served to the staff and the allowed addresses by default
+    def test_metrics_restricted(self):
+        self.assertEqual(
+            self.client.get(reverse("metrics"), REMOTE_ADDR="10.0.0.1").status_code, 403
+        )
+
+        User.objects.create_user(username="staff", password="test123+", is_staff=True)
+        self.client.login(username="staff", password="test123+")
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(response.status_code, 200)
+
+    # test that the metrics view renders the sum of the metrics saved by every process
+    def test_metrics_of_every_process(self):
+        metrics.search_duration.observe(0.2)
+        metrics.favorite_toggles.inc(action="save")
+        other_process = metrics.Registry()
+        for metric in metrics.registry.metrics:
+            other_process.register(metric.empty())
+        other_metrics = {metric.name: metric for metric in other_process.metrics}
+        other_metrics["purebeurre_search_duration_seconds"].observe(3)
+        other_metrics["purebeurre_favorite_toggles_total"].inc(2, action="save")
+        metrics.replace_file(
+            os.path.join(settings.METRICS_DIRECTORY, "1-1.json"),
+            json.dumps(other_process.dump()),
+        )
+
+        content = self.client.get(reverse("metrics")).content.decode()
+        self.assertIn("purebeurre_search_duration_seconds_count 2", content)
+        self.assertIn("purebeurre_search_duration_seconds_sum 3.2", content)
+        self.assertIn('purebeurre_search_duration_seconds_bucket{le="0.25"} 1', content)
+        self.assertIn('purebeurre_favorite_toggles_total{action="save"} 3.0', content)
+
+    # test that the latency of the requests to Open Food Facts is observed per status
+    def test_off_request_duration(self):
+        with OpenFoodFactsClient(retries=0) as client:
+            client.session.get = Mock(return_value=Mock(status_code=404))
+            self.assertIsNone(client.request_page("meats", 10, 1, stream=False))
+            client.session.get = Mock(side_effect=requests.ConnectionError)
+            self.assertIsNone(client.request_page("meats", 10, 1, stream=False))
+
+        self.assertEqual(metrics.off_request_duration.count(status=404), 1)
+        self.assertEqual(metrics.off_request_duration.count(status="error"), 1)
+
+    # test that database_update writes its stats in the file read by the metrics view
+    @patch("products.management.commands.database_update.Command.openfoodfacts_api_get_product")
+    def test_database_update_metrics(self, mock_get):
+        mock_get.return_value = [
+            {
+                "url": "https://url.test.com/1",
+                "product_name": "produit test 1",
+                "categories_tags": ["en:meats"],
+            },
+            {"url": "https://url.test.com/2", "categories_tags": []},
+        ]
+        with redirect_stdout(StringIO()):
+            call_command("database_update")
+
+        categories = len(settings.PRODUCTS_CATEGORIES)
+        self.assertEqual(metrics.import_products.value(result="fetched"), 2 * categories)
+        self.assertEqual(metrics.import_products.value(result="inserted"), 1)
+        self.assertIsNotNone(metrics.import_last_success.value())
+
+        content = self.client.get(reverse("metrics")).content.decode()
+        self.assertIn('purebeurre_import_products{result="inserted"} 1.0', content)
+        self.assertIn("purebeurre_import_db_write_seconds", content)
+        self.assertTrue(os.path.exists(self.import_file))
+
+
+class CommandLoggingTest(TestCase):
+    def setUp(self):
+        self.products = [
+            {
+                "url": "https://url.test.com/{}".format(index),
+                "product_name": "produit test {}".format(index),
+                "categories_tags": ["en:meats"],
+            }
+            for index in range(3)
+        ]
+
+    def call_database_update(self, **options):
+        out = StringIO()
+        with patch(
+            "products.management.commands.database_update.Command.openfoodfacts_api_get_product"
+        ) as mock_get:
+            mock_get.return_value = self.products
+            call_command("database_update", stdout=out, **options)
+        return out.getvalue()
+
+    # test that the default verbosity logs a summary per category instead of a line per product
+    def test_default_logs_summaries(self):
+        output = self.call_database_update()
+
+        self.assertNotIn("Adding new product to database", output)
+        self.assertRegex(
+            output, r"Category [a-z-]+ : 3 products, 3 inserted, 0 updated, 0 skipped in"
+        )
+        self.assertIn("3 products inserted, 0 updated, 15 skipped", output)
+        self.assertLess(len(output.splitlines()), 30)
+
+    # test that verbosity 2 logs every product and every page
+    def test_verbose_logs_products(self):
+        output = self.call_database_update(verbosity=2)
+
+        self.assertIn("Adding new product to database : produit test 0", output)
+        self.assertIn("Category meats - page 1 : 3 products", output)
+
+    # test that the json format writes one object per line with the stats of the events
+    def test_json_format(self):
+        output = self.call_database_update(log_format="json")
+
+        records = [json.loads(line) for line in output.splitlines()]
+        events = {record["event"]: record for record in records}
+        self.assertEqual(events["summary"]["inserted"], 3)
+        self.assertEqual(events["summary"]["fetched"], 3 * len(settings.PRODUCTS_CATEGORIES))
+        categories = [record for record in records if record["event"] == "category"]
+        self.assertEqual(len(categories), len(settings.PRODUCTS_CATEGORIES))
+
+    # test that nothing but the warnings is logged with verbosity 0
+    def test_quiet(self):
+        self.assertEqual(self.call_database_update(verbosity=0), "")
+
+
+class ReplicaRouterTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = ReplicaRouter()
+        default = dict(settings.DATABASES["default"])
+        self.databases_with_replica = {
+            "default": default,
+            "replica": dict(default, NAME="replica", HOST="replica.test"),
+        }
+
+    # test that only the reads of the read-only views go to the replica
+    def test_reads_sent_to_replica(self):
+        with override_settings(DATABASES=self.databases_with_replica):
+            self.assertEqual(self.router.db_for_read(Product), "default")
+            with read_from_replica():
+                self.assertEqual(self.router.db_for_read(Product), "replica")
+                self.assertEqual(self.router.db_for_write(Product), "default")
+            self.assertEqual(self.router.db_for_read(Product), "default")
+
+    # test that the reads stay on the primary database without replica, or with a test mirror
+    def test_no_replica(self):
+        default = dict(settings.DATABASES["default"])
+        for databases in [{"default": default}, {"default": default, "replica": default}]:
+            with override_settings(DATABASES=databases), read_from_replica():
+                self.assertEqual(self.router.db_for_read(Product), "default")
+
+    # test that the replica is not migrated
+    def test_allow_migrate(self):
+        self.assertTrue(self.router.allow_migrate("default", "products"))
+        self.assertFalse(self.router.allow_migrate("replica", "products"))
+
+    # test that the search, details and autocomplete views read from the replica, not the favorites
+    def test_read_only_views(self):
+        product = Product.objects.create(name="Produit test", url="test.fr", nutri_score="c")
+        used_replica = []
+
+        def record(*args, **kwargs):
+            used_replica.append(use_replica.get())
+            return []
+
+        with patch("products.views.autocomplete", side_effect=record):
+            self.client.get(reverse("product-autocomplete"), {"q": "pro"})
+        with patch("products.views.get_nutrition_table", side_effect=record):
+            self.client.get(reverse("product-details", args=(product.id,)))
+        self.assertEqual(used_replica, [True, True])
+
+        User.objects.create_user(username="test", password="test123+")
+        self.client.login(username="test", password="test123+")
+        with patch("products.views.favorite_toggles.inc", side_effect=record):
+            self.client.get(reverse("save-product", args=(product.id,)))
+        self.assertEqual(used_replica, [True, True, False])
+
+    # test that the idle or failed persistent connections closed by the database are closed
+    # before the request, without checking the connections used just before
+    def test_health_check(self):
+        now = time.monotonic()
+        opened = {"connection": object(), "in_atomic_block": False}
+        idle = Mock(errors_occurred=False, idle_since=now - 60, **opened)
+        idle.is_usable.return_value = False
+        failed = Mock(errors_occurred=True, idle_since=now, **opened)
+        failed.is_usable.return_value = False
+        recent = Mock(errors_occurred=False, idle_since=now, **opened)
+        closed = Mock(connection=None)
+
+        with patch("products.routers.connections") as mock_connections:
+            mock_connections.all.return_value = [idle, failed, recent, closed]
+            check_persistent_connections()
+
+        idle.close.assert_called_once_with()
+        failed.close.assert_called_once_with()
+        recent.is_usable.assert_not_called()
+        closed.is_usable.assert_not_called()
+
+    # test that the saved products of the search page are read from the primary database
+    def test_saved_products_from_primary(self):
+        product = Product.objects.create(name="Produit test", url="test.fr", nutri_score="c")
+        user = User.objects.create_user(username="test", password="test123+")
+        ProductUsers.objects.create(product=product, user=user)
+        self.client.login(username="test", password="test123+")
+
+        with patch.object(
+            ProductUsers.objects, "using", wraps=ProductUsers.objects.using
+        ) as using:
+            response = self.client.get(
+                reverse("product-search-results"), {"q": "Produit test"}
+            )
+
+        using.assert_called_once_with("default")
+        self.assertEqual(response.context["saved_product"], {product.id})
+
+
+class SearchGetTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(
+            name="Produit test", url="test.fr", nutri_score="c"
+        )
+        self.substitute = Product.objects.create(
+            name="Substitut produit test", url="test-sub.fr", nutri_score="a"
+        )
+        category = Category.objects.create(name="test-category")
+        ProductCategories.objects.create(product=self.product, category=category)
+        ProductCategories.objects.create(product=self.substitute, category=category)
+        self.url = reverse("product-search-results")
+
+    # test that the search form sends the text in the "q" parameter of a GET request
+    def test_search_form_get(self):
+        response = self.client.get(reverse("home"))
+        self.assertContains(response, 'method="GET"')
+        self.assertContains(response, 'name="q"')
+
+        response = self.client.get(self.url, {"q": "Produit test"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["searched_product"], self.product)
+        self.assertEqual(response.context["products"], [self.substitute])
+
+    # test that the other spellings of a search are redirected to its canonical url
+    def test_canonical_redirect(self):
+        response = self.client.get(self.url, {"q": "  Produit   test ", "utm_source": "x"})
+        self.assertRedirects(
+            response,
+            self.url + "?q=Produit+test",
+            status_code=301,
+            fetch_redirect_response=False,
+        )
+
+    # test that an empty search returns the homepage with the errors of the form
+    def test_empty_search(self):
+        response = self.client.get(self.url, {"q": ""})
+        self.assertIsNotNone(response.context["errors"])
+
+    # test that the anonymous searches are validated by the version of the catalog
+    def test_conditional_response(self):
+        response = self.client.get(self.url, {"q": "Produit test"})
+        etag = response["ETag"]
+        self.assertIn("public", response["Cache-Control"])
+        self.assertIn("Last-Modified", response)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                self.url, {"q": "Produit test"}, HTTP_IF_NONE_MATCH=etag
+            )
+        self.assertEqual(response.status_code, 304)
+
+        bump_catalog_version()
+        response = self.client.get(
+            self.url, {"q": "Produit test"}, HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    # test that a repeated anonymous search doesn't query the database
+    def test_repeated_search_without_queries(self):
+        self.client.get(self.url, {"q": "Produit test"})
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, {"q": "Produit test"})
+        self.assertContains(response, "Substitut produit test")
+
+    # test that the searches are not validated when every process has its own version of the catalog
+    def test_local_cache_not_validated(self):
+        locmem = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+        with override_settings(CACHES=locmem):
+            response = self.client.get(self.url, {"q": "Produit test"})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("ETag", response)
+        self.assertNotIn("Last-Modified", response)
+        self.assertNotIn("public", response.get("Cache-Control", ""))
+
+    # test that the searches of the users are neither validated nor cached by the proxies
+    def test_authenticated_search_not_validated(self):
+        User.objects.create_user(username="testuser", password="test123+")
+        self.client.login(username="testuser", password="test123+")
+
+        response = self.client.get(self.url, {"q": "Produit test"})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("ETag", response)
+        self.assertNotIn("public", response.get("Cache-Control", ""))
+
+
+class ProductCardCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(
+            name="Produit test", url="test.fr", nutri_score="c"
+        )
+        self.substitute = Product.objects.create(
+            name="Substitut produit test", url="test-sub.fr", nutri_score="a"
+        )
+        category = Category.objects.create(name="test-category")
+        ProductCategories.objects.create(product=self.product, category=category)
+        ProductCategories.objects.create(product=self.substitute, category=category)
+        self.user = User.objects.create_user(username="testuser", password="test123+")
+        self.client.login(username="testuser", password="test123+")
+
+    def search(self):
+        return self.client.get(reverse("product-search-results"), {"q": "Produit test"})
+
+    # test that the cards are cached per product and version of the catalog
+    def test_cards_cached(self):
+        self.search()
+        version = get_catalog_version()
+        self.assertIsNotNone(
+            cache.get(make_template_fragment_key("product_card", [self.product.id, version, True]))
+        )
+        self.assertIsNotNone(
+            cache.get(make_template_fragment_key("product_card", [self.substitute.id, version, ""]))
+        )
+
+        # the bulk updates don't send signals, the cards change with the next version
+        Product.objects.filter(id=self.substitute.id).update(name="Substitut renommé")
+        self.assertContains(self.search(), "Substitut produit test")
+        bump_catalog_version()
+        self.assertContains(self.search(), "Substitut renommé")
+
+    # test that the favorite buttons are rendered per user on the cached cards
+    def test_favorite_buttons_not_cached(self):
+        response = self.search()
+        self.assertNotContains(response, "Retirer des favoris")
+
+        ProductUsers.objects.create(product=self.substitute, user=self.user)
+        response = self.search()
+        self.assertEqual(response.context["saved_product"], {self.substitute.id})
+        self.assertContains(response, "Retirer des favoris", count=1)
+        self.assertContains(response, "Ajouter aux favoris", count=1)
+
+    # test that the saved products page renders the cached cards with the csrf token of the batch endpoint
+    def test_user_results_cards(self):
+        ProductUsers.objects.create(product=self.substitute, user=self.user)
+        response = self.client.get(reverse("product-user-results"))
+
+        self.assertContains(response, 'id="product-card-{}"'.format(self.substitute.id))
+        self.assertContains(response, "Retirer des favoris", count=1)
+        self.assertContains(response, 'data-csrf="')
+
+
+class CatalogRebuildTest(OpenFoodFactsStubMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        call_command("database_reset", stdout=StringIO())
+        self.category = Category.objects.create(name="meats")
+        Nutriment.objects.create(name="salt", unit="g")
+        self.kept = Product.objects.create(
+            name="Produit gardé", url="https://off.test/kept", nutri_score="c"
+        )
+        self.removed = Product.objects.create(
+            name="Produit retiré", url="https://off.test/removed", nutri_score="d"
+        )
+        ProductSubstitute.objects.create(product=self.removed, substitute=self.kept, rank=0)
+        self.user = User.objects.create_user(username="testuser", password="test123+")
+        ProductUsers.objects.create(product=self.kept, user=self.user)
+        ProductUsers.objects.create(product=self.removed, user=self.user)
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "dump.jsonl")
+        with open(self.path, "w") as dump:
+            for product in [
+                {
+                    "url": "https://off.test/kept",
+                    "product_name": "Produit gardé",
+                    "nutrition_grades_tags": ["a"],
+                    "categories_tags": ["en:meats"],
+                    "nutriments": {"salt_100g": 1.2},
+                },
+                {
+                    "url": "https://off.test/new",
+                    "product_name": "Produit nouveau",
+                    "nutrition_grades_tags": ["b"],
+                    "categories_tags": ["en:meats"],
+                },
+            ]:
+                dump.write(json.dumps(product) + "\n")
+
+    def staging_tables(self):
+        return [
+            table
+            for table in connection.introspection.table_names()
+            if table.endswith("_staging")
+        ]
+
+    # test that the rebuild replaces the catalog, keeping the ids and the saved products of the kept products
+    def test_rebuild_swaps_catalog(self):
+        with redirect_stdout(StringIO()):
+            call_command("database_import", self.path, "--rebuild")
+
+        self.assertEqual(
+            set(Product.objects.values_list("url", flat=True)),
+            {"https://off.test/kept", "https://off.test/new"},
+        )
+        kept = Product.objects.get(url="https://off.test/kept")
+        new = Product.objects.get(url="https://off.test/new")
+        self.assertEqual(kept.id, self.kept.id)
+        self.assertEqual(kept.nutri_score, "a")
+        self.assertEqual(kept.search_name, "produit garde")
+        self.assertGreater(new.id, self.removed.id)
+        self.assertEqual(list(new.categories.all()), [self.category])
+        self.assertEqual(
+            ProductNutriments.objects.get(product=kept, nutriment__name="salt").quantity,
+            1.2,
+        )
+
+        self.assertEqual(
+            list(ProductUsers.objects.values_list("product_id", flat=True)), [kept.id]
+        )
+        self.assertFalse(
+            ProductSubstitute.objects.filter(product_id=self.removed.id).exists()
+        )
+        self.assertEqual(get_substitutes(new), [kept])
+        self.assertEqual(self.staging_tables(), [])
+        connection.check_constraints()
+
+    # test that a failed rebuild leaves the live catalog untouched
+    def test_failed_rebuild_keeps_catalog(self):
+        with patch(
+            "products.staging.StagingCatalog.swap", side_effect=RuntimeError("swap")
+        ), redirect_stdout(StringIO()):
+            with self.assertRaises(RuntimeError):
+                call_command("database_import", self.path, "--rebuild")
+
+        self.assertEqual(Product.objects.count(), 2)
+        self.assertEqual(ProductUsers.objects.count(), 2)
+        self.assertEqual(self.staging_tables(), [])
+
+    # test that database_update doesn't swap a catalog missing the products of a category
+    @patch("products.management.commands.database_update.Command.openfoodfacts_api_get_product")
+    def test_update_rebuild_without_products(self, mock_get):
+        mock_get.return_value = []
+        with self.assertRaises(CommandError):
+            call_command("database_update", "--rebuild", stdout=StringIO())
+
+        self.assertEqual(Product.objects.count(), 2)
+        self.assertEqual(self.staging_tables(), [])
+
+    # test that a rebuild is aborted when a page fails or is cut off, the products not fetched and their favorites are kept
+    def test_update_rebuild_with_failed_page(self):
+        options = {"products": 6, "page_size": 2, "stdout": StringIO()}
+        with self.settings(OFF_SEARCH_URL=self.stub_url, OFF_RETRIES=0):
+            call_command("database_update", **options)
+            products = Product.objects.count()
+            ProductUsers.objects.create(
+                product=Product.objects.get(url="https://stub.test/meats/3/0"),
+                user=self.user,
+            )
+            favorites = ProductUsers.objects.count()
+
+            for pages in ["failing_pages", "cut_pages"]:
+                setattr(OpenFoodFactsStub, pages, {("meats", 2)})
+                with self.assertRaises(CommandError):
+                    call_command("database_update", "--rebuild", **options)
+                setattr(OpenFoodFactsStub, pages, set())
+
+                self.assertEqual(Product.objects.count(), products)
+                self.assertEqual(ProductUsers.objects.count(), favorites)
+                self.assertEqual(self.staging_tables(), [])
+
+    # test that the reset empties the catalog and the saved products
+    def test_reset(self):
+        call_command("database_reset", stdout=StringIO())
+
+        for model in [Product, ProductUsers, ProductSubstitute, Category, Nutriment]:
+            self.assertFalse(model.objects.exists())
+        self.assertTrue(User.objects.filter(id=self.user.id).exists())
+
+
+# Checkpoints and --resume of database_update
+@override_settings(
+    NB_PRODUCTS_TO_GET=6, OFF_PAGE_SIZE=2, IMPORT_BATCH_SIZE=2, OFF_RETRIES=0
+)
+class ImportResumeTest(OpenFoodFactsStubMixin, TestCase):
+    def run_update(self, **options):
+        OpenFoodFactsStub.requested = []
+        with self.settings(OFF_SEARCH_URL=self.stub_url):
+            call_command("database_update", stdout=StringIO(), **options)
+
+    # test that an import failing on a page keeps its committed batches and is resumed after the last committed product
+    def test_resume_interrupted_import(self):
+        OpenFoodFactsStub.failing_pages = {("meats", 3)}
+        with self.assertRaises(CommandError):
+            self.run_update()
+
+        run = ImportRun.objects.get()
+        self.assertEqual(run.status, ImportRun.FAILED)
+        self.assertEqual(Product.objects.count(), 5 * 6 + 4)
+        checkpoint = ImportCheckpoint.objects.get(category__name="meats")
+        self.assertEqual(
+            (checkpoint.page, checkpoint.last_code, checkpoint.products, checkpoint.finished),
+            (2, "meats21", 4, False),
+        )
+        self.assertTrue(
+            ImportCheckpoint.objects.get(category__name="plant-based-foods").finished
+        )
+
+        OpenFoodFactsStub.failing_pages = set()
+        self.run_update(resume=True)
+
+        self.assertEqual(OpenFoodFactsStub.requested, [("meats", 2), ("meats", 3)])
+        self.assertEqual(Product.objects.count(), 6 * 6)
+        run.refresh_from_db()
+        self.assertEqual(run.status, ImportRun.FINISHED)
+        self.assertIsNotNone(run.finished_at)
+        self.assertFalse(run.checkpoints.filter(finished=False).exists())
+
+    # test that a page cut off leaves the category to resume
+    def test_resume_cut_off_page(self):
+        OpenFoodFactsStub.cut_pages = {("meats", 2)}
+        with self.assertRaises(CommandError):
+            self.run_update()
+
+        self.assertEqual(ImportRun.objects.get().status, ImportRun.FAILED)
+        self.assertFalse(ImportCheckpoint.objects.get(category__name="meats").finished)
+
+        OpenFoodFactsStub.cut_pages = set()
+        self.run_update(resume=True)
+
+        self.assertEqual(Product.objects.count(), 6 * 6)
+        self.assertEqual(ImportRun.objects.get().status, ImportRun.FINISHED)
+
+    # test that --resume starts a new import when the last one finished
+    def test_resume_after_finished_import(self):
+        self.run_update()
+        self.run_update(resume=True)
+
+        self.assertEqual(
+            list(ImportRun.objects.values_list("status", flat=True)),
+            [ImportRun.FINISHED, ImportRun.FINISHED],
+        )
+        self.assertIn(("plant-based-foods", 1), OpenFoodFactsStub.requested)
+
+    # test that the cron job continues the interrupted import
+    def test_cron_job_resumes(self):
+        OpenFoodFactsStub.failing_pages = {("meats", 3)}
+        with self.assertRaises(CommandError):
+            self.run_update()
+        OpenFoodFactsStub.failing_pages = set()
+
+        schedule, function, args, kwargs = settings.CRONJOBS[0][:4]
+        with self.settings(OFF_SEARCH_URL=self.stub_url), redirect_stdout(StringIO()):
+            import_string(function)(*args, **kwargs)
+
+        self.assertEqual(
+            list(ImportRun.objects.values_list("status", flat=True)), [ImportRun.FINISHED]
+        )
+        self.assertEqual(Product.objects.count(), 6 * 6)
+
+    # test that a rebuild can't be resumed
+    def test_resume_with_rebuild(self):
+        with self.assertRaises(CommandError):
+            call_command("database_update", "--resume", "--rebuild", stdout=StringIO())
+
+
+# database_update --workers
+class ParallelImportTest(TestCase):
+    def setUp(self):
+        create_missing_categories()
+        Nutriment.objects.create(name="salt", unit="g")
+        self.product = {
+            "code": "1",
+            "url": "https://off.test/1",
+            "product_name": "Produit partagé",
+            "nutrition_grades_tags": ["a"],
+            "categories_tags": ["en:meats", "en:fishes"],
+        }
+
+    # test that the keys of a product are given to the first worker claiming them
+    def test_claim_registry(self):
+        registry = ClaimRegistry()
+
+        self.assertEqual(
+            registry.claim(0, [[("url", "a"), ("name", "a")], [("url", "b")]]), [0, 1]
+        )
+        self.assertEqual(
+            registry.claim(1, [[("url", "c"), ("name", "a")], [("url", "d")]]), [1]
+        )
+        self.assertEqual(registry.claim(0, [[("url", "a"), ("name", "e")]]), [0])
+
+    # test that the categories are spread over the workers
+    def test_partition(self):
+        self.assertEqual(
+            partition(["a", "b", "c", "d", "e"], 2), [["a", "c", "e"], ["b", "d"]]
+        )
+        self.assertEqual(partition(["a"], 3), [["a"]])
+
+    # test that a product returned to two workers is written once
+    def test_importers_share_claims(self):
+        registry = ClaimRegistry()
+        importers = [
+            ProductImporter(claim=partial(registry.claim, worker)) for worker in range(2)
+        ]
+        for importer in importers:
+            importer.load_existing_keys()
+        for importer in importers:
+            importer.add(dict(self.product))
+            importer.flush()
+
+        self.assertEqual(Product.objects.count(), 1)
+        self.assertEqual(
+            [
+                (importer.inserted_products, importer.skipped_products)
+                for importer in importers
+            ],
+            [(1, 0), (0, 1)],
+        )
+
+    # test that a worker imports its categories with the checkpoints of the run and sends its logs
+    @patch("products.management.commands.database_update.Command.openfoodfacts_api_get_product")
+    def test_import_worker(self, mock_get):
+        def get_products(category, *args):
+            metrics.off_request_duration.observe(0.3, status=200)
+            return [self.product] if category == "meats" else []
+
+        mock_get.side_effect = get_products
+        # observed by the categories of another worker, in the same process
+        metrics.off_request_duration.observe(0.3, status=200)
+        run = ImportRun.objects.create()
+        for category in Category.objects.all():
+            ImportCheckpoint.objects.create(run=run, category=category)
+        records = queue.Queue()
+        options = {
+            "rebuild": False,
+            "batch_size": 10,
+            "products": 10,
+            "page_size": 10,
+            "concurrency": 1,
+            "verbosity": 1,
+        }
+
+        stats = import_worker(
+            0, run.pk, ["meats", "fishes"], options, ClaimRegistry(), records
+        )
+
+        self.assertEqual(stats["fetched"], 1)
+        self.assertEqual(stats["inserted"], 1)
+        self.assertEqual(
+            [(values, series["count"]) for values, series in stats["off_request_duration"]],
+            [(["200"], mock_get.call_count)],
+        )
+        self.assertEqual(
+            list(
+                Product.objects.get()
+                .categories.order_by("name")
+                .values_list("name", flat=True)
+            ),
+            ["fishes", "meats"],
+        )
+        self.assertEqual(
+            set(
+                run.checkpoints.filter(finished=True).values_list(
+                    "category__name", flat=True
+                )
+            ),
+            {"meats", "fishes"},
+        )
+        messages = [records.get_nowait().getMessage() for _ in range(records.qsize())]
+        self.assertTrue(any(message.startswith("Category meats") for message in messages))
+
+    # test that the latency of the requests of the workers is added to the metrics of the command
+    @patch("products.management.commands.database_update.worker_pool", ThreadPoolExecutor)
+    @patch("products.management.commands.database_update.import_worker")
+    def test_workers_request_metrics(self, mock_worker):
+        histogram = metrics.off_request_duration.empty()
+        histogram.observe(0.3, status=200)
+        worker_stats = {
+            "fetched": 1,
+            "inserted": 1,
+            "updated": 0,
+            "skipped": 0,
+            "rows": 1,
+            "write_seconds": 0.1,
+            "off_request_duration": histogram.dump(),
+        }
+        mock_worker.side_effect = lambda *args: dict(worker_stats)
+        metrics.off_request_duration.clear()
+        command = Command()
+        command.run = ImportRun.objects.create()
+
+        stats = command.import_in_workers(
+            ["meats", "fishes"], {"workers": 2, "concurrency": 2}
+        )
+
+        self.assertEqual(stats["fetched"], 2)
+        self.assertEqual(metrics.off_request_duration.count(status=200), 2)
+
+    # test that the staging tables of a rebuild are not loaded by several processes
+    def test_workers_with_rebuild(self):
+        with self.assertRaises(CommandError):
+            call_command("database_update", "--workers", "2", "--rebuild", stdout=StringIO())
@@ -1,8 +1,20 @@
+from django.conf import settings
 from django.urls import include, path
 from django.contrib.auth import views as auth_views
 
 from . import views
 
+# the async views run their queries in a pool of threads, on an ASGI server
+if settings.ASYNC_VIEWS:
+    search_result_view = views.search_result_async
+    save_product_view = views.user_save_product_async
+    save_products_view = views.user_save_products_async
+    product_details_view = views.product_details_async
+else:
+    search_result_view = views.SearchResult.as_view()
+    save_product_view = views.UserSaveProduct.as_view()
+    save_products_view = views.UserSaveProducts.as_view()
+    product_details_view = views.ProductDetails.as_view()
 
 urlpatterns = [
     path("", views.HomeView.as_view(), name="home"),
@@ -10,18 +22,14 @@ urlpatterns = [
     path("user/login", views.UserLogin.as_view(), name="login"),
     path("user/logout", views.UserLogout.as_view(), name="logout"),
     path("user/sign-up", views.UserCreate.as_view(), name="user-create"),
-    path(
-        "search-results/", views.SearchResult.as_view(), name="product-search-results"
-    ),
+    path("search-results/", search_result_view, name="product-search-results"),
     path(
         "user-save-product/<int:product_id>",
-        views.UserSaveProduct.as_view(),
+        save_product_view,
         name="save-product",
     ),
+    path("user-save-products/", save_products_view, name="save-products"),
     path("user-results/", views.UserResults.as_view(), name="product-user-results"),
-    path(
-        "details/<int:product_id>",
-        views.ProductDetails.as_view(),
-        name="product-details",
-    ),
+    path("autocomplete/", views.Autocomplete.as_view(), name="product-autocomplete"),
+    path("details/<int:product_id>", product_details_view, name="product-details"),
 ]
@@ -1,9 +1,21 @@
 # from django.http import HttpResponse
 # from django.template import loader
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+import json
+import time
+from urllib.parse import urlencode
+
+from django.db import close_old_connections
+from django.db.models import Exists, OuterRef
 from django.shortcuts import render, redirect, get_object_or_404, get_list_or_404
 from django.views import View
+from django.views.generic.base import ContextMixin
 from django.conf import settings
 from django.http import JsonResponse
+from django.urls import reverse
 
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.forms import AuthenticationForm
@@ -19,33 +31,53 @@ from products.models import (
     ProductNutriments,
     ProductUsers,
 )
+from products.cache import (
+    AnonymousPageCacheMixin,
+    CatalogConditionalMixin,
+    get_or_set_catalog,
+)
 from products.forms import SearchForm, UserCreateForm, LoginForm
+from products.metrics import favorite_toggles, search_duration
+from products.nutrition import get_nutrition_table
+from products.profiling import profile_thread
+from products.routers import ReadReplicaMixin
+from products.search import autocomplete, normalize_search_text, search_product
+from products.substitutes import get_substitutes
 
 # Create your views here.
-class HomeView(View):
+class SearchFormContextMixin(ContextMixin):
+    """Build the context of the pages per request, with a new search form.
+    The views must not store the context of a request on the class, the
+    threads of the server would see the context of each other"""
+
+    def get_context_data(self, **kwargs):
+        kwargs.setdefault("search_form", SearchForm())
+        return super().get_context_data(**kwargs)
+
+
+class HomeView(AnonymousPageCacheMixin, SearchFormContextMixin, View):
     template_name = "products/homepage.html"
-    context = {"search_form": SearchForm()}
 
     def get(self, request):
         """Return the homepage template"""
-        return render(request, self.template_name, self.context)
+        return render(request, self.template_name, self.get_context_data())
 
 
-class UserView(View):
+class UserView(SearchFormContextMixin, View):
     template_name = "products/user-details.html"
-    context = {"search_form": SearchForm()}
 
     def get(self, request):
         """Return the user-details template"""
-        self.context["title"] = "Salut " + request.user.first_name + " !"
-        self.context["user"] = request.user
-        return render(request, self.template_name, self.context)
+        context = self.get_context_data(
+            title="Salut " + request.user.first_name + " !", user=request.user
+        )
+        return render(request, self.template_name, context)
 
 
-class UserLogin(LoginView):
+class UserLogin(SearchFormContextMixin, LoginView):
     template_name = "products/user-login.html"
     authentication_form = LoginForm
-    extra_context = {"title": "Connexion utilisateur", "search_form": SearchForm()}
+    extra_context = {"title": "Connexion utilisateur"}
 
 
 class UserLogout(LogoutView):
@@ -54,15 +86,14 @@ class UserLogout(LogoutView):
         return redirect("home")
 
 
-class UserCreate(View):
+class UserCreate(SearchFormContextMixin, View):
     template_name = "products/user-create.html"
-    context = {"title": "Création utilisateur", "search_form": SearchForm()}
+    extra_context = {"title": "Création utilisateur"}
 
     def get(self, request):
         """Return the signup template"""
         form = UserCreateForm()
-        self.context["form"] = form
-        return render(request, self.template_name, self.context)
+        return render(request, self.template_name, self.get_context_data(form=form))
 
     def post(self, request):
         """Process the UserCreate form, redirect and log the user if it is
@@ -76,150 +107,303 @@ class UserCreate(View):
             login(request, user)
             return redirect("home")
         else:
-            self.context["form"] = form
-            self.context["errors"] = form.errors.items()
-            return render(request, self.template_name, self.context)
+            context = self.get_context_data(form=form, errors=form.errors.items())
+            return render(request, self.template_name, context)
 
 
-class SearchResult(View):
+class SearchResult(
+    CatalogConditionalMixin,
+    AnonymousPageCacheMixin,
+    ReadReplicaMixin,
+    SearchFormContextMixin,
+    View,
+):
     template_name = "products/result-search.html"
-    context = {"search_form": SearchForm()}
+
+    def get(self, request):
+        """Return the result-search template of the text of the "q" parameter.
+        The other spellings of the url are redirected to a single url per
+        search, which the browsers and the proxies can cache"""
+        text = request.GET.get("q", "")
+        canonical_text = " ".join(text.split())
+        if canonical_text and (canonical_text != text or list(request.GET) != ["q"]):
+            return redirect(
+                "{}?{}".format(
+                    reverse("product-search-results"), urlencode({"q": canonical_text})
+                ),
+                permanent=True,
+            )
+        return self.render_search(request, SearchForm({"q": text}))
 
     def post(self, request):
+        """Process the search form of the pages of the previous versions,
+        sent with a POST request"""
+        return self.render_search(
+            request, SearchForm({"q": request.POST.get("product_name", "")})
+        )
+
+    def render_search(self, request, form: SearchForm):
         """Process the SearchForm form, return the result-search template 
         if form is valid, render homepage template with errors context otherwise"""
-        form = SearchForm(request.POST)
-
         if form.is_valid():
-            product_name = form.cleaned_data["product_name"]
-            searched_product = Product.objects.filter(
-                name__icontains=product_name
-            ).first()
-            saved_product = []
-
-            if searched_product:
-                substitutes_products = (
-                    Product.objects.filter(
-                        categories=searched_product.categories.first()
+            product_name = form.cleaned_data["q"]
+            start = time.perf_counter()
+            searched_product, substitutes_products = get_or_set_catalog(
+                "search",
+                normalize_search_text(product_name),
+                lambda: self.search(product_name),
+            )
+            search_duration.observe(time.perf_counter() - start)
+            # ids of the saved products, for the favorite buttons of the cards
+            saved_product = set()
+
+            if searched_product and request.user.is_authenticated:
+                # one query for the searched product and all its substitutes
+                displayed_products = [searched_product] + substitutes_products
+                # read from the primary database, the replica may not have
+                # the favorites the user just saved yet
+                saved_product = set(
+                    ProductUsers.objects.using("default")
+                    .filter(
+                        user=request.user,
+                        product_id__in=[product.id for product in displayed_products],
                     )
-                    .exclude(id=searched_product.id)
-                    .order_by("nutri_score")[:12]
+                    .values_list("product_id", flat=True)
                 )
 
-                if request.user.is_authenticated:
-                    if ProductUsers.objects.filter(
-                        product=searched_product, user=request.user
-                    ).exists():
-                        saved_product.append(searched_product)
-
-                    for product in substitutes_products:
-                        if ProductUsers.objects.filter(
-                            product=product, user=request.user
-                        ).exists():
-                            saved_product.append(product)
-            else:
-                substitutes_products = None
-
-            self.context["title"] = (
-                'produit trouvé pour la recherche : "' + product_name + '"'
+            context = self.get_context_data(
+                title='produit trouvé pour la recherche : "' + product_name + '"',
+                searched_product=searched_product,
+                products=substitutes_products,
+                saved_product=saved_product,
             )
-            self.context["searched_product"] = searched_product
-            self.context["products"] = substitutes_products
-            self.context["saved_product"] = saved_product
-
-            return render(request, self.template_name, self.context)
+            return render(request, self.template_name, context)
         else:
-            self.context["errors"] = form.errors.items()
-            return render(request, "products/homepage.html", self.context)
-
-
-class ProductDetails(View):
-    context = {"search_form": SearchForm()}
+            context = self.get_context_data(errors=form.errors.items())
+            return render(request, "products/homepage.html", context)
+
+    def search(self, product_name: str):
+        """Return the product found for the searched text and its substitutes,
+        cached per normalized text until the next import"""
+        searched_product = search_product(product_name)
+        if searched_product is None:
+            return None, None
+        return searched_product, get_substitutes(searched_product)
+
+
+class ProductDetails(
+    CatalogConditionalMixin,
+    AnonymousPageCacheMixin,
+    ReadReplicaMixin,
+    SearchFormContextMixin,
+    View,
+):
 
     def get(self, request, product_id):
         """Return the product-details template if product exists. 
         Return 404 otherwise"""
         searched_product = get_object_or_404(Product, id=product_id)
-        product_nutriments = searched_product.nutriments.all()
-        clean_nutriments = []
-
-        for nutriment in product_nutriments:
-            clean_nutriments.append(
-                {
-                    "name": settings.NUTRIMENTS[nutriment.name]["name"],
-                    "unit": nutriment.unit,
-                    "quantity": ProductNutriments.objects.filter(
-                        product=searched_product, nutriment=nutriment
-                    )
-                    .first()
-                    .quantity,
-                }
-            )
+        clean_nutriments = get_nutrition_table(searched_product.id)
 
-        self.context["title"] = searched_product.name
-        self.context["searched_product"] = searched_product
-        self.context["product_nutriments"] = clean_nutriments
+        context = self.get_context_data(
+            title=searched_product.name,
+            searched_product=searched_product,
+            product_nutriments=clean_nutriments,
+        )
+        return render(request, "products/product-details.html", context)
 
-        return render(request, "products/product-details.html", self.context)
 
-
-class UserResults(View):
+class UserResults(SearchFormContextMixin, View):
     template_name = "products/result-user.html"
-    context = {"search_form": SearchForm()}
 
     def get(self, request):
         """Return the result-user template"""
-        product_users_list = ProductUsers.objects.filter(user=request.user)
-        product_list = []
-
-        for queryset in product_users_list:
-            product_list.append(queryset.product)
+        product_users_list = (
+            ProductUsers.objects.filter(user=request.user)
+            .select_related("product")
+            .order_by("id")
+        )
+        product_list = [queryset.product for queryset in product_users_list]
 
-        self.context["title"] = "Salut " + request.user.first_name + " !"
-        self.context["products"] = product_list
-        return render(request, self.template_name, self.context)
+        context = self.get_context_data(
+            title="Salut " + request.user.first_name + " !",
+            products=product_list,
+            saved_product={product.id for product in product_list},
+        )
+        return render(request, self.template_name, context)
 
 
 class UserSaveProduct(View):
-    context = {"search_form": SearchForm()}
-
     def get(self, request, product_id):
         """Create/Delete a relation user-product to save/unsave a product 
-        for authenticated user and return appropriate JSON response"""
-        product_to_save = Product.objects.get(id=product_id)
-
-        if not ProductUsers.objects.filter(
-            product=product_to_save, user=request.user
-        ).exists():
-            product_user_relation = ProductUsers(
-                product=product_to_save, user=request.user
+        for authenticated user and return appropriate JSON response.
+
+        The product and its saved state are read in one query, then the
+        relation is inserted or deleted in a second one. The unique (user,
+        product) constraint makes a double click save the product once."""
+        if not request.user.is_authenticated:
+            return JsonResponse({"error": "utilisateur non connecté"}, status=401)
+
+        product_to_save = (
+            Product.objects.filter(id=product_id)
+            .annotate(
+                saved=Exists(
+                    ProductUsers.objects.filter(
+                        product=OuterRef("pk"), user=request.user
+                    )
+                )
+            )
+            .values("name", "saved")
+            .first()
+        )
+        if product_to_save is None:
+            return JsonResponse({"error": "produit introuvable"}, status=404)
+
+        if not product_to_save["saved"]:
+            ProductUsers.objects.bulk_create(
+                [ProductUsers(product_id=product_id, user=request.user)],
+                ignore_conflicts=True,
             )
-            product_user_relation.save()
+            favorite_toggles.inc(action="save")
             data = {
                 "saved": True,
-                "product_name": product_to_save.name,
+                "product_name": product_to_save["name"],
                 "response": "ajouté à vos favoris",
             }
         else:
             ProductUsers.objects.filter(
-                product=product_to_save, user=request.user
+                product_id=product_id, user=request.user
             ).delete()
+            favorite_toggles.inc(action="unsave")
             data = {
                 "saved": False,
-                "product_name": product_to_save.name,
+                "product_name": product_to_save["name"],
                 "response": "retiré de vos favoris",
             }
 
         return JsonResponse(data)
 
 
-class LegalNotice(View):
+class UserSaveProducts(View):
+    # maximum number of products saved or unsaved per request
+    max_products = 100
+
+    def post(self, request):
+        """Save or unsave many products for the authenticated user, from a
+        JSON body like {"product_ids": [1, 2], "saved": true}. Return the ids
+        of the products changed and the unknown ids as JSON"""
+        if not request.user.is_authenticated:
+            return JsonResponse({"error": "utilisateur non connecté"}, status=401)
+
+        try:
+            body = json.loads(request.body)
+            product_ids = [int(product_id) for product_id in body["product_ids"]]
+            saved = body["saved"]
+            if not isinstance(saved, bool):
+                raise TypeError
+        except (ValueError, TypeError, KeyError):
+            return JsonResponse({"error": "requête invalide"}, status=400)
+
+        if len(product_ids) > self.max_products:
+            return JsonResponse(
+                {"error": "{} produits au maximum".format(self.max_products)},
+                status=400,
+            )
+
+        existing_ids = sorted(
+            Product.objects.filter(id__in=product_ids).values_list("id", flat=True)
+        )
+
+        if saved:
+            ProductUsers.objects.bulk_create(
+                [
+                    ProductUsers(product_id=product_id, user=request.user)
+                    for product_id in existing_ids
+                ],
+                ignore_conflicts=True,
+            )
+        else:
+            ProductUsers.objects.filter(
+                user=request.user, product_id__in=existing_ids
+            ).delete()
+
+        favorite_toggles.inc(len(existing_ids), action="save" if saved else "unsave")
+
+        data = {
+            "saved": saved,
+            "product_ids": existing_ids,
+            "unknown_ids": sorted(set(product_ids) - set(existing_ids)),
+        }
+        return JsonResponse(data)
+
+
+class LegalNotice(AnonymousPageCacheMixin, SearchFormContextMixin, View):
     template_name = "products/legal-notice.html"
-    context = {
-        "search_form": SearchForm(),
-        "title": "Mentions légales"
-    }
+    extra_context = {"title": "Mentions légales"}
 
     def get(self, request):
         """Return the homepage template"""
-        return render(request, self.template_name, self.context)
+        return render(request, self.template_name, self.get_context_data())
+
+
+class Autocomplete(ReadReplicaMixin, View):
+    def get(self, request):
+        """Return the products whose name starts like the text of the "q"
+        parameter, as JSON, from the in-memory index of the products"""
+        suggestions = autocomplete(request.GET.get("q", ""))
+        data = {
+            "results": [
+                {
+                    "id": product_id,
+                    "name": name,
+                    "url": reverse("product-details", args=(product_id,)),
+                }
+                for product_id, name in suggestions
+            ]
+        }
+        return JsonResponse(data)
+
+
+# Threads running the synchronous code of the async views, every thread
+# keeps its own database connection
+views_executor = ThreadPoolExecutor(
+    max_workers=settings.ASYNC_VIEWS_THREADS, thread_name_prefix="async-views"
+)
+
+
+def run_in_views_executor(view):
+    """
+        Return an async version of a synchronous view.
+
+        The view runs in the bounded pool of threads of the async views, the
+        event loop of the worker keeps serving the other requests while the
+        database is queried, and the number of database connections is bounded
+        by ASYNC_VIEWS_THREADS. The thread runs with the context of the
+        request, so its queries and its profile are measured.
+    """
+
+    def call_view(request, *args, **kwargs):
+        close_old_connections()
+        try:
+            with profile_thread():
+                return view(request, *args, **kwargs)
+        finally:
+            close_old_connections()
+
+    async def async_view(request, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            views_executor,
+            functools.partial(context.run, call_view, request, *args, **kwargs),
+        )
+
+    functools.update_wrapper(async_view, view)
+    return async_view
+
+
+# Async views, used by the urls when ASYNC_VIEWS is set (ASGI server)
+search_result_async = run_in_views_executor(SearchResult.as_view())
+product_details_async = run_in_views_executor(ProductDetails.as_view())
+user_save_product_async = run_in_views_executor(UserSaveProduct.as_view())
+user_save_products_async = run_in_views_executor(UserSaveProducts.as_view())
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -18,14 +19,15 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 # SECURITY WARNING: don't run with debug turned on in production!
 # SECURITY WARNING: keep the secret key used in production secret!
-DEBUG = True
+DEBUG = os.environ.get("DJANGO_DEBUG", "1") == "1"
 SECRET_KEY = "%!p7ld+l#wxdmmo4u(7@swrvap*$05wom^6!q-flp$w+2#%$t-"
 
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/3.0/howto/deployment/checklist/
 
-ALLOWED_HOSTS = []
+# comma separated hosts of the site, the local ones by default
+ALLOWED_HOSTS = os.environ.get("ALLOWED_HOSTS", "localhost,127.0.0.1,[::1]").split(",")
 LOGIN_REDIRECT_URL = "/"
 
 
@@ -39,11 +41,11 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
-    "debug_toolbar",
     "django_crontab",
 ]
 
 MIDDLEWARE = [
+    "products.profiling.ProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -51,9 +53,15 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
-    "debug_toolbar.middleware.DebugToolbarMiddleware",
 ]
 
+# The middlewares above are async capable. The toolbar is not, on an ASGI
+# server it makes the async views run one at a time in the thread of the
+# synchronous code of Django
+if DEBUG:
+    INSTALLED_APPS.append("debug_toolbar")
+    MIDDLEWARE.append("debug_toolbar.middleware.DebugToolbarMiddleware")
+
 
 ROOT_URLCONF = "pureBeurreOC.urls"
 INTERNAL_IPS = ["127.0.0.1"]
@@ -69,6 +77,7 @@ TEMPLATES = [
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
+                "products.context_processors.catalog",
             ],
         },
     },
@@ -76,6 +85,11 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "pureBeurreOC.wsgi.application"
 
+# Async views for the search, product details and save endpoints, set by
+# gunicorn_asgi.conf.py. Their database queries run in a pool of threads.
+ASYNC_VIEWS = os.environ.get("ASYNC_VIEWS") == "1"
+ASYNC_VIEWS_THREADS = int(os.environ.get("ASYNC_VIEWS_THREADS", 8))
+
 
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
@@ -87,9 +101,33 @@ DATABASES = {
         "PASSWORD": "J4sp4r075",
         "HOST": "localhost",
         "PORT": "5432",
+        # seconds a connection is kept open between the requests
+        "CONN_MAX_AGE": int(os.environ.get("DB_CONN_MAX_AGE", "60")),
     }
 }
 
+# Read replica, used by the read-only views (search, details, autocomplete)
+if os.environ.get("DB_REPLICA_HOST"):
+    DATABASES["replica"] = dict(
+        DATABASES["default"],
+        HOST=os.environ["DB_REPLICA_HOST"],
+        PORT=os.environ.get("DB_REPLICA_PORT", DATABASES["default"]["PORT"]),
+        TEST={"MIRROR": "default"},
+    )
+
+# Connection pooler in transaction mode (pgbouncer) : the server-side cursors
+# of QuerySet.iterator() don't survive the end of the transactions
+if os.environ.get("DB_POOLER") == "1":
+    for database in DATABASES.values():
+        database["DISABLE_SERVER_SIDE_CURSORS"] = True
+
+DATABASE_ROUTERS = ["products.routers.ReplicaRouter"]
+
+# Check the persistent connections at the start of the requests, when they
+# have been idle for DATABASE_HEALTH_CHECK_IDLE seconds or their queries failed
+DATABASE_HEALTH_CHECKS = True
+DATABASE_HEALTH_CHECK_IDLE = 30
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -128,20 +166,136 @@ STATIC_URL = "/static/"
 
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
+# Cache : "file" (shared by the processes of the server and the cron job,
+# default), "redis" (requires django-redis and REDIS_URL) or "locmem" (memory
+# of every process). The import commands of the cron job invalidate the
+# entries of the catalog of the shared caches only, with a process memory
+# cache the version of the catalog expires after CATALOG_VERSION_LOCAL_TIMEOUT.
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "file")
+
+if CACHE_BACKEND == "file":
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": os.environ.get(
+                "CACHE_LOCATION", os.path.join(tempfile.gettempdir(), "purebeurre", "cache")
+            ),
+            "OPTIONS": {"MAX_ENTRIES": 20000},
+        }
+    }
+elif CACHE_BACKEND == "redis":
+    CACHES = {
+        "default": {
+            "BACKEND": "django_redis.cache.RedisCache",
+            "LOCATION": os.environ.get("REDIS_URL", "redis://127.0.0.1:6379/1"),
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "pure-beurre",
+            # the least recently used entries are removed past this size
+            "OPTIONS": {"MAX_ENTRIES": 5000, "CULL_FREQUENCY": 4},
+        }
+    }
+
+# Number of seconds the pages and searches stay in the cache
+CATALOG_CACHE_TIMEOUT = 60 * 60
+
+# Number of seconds the version of the catalog stays in a process memory cache
+CATALOG_VERSION_LOCAL_TIMEOUT = 5 * 60
+
+# Number of seconds the browsers and proxies use the pages of the catalog
+# before revalidating them with their ETag
+CATALOG_HTTP_MAX_AGE = 5 * 60
+
+# Profiling : fraction of the requests profiled with cProfile, number of
+# profiles kept in memory and of lines per profile, and duration from which
+# every request is logged
+PROFILING_SAMPLE_RATE = float(os.environ.get("PROFILING_SAMPLE_RATE", 0.01))
+PROFILING_MAX_PROFILES = 50
+PROFILING_PROFILE_LINES = 40
+PROFILING_SLOW_REQUEST_MS = 500
+
+# Metrics in the Prometheus text format on /metrics, with the stats of the
+# last database_update written in METRICS_IMPORT_FILE, shared by the cron job
+# and the web processes. Every web process saves its metrics in
+# METRICS_DIRECTORY every METRICS_SAVE_INTERVAL seconds at most. The metrics
+# are served to the staff users, to the addresses of METRICS_ALLOWED_IPS
+# (comma separated) and, when METRICS_TOKEN is set, to the requests sending
+# it as a bearer token
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+METRICS_ALLOWED_IPS = os.environ.get("METRICS_ALLOWED_IPS", "127.0.0.1,::1").split(",")
+METRICS_DIRECTORY = os.environ.get(
+    "METRICS_DIRECTORY", os.path.join(tempfile.gettempdir(), "purebeurre", "metrics")
+)
+METRICS_SAVE_INTERVAL = 10
+METRICS_IMPORT_FILE = os.environ.get(
+    "METRICS_IMPORT_FILE",
+    os.path.join(tempfile.gettempdir(), "purebeurre", "database_update.prom"),
+)
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        "products.profiling": {"handlers": ["console"], "level": "INFO"},
+    },
+}
+
+# Format of the logs of database_update : "text" or "json", one object per line
+IMPORT_LOG_FORMAT = os.environ.get("IMPORT_LOG_FORMAT", "text")
+
+# Number of substitutes precomputed and shown for a product
+NB_SUBSTITUTES = 12
+
+# Number of seconds the nutriments of a product stay in the cache
+NUTRITION_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Search autocompletion : minimum length of the text, also checked by the
+# script of the search forms. The in-memory index of every web process is
+# rebuilt when the version of the catalog changes
+AUTOCOMPLETE_MIN_LENGTH = 2
+
 # Django crontab
 CRONJOBS = [
     # Test cron job
     # ('*/1 * * * *', 'django.core.management.call_command', ['database_update'], {}, '>> ' + os.path.join(os.path.dirname(BASE_DIR), 'django_cron_test.log')),    
-    # Call manage.py custom command every Monday at 2:00 AM and append ouput to specified file
-    ('0 2 * * 1', 'django.core.management.call_command', ['database_update'], {}, '>> ' + os.path.join(os.path.dirname(BASE_DIR), 'django_cron.log')),
+    # Call manage.py custom command every Monday at 2:00 AM and append ouput to specified file,
+    # an interrupted import is continued from its checkpoints
+    ('0 2 * * 1', 'django.core.management.call_command', ['database_update', '--resume'], {}, '>> ' + os.path.join(os.path.dirname(BASE_DIR), 'django_cron.log')),
 ]
 
 # Open Food Facts API requests variables
 
 USER_AGENT_OFF = "Pur Beurre Django - Projet étudiant - Python - Version 3.7.3"
 
+OFF_SEARCH_URL = "https://fr-en.openfoodfacts.org/cgi/search.pl"
+
+# Url of the page of a product, from its code, for the products of the dumps
+OFF_PRODUCT_URL = "https://fr-en.openfoodfacts.org/product/{}"
+
+# Maximum number of products imported per category, requested page by page
 NB_PRODUCTS_TO_GET = 100
 
+OFF_PAGE_SIZE = 100
+
+# Maximum number of categories fetched at once, each one requesting its next
+# page while a page is read, timeout in seconds and retries with exponential
+# backoff of every request
+OFF_CONCURRENCY = 4
+OFF_TIMEOUT = 30
+OFF_RETRIES = 3
+OFF_BACKOFF_FACTOR = 1
+
+# Number of products written in the database per bulk insert
+IMPORT_BATCH_SIZE = 500
+
+# Number of processes of database_update, the categories are split between them
+IMPORT_WORKERS = int(os.environ.get("IMPORT_WORKERS", 1))
+
 PRODUCTS_CATEGORIES = {
     "plant-based-foods": "Fruits, Légumes, Plantes",
     "cereals-and-potatoes": "Féculents",
@@ -0,0 +1,16 @@
+from . import *
+
+# Local tests without a Postgres server : two SQLite databases, the replica
+# being a mirror of the primary database during the tests
+#   python manage.py test --settings=pureBeurreOC.settings.test
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(BASE_DIR, "db.sqlite3"),
+    },
+    "replica": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(BASE_DIR, "db-replica.sqlite3"),
+        "TEST": {"MIRROR": "default"},
+    },
+}
@@ -18,11 +18,15 @@ from django.contrib import admin
 from django.urls import include, path
 
 from products import views
+from products.metrics import metrics_view
+from products.profiling import profiling_report
 
 urlpatterns = [
     path("", views.HomeView.as_view()),
     path("legal-notice/", views.LegalNotice.as_view(), name="legal-notice"),
     path("products/", include("products.urls")),
+    path("metrics", metrics_view, name="metrics"),
+    path("vigile/profiling/", profiling_report, name="profiling-report"),
     path("vigile/", admin.site.urls),
 ]
 